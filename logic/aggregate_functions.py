@@ -1,30 +1,171 @@
 """
-To enable this, it has to be called by pulsar admin. Adjust depending on 'aggregate_functions.py' path
+To enable this, it has to be called by pulsar admin. As it imports 'message_schema.py',
+'commit_ranking.py' and 'bloom_filter.py', they are deployed together in a zip (see
+'scripts/init-functions.sh', which builds it). Adjust depending on the zip path
 $ bin/pulsar-admin functions create \
-  --py ~/de2_g12_project/producer/aggregate_functions.py \
+  --py ~/de2_g12_project/producer/aggregate_functions.zip \
   --classname aggregate_functions.AggregateFunction \
   --tenant public \
   --namespace static \
   --name aggregate_functions \
-  --inputs persistent://public/default/repos_for_commit_count,persistent://public/default/repo_with_tests,persistent://public/static/repo_with_ci,persistent://public/static/aggregate_languages_info 
+  --inputs persistent://public/default/repos_for_commit_count,persistent://public/default/repo_with_tests,persistent://public/static/repo_with_ci,persistent://public/static/aggregate_languages_info,persistent://public/static/commit_repo_info,persistent://public/static/commit_leaderboard_request \
+  --user-config '{"leaderboard_size": 100, "dedup_mode": "counter"}'
+User config (all optional):
+- leaderboard_size: number of repos in the commit leaderboard (100)
+- dedup_mode: how already reviewed repos are remembered, 'counter' (one counter per repo) or
+  'bloom' (a sharded Bloom filter, fixed size) ('counter'). Bloom filter shards are cached
+  by each instance of the function, so 'bloom' needs --parallelism 1, or input topics routed
+  by repo_id key, for every repo to be counted once. Changing the mode of an existing
+  deployment starts from an empty dedup history, so already seen repos are counted again
+- dedup_expected_repos, dedup_false_positive_rate, dedup_shards: size of each Bloom filter
+  (1000000, 0.001, 1024). A false positive makes a new repo count as already reviewed
+- flush_messages, flush_interval_ms: language counters and Bloom filter shards are updated in
+  memory, and written to the state store every flush_messages messages or flush_interval_ms
+  milliseconds, whatever comes first, and always before answering to aggregate_languages_info
+  (500, 5000). In 'counter' mode the repo counters are written as soon as the repo is, so a
+  restart can't leave a repo marked as reviewed without its language counted; only -ci
+  counters are buffered then
 Some counters and topics we're using:
 Global counters:
-- *repo_id* : a 1 indicates that the repository has already been reviewed
-- *repo_id*-tests : a 1 indicates that the repository has been reviewed for tests
-- *language*-repos: counts number of repositories in *language*
+- *repo_id* : a 1 indicates that the repository has already been reviewed ('counter' mode)
+- *repo_id*-tests : a 1 indicates that the repository has been reviewed for tests ('counter' mode)
+- *language*-repos: counts number of repositories in *language* ('None' for repos without one)
 - *language*-tests: counts number of repositories of *language* that use tests
 - *language*-ci: counts number of repositories of *language* that use ci/cd
+Global state:
+- commit_leaderboard: top 'leaderboard_size' repos by commits, as a commit_ranking checkpoint
+- dedup-repos-*shard*, dedup-tests-*shard*: Bloom filter shards of the reviewed repos ('bloom' mode)
 Result topics:
-- persistent://public/static/languages: keeps track of unique languages
+- persistent://public/static/languages: keeps track of the languages seen, published as soon as
+  they're first seen (might be repeated with --parallelism)
 - persistent://public/static/language_results: aggregated information of each language
+- persistent://public/static/commit_leaderboard: snapshot of the commit leaderboard, published
+  each time a message arrives to persistent://public/static/commit_leaderboard_request
+Messages in and out are message_schema records
 """
 
+import collections
+import time
+
 from pulsar import Function
 
+import message_schema
+from message_schema import BasicRepoInfo, CommitRepoInfo, RepoWithCi, LanguageResult
+from commit_ranking import CommitRanking
+from bloom_filter import ShardedBloomFilter
+
 class AggregateFunction(Function):
     def __init__(self):
         self.tenant = 'public'
         self.namespace = 'static'
+        # Commit leaderboard, loaded from the function state on first use
+        self.leaderboard = None
+        # 'bloom' dedup mode: one filter for reviewed repos, one for repos reviewed for
+        # tests. Their shards are loaded from the state on first use
+        self.dedup_mode = None
+        self.dedup_filters = {}
+        # Increments of the *language*-repos/tests/ci counters not written to the state yet
+        self.language_deltas = collections.Counter()
+        # Languages already seen by this instance, so published to the 'languages' topic
+        self.known_languages = set()
+        self.flush_messages = 500
+        self.flush_interval_ms = 5000
+        self.messages_since_flush = 0
+        self.last_flush = time.monotonic()
+
+    def _setup(self, context):
+        self.flush_messages = int(context.get_user_config_value('flush_messages') or 500)
+        self.flush_interval_ms = int(context.get_user_config_value('flush_interval_ms') or 5000)
+
+        self.dedup_mode = context.get_user_config_value('dedup_mode') or 'counter'
+        if self.dedup_mode != 'bloom':
+            return
+        expected_repos = int(context.get_user_config_value('dedup_expected_repos') or 1000000)
+        false_positive_rate = float(context.get_user_config_value('dedup_false_positive_rate') or 0.001)
+        shards = int(context.get_user_config_value('dedup_shards') or 1024)
+        for dedup_set in ['repos', 'tests']:
+            self.dedup_filters[dedup_set] = ShardedBloomFilter(expected_repos, false_positive_rate, shards)
+
+    def _is_new_repo(self, context, dedup_set, repo_id):
+        """ True the first time repo_id is seen in dedup_set ('repos' or 'tests') """
+        if self.dedup_mode != 'bloom':
+            # One counter per repo: two state operations per message
+            counter = repo_id if dedup_set == 'repos' else f'{repo_id}-tests'
+            context.incr_counter(counter, 1)
+            return context.get_counter(counter) == 1
+
+        # A local check, the state is only read the first time a shard is used
+        bloom = self.dedup_filters[dedup_set]
+        shard = bloom.shard_of(repo_id)
+        if not bloom.is_loaded(shard):
+            bloom.load_shard(shard, context.get_state(f'dedup-{dedup_set}-{shard}'))
+        return bloom.add(repo_id)
+
+    def _count_repo(self, context, counter):
+        """ Counts a repo just found new in a *language*-repos/tests counter. In 'counter'
+        mode its dedup counter is already written, so this one is written along with it.
+        Bloom filter shards are written on flush, so its increment waits for it too """
+        if self.dedup_mode != 'bloom':
+            context.incr_counter(counter, 1)
+            return
+        self.language_deltas[counter] += 1
+
+    def _flush(self, context):
+        """ Writes the language counter increments and the Bloom filter shards changed
+        since the last flush. Shards are merged with the saved ones first, as other
+        instances of the function (with --parallelism) might have changed them too """
+        for counter, delta in self.language_deltas.items():
+            context.incr_counter(counter, delta)
+        self.language_deltas.clear()
+
+        for dedup_set, bloom in self.dedup_filters.items():
+            for shard in bloom.dirty:
+                key = f'dedup-{dedup_set}-{shard}'
+                bloom.merge_shard(shard, context.get_state(key))
+                context.put_state(key, bloom.shard_bytes(shard))
+            bloom.dirty.clear()
+
+        self.messages_since_flush = 0
+        self.last_flush = time.monotonic()
+
+    def _see_language(self, context, language):
+        """ Publishes a language to the 'languages' topic as soon as it's first seen, not on
+        the next flush, so results read in the meantime don't leave it out. Its counter
+        is only written after it's published, so a counter still at 0 means nobody published
+        it yet. Other instances might publish it at the same time: readers of the topic
+        skip repeated languages """
+        if language in self.known_languages:
+            return
+        if int(context.get_counter(f"{language}-repos") or 0) == 0:
+            context.publish(
+                topic_name=f"persistent://{self.tenant}/{self.namespace}/languages",
+                message=language.encode('utf-8'))
+        self.known_languages.add(language)
+
+    def _get_leaderboard(self, context):
+        if self.leaderboard is None:
+            size = int(context.get_user_config_value('leaderboard_size') or 100)
+            self.leaderboard = self._merge_state_leaderboard(context, CommitRanking(size))
+        return self.leaderboard
+
+    @staticmethod
+    def _merge_state_leaderboard(context, leaderboard):
+        """ Adds the leaderboard saved in the state store to the local one. Other instances
+        of the function (with --parallelism) might have updated it """
+        snapshot = context.get_state('commit_leaderboard')
+        if snapshot:
+            saved, _ = CommitRanking.from_checkpoint(snapshot, leaderboard.size)
+            for record in saved.top():
+                leaderboard.add(record)
+        return leaderboard
+
+    def _update_leaderboard(self, message, context):
+        """ Only a repo entering the top changes the leaderboard, and only then the
+        state gets written """
+        leaderboard = self._get_leaderboard(context)
+        if leaderboard.add(message):
+            self._merge_state_leaderboard(context, leaderboard)
+            context.put_state('commit_leaderboard', leaderboard.to_checkpoint({}))
 
     # This function gets called each time a day is published in
     # the topic: persistent://public/static/days_processed
@@ -33,46 +174,58 @@ class AggregateFunction(Function):
         #logger.info(f"Message content: {item}")
         #logger.info(f"*** In topic: {context.get_current_message_topic_name()}")
         
+        if self.dedup_mode is None:
+            self._setup(context)
+        
         in_topic = context.get_current_message_topic_name()
         if 'repos_for_commit_count' in in_topic:
             # basic_repo_info: (repo_id, 'owner', 'name', 'language')
-            message = eval(item) # convert byte to text, and then to tuple
+            message = message_schema.decode(item, BasicRepoInfo)
             repo_id = str(message[0])            
-            context.incr_counter(f'{repo_id}', 1) # register we've reviewed repo_id
-            if (context.get_counter(f'{repo_id}') == 1):
+            # Repos without a primary language are counted under 'None'
+            language = str(message[3])
+            # register we've reviewed repo_id
+            if self._is_new_repo(context, 'repos', repo_id):
                 # Increase the language counter if the repo hasn't been processed before
-                language_repos = f"{message[3]}-repos"
-                context.incr_counter(f'{language_repos}', 1)
-                if (context.get_counter(f'{language_repos}') == 1):
-                    # If its the first time we see the language publish it to 'languages' topic
-                    context.publish(
-                        topic_name=f"persistent://{self.tenant}/{self.namespace}/languages",
-                        message=(message[3]).encode('utf-8'))
+                self._see_language(context, language)
+                self._count_repo(context, f"{language}-repos")
         elif 'repo_with_tests' in in_topic:
-            message = eval(item)
+            message = message_schema.decode(item, BasicRepoInfo)
             repo_id = str(message[0])
             # repo_with_tests: (repo_id, 'owner', 'name', 'language')
-            repo_id_tests = f"{repo_id}-tests"
-            context.incr_counter(f'{repo_id_tests}', 1)
-            if (context.get_counter(f'{repo_id_tests}') == 1):
+            if self._is_new_repo(context, 'tests', repo_id):
                 # Increase counter if the repo hasn't been processed before for tests
-                language_tests = f"{message[3]}-tests"
-                context.incr_counter(f'{language_tests}', 1)
+                self._count_repo(context, f"{message[3]}-tests")
         elif 'repo_with_ci' in in_topic:
-            message = eval(item)
+            message = message_schema.decode(item, RepoWithCi)
             repo_id = str(message[0])
             # repo_wit_ci: (repo_id, 'owner', 'name', 'language')
             # This time there's no need to check if the repo has been processed multiple times
-            language_ci = f"{message[1]}-ci"
-            context.incr_counter(f'{language_ci}', 1)
+            self.language_deltas[f"{message[1]}-ci"] += 1
+        elif 'commit_repo_info' in in_topic:
+            # commit_repo_info: (repo_id, num_commits, 'owner', 'name')
+            self._update_leaderboard(message_schema.decode(item, CommitRepoInfo), context)
+        elif 'commit_leaderboard_request' in in_topic:
+            leaderboard = self._merge_state_leaderboard(context, self._get_leaderboard(context))
+            context.publish(
+                topic_name=f"persistent://{self.tenant}/{self.namespace}/commit_leaderboard",
+                message=leaderboard.to_checkpoint({}))
         elif 'aggregate_languages_info' in in_topic:
-            language = item
+            language = item.decode('utf-8') if isinstance(item, bytes) else item
+            # Counters have to be up to date before reading them
+            self._flush(context)
             num_repos = int(context.get_counter(f"{language}-repos") or 0)
             num_tests = int(context.get_counter(f"{language}-tests") or 0)
             num_cis = int(context.get_counter(f"{language}-ci") or 0)
             # Create a tuple with all info to publish
             # ('language', num_repos, num_tests, num_cis)
-            lang_tuple = f"('{language}', {num_repos}, {num_tests}, {num_cis})"
+            lang_tuple = LanguageResult(language, num_repos, num_tests, num_cis)
             context.publish(
                 topic_name=f"persistent://{self.tenant}/{self.namespace}/language_results",
-                message=(lang_tuple).encode('utf-8'))
\ No newline at end of file
+                message=message_schema.encode(lang_tuple))
+        
+        # Counters and changed Bloom filter shards are written in batches
+        self.messages_since_flush += 1
+        if (self.messages_since_flush >= self.flush_messages or
+                (time.monotonic() - self.last_flush) * 1000 >= self.flush_interval_ms):
+            self._flush(context)
\ No newline at end of file
@@ -1,18 +1,99 @@
+import fnmatch
+import json
 import random
 import time
-import uuid
-from typing import List, Dict
+from typing import Callable, List, Dict, Tuple, Optional
 
 import requests
-from github import RateLimitExceededException
 from requests import Response
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
+from rate_limiter import SECONDARY_LIMIT_WAIT
 
-class RateLimitException(Exception):
+# Most ids GitHub resolves in a single nodes(ids: [..]) field
+NODES_PER_FIELD = 100
+
+
+class GithubException(Exception):
+    """ Base of the errors of GitHub requests. Their type tells what to do about them:
+    - RateLimitException: the token has no quota left, use another one
+    - UnauthorizedException: the token is bad, stop using it
+    - TransientException: server errors, timeouts and connection errors, retry later
+    - RepoException: the repo can't be read (deleted, private, blocked..), skip it
+    Other exceptions are unexpected, likely bugs """
+    pass
+
+
+class RateLimitException(GithubException):
+    def __init__(self, resource: Optional[str] = None, reset: Optional[float] = None):
+        super().__init__(resource, reset)
+        # Resource whose limit was hit, and when it resets (epoch seconds), if known
+        self.resource = resource
+        self.reset = reset
+
+
+def is_rate_limited(response: Response) -> bool:
+    """ Whether response is a rate limit error: of the primary limits (no requests left),
+    or of the secondary ones (too many requests too fast, see rate_limiter.py) """
+    if response.status_code == 429:
+        return True
+
+    if response.status_code != 403:
+        return False
+
+    if response.headers.get('Retry-After') is not None:
+        return True
+
+    remaining_header = response.headers.get('X-RateLimit-Remaining')
+    if remaining_header is not None:
+        try:
+            if int(remaining_header) < 1:
+                return True
+        except ValueError:
+            pass
+            # Could not parse int from remaining_header, look at the message instead
+
+    try:
+        data = response.json()
+    except ValueError:
+        return False
+
+    message = data.get('message') if isinstance(data, dict) else None
+    return isinstance(message, str) and \
+        (message.startswith('You have exceeded') or 'secondary rate limit' in message)
+
+
+def rate_limit_exception(response: Response) -> RateLimitException:
+    try:
+        retry_after = float(response.headers.get('Retry-After'))
+    except (TypeError, ValueError):
+        retry_after = None
+
+    try:
+        remaining = int(response.headers.get('X-RateLimit-Remaining'))
+        reset = float(response.headers.get('X-RateLimit-Reset'))
+    except (TypeError, ValueError):
+        remaining, reset = None, None
+
+    if retry_after is not None:
+        reset = time.time() + retry_after
+    elif remaining is not None and remaining > 0:
+        # A secondary limit, with quota left until the reset
+        reset = time.time() + SECONDARY_LIMIT_WAIT
+
+    return RateLimitException(resource=response.headers.get('X-RateLimit-Resource'), reset=reset)
+
+
+class UnauthorizedException(GithubException):
     pass
 
 
-class UnauthorizedException(Exception):
+class TransientException(GithubException):
+    pass
+
+
+class RepoException(GithubException):
     pass
 
 
@@ -28,38 +109,43 @@ def find_property(tree: Dict, path: List[str]):
 
 
 def ensure_success(response: Response):
-    if not response.ok:
-        if response.status_code == 403:
-            remaining_header = response.headers.get('X-RateLimit-Remaining')
-
-            if remaining_header is not None:
-                try:
-                    remaining = int(remaining_header)
-                    if remaining < 1:
-                        raise RateLimitException
-                except ValueError:
-                    pass
-                    # Could not parse int from remaining_header, return invalid status code instead
-                    # and do nothing in this except clause
-
-            data = response.json()
-            message = data.get('message') if data is not None else None
-            if message is not None and isinstance(message, str) and \
-                    message.startswith('You have exceeded'):
-                raise RateLimitException
-            
+    # Also used with httpx responses (see async_api_wrapper.py), which have no 'ok'
+    if response.status_code >= 400:
+        if is_rate_limited(response):
+            raise rate_limit_exception(response)
+
         if response.status_code == 401:
             raise UnauthorizedException
 
-        raise Exception(f"Received HTTP status code does not indicate success: {response.status_code}")
+        message = f"Received HTTP status code does not indicate success: {response.status_code}"
+
+        if response.status_code >= 500 or response.status_code == 408:
+            raise TransientException(message)
+
+        # Not found, gone, unprocessable (like a search in a missing repo) and legal reasons
+        if response.status_code in [404, 410, 422, 451]:
+            raise RepoException(message)
+
+        raise Exception(message)
+
+
+def ensure_data(response_dict: Dict):
+    """ A GraphQL query that failed as a whole (usually because it timed out) has no data """
+    if response_dict.get("data") is None:
+        raise TransientException(f"No data received: {response_dict.get('errors')}")
+
+
+def is_file_pattern(file_name: str) -> bool:
+    return any(char in file_name for char in '*?[')
 
 
 class RepoName:
-    def __init__(self, owner: str, name: str, repo_id: int = -1):
+    def __init__(self, owner: str, name: str, repo_id: int = -1, node_id: Optional[str] = None):
         self.owner = owner
         self.name = name
         self.id = repo_id
-        self.uuid = uuid.uuid4()
+        # GraphQL global id, which doesn't change when the repo is renamed
+        self.node_id = node_id
 
     def __str__(self):
         return self.full_name()
@@ -113,11 +199,27 @@ class RepoFile:
         }
 
 
+class RepoSearchPage:
+    def __init__(self, total_count: int, repos: List[Tuple[int, str, str, str, str]]):
+        # Number of repos matching the query, even past the 1000 the search API returns
+        self.total_count = total_count
+        # (repo_id, 'owner', 'name', 'language', 'node_id') of the repos in this page
+        self.repos = repos
+
+    def __str__(self):
+        return f"( total_count: {self.total_count}, repos: {len(self.repos)} )"
+
+    def __repr__(self):
+        return f"( total_count: {self.total_count}, repos: {len(self.repos)} )"
+
+
 class RateLimit:
-    def __init__(self, core: int, search: int, graphql: int):
+    def __init__(self, core: int, search: int, graphql: int, resets: Optional[Dict[str, Tuple[int, float]]] = None):
         self.core = core
         self.search = search
         self.graphql = graphql
+        # resource -> (remaining, reset epoch seconds), of every resource GitHub reported
+        self.resets = resets or {}
 
     def is_exceeded(self):
         limits = [
@@ -130,16 +232,139 @@ class RateLimit:
 
 
 class GithubWrapper:
+    # Read once, shared by every instance
+    _query_template = None
+
     def __init__(self,
                  auth_tokens: List[str],
                  graphql_url: str = 'https://graphql.github.com',
+                 graphql_api_url: str = 'https://api.github.com/graphql',
                  repositories_url: str = 'https://api.github.com/repositories',
-                 search_url: str = 'https://api.github.com/search/code'):
+                 search_url: str = 'https://api.github.com/search/code',
+                 repo_search_url: str = 'https://api.github.com/search/repositories',
+                 session: Optional[requests.Session] = None,
+                 timeout: float = 30,
+                 scheduler=None,
+                 rate_limiter=None):
         self.tokens = auth_tokens
-        self.query_template = open("repo_query.graphql", "r").read()
+        self.query_template = GithubWrapper._load_query_template()
+        # Connections are kept alive and reused by the session across requests
+        self.session = session or GithubWrapper.create_session()
+        self.timeout = timeout
+        # TokenScheduler (token_scheduler.py) told of the quota left after every response
+        self.scheduler = scheduler
+        # RateLimiter (rate_limiter.py) pacing the requests of every token, if any
+        self.rate_limiter = rate_limiter
+        self.request_count = 0
+        self.request_time = 0.0
+        self.last_request_time = 0.0
+        # rateLimit of the last GraphQL query: points it cost, points left and when they reset
+        self.last_query_cost = None
+        self.graphql_remaining = None
+        self.graphql_reset_at = None
+        # Times the last batch of a GraphQL query (see _query_in_parts) had to be split
+        self.last_query_splits = 0
         self.graphql_url = graphql_url
+        # Where GraphQL queries are posted to (graphql_url is only their Origin)
+        self.graphql_api_url = graphql_api_url
         self.repositories_url = repositories_url
         self.search_url = search_url
+        self.repo_search_url = repo_search_url
+
+    @classmethod
+    def _load_query_template(cls):
+        if cls._query_template is None:
+            with open("repo_query.graphql", "r") as query_file:
+                cls._query_template = query_file.read()
+
+        return cls._query_template
+
+    @staticmethod
+    def create_session(pool_size: int = 10, retries: int = 3) -> requests.Session:
+        # Retry what is likely transient (connection errors and 502/503/504),
+        # backing off 0.5s, 1s, 2s.. and honouring Retry-After
+        retry = Retry(
+            total=retries,
+            backoff_factor=0.5,
+            status_forcelist=[502, 503, 504],
+            allowed_methods=frozenset(['GET', 'POST']),
+            raise_on_status=False
+        )
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+
+        session = requests.Session()
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        return session
+
+    def _send(self, method: str, request: Dict) -> Response:
+        delay = self._pace(request)
+        if delay > 0:
+            time.sleep(delay)
+
+        start = time.perf_counter()
+        try:
+            response = self.session.request(method, timeout=self.timeout, **request)
+        except (requests.exceptions.Timeout, requests.exceptions.ConnectionError) as e:
+            raise TransientException(str(e)) from e
+        self._record_rate_limit(request, response)
+        self.last_request_time = time.perf_counter() - start
+        self.request_count += 1
+        self.request_time += self.last_request_time
+        return response
+
+    @staticmethod
+    def _request_token(request: Dict) -> Optional[str]:
+        authorization = request.get('headers', {}).get('Authorization', '')
+        if authorization.startswith('bearer '):
+            return authorization[len('bearer '):]
+        return None
+
+    def _resource(self, request: Dict) -> str:
+        """ Rate limit resource a request counts against """
+        if request['url'] == self.graphql_api_url:
+            return 'graphql'
+        if request['url'] == self.search_url:
+            return 'code_search'
+        if request['url'] == self.repo_search_url:
+            return 'search'
+        return 'core'
+
+    def _pace(self, request: Dict) -> float:
+        """ Seconds to wait before sending request, so its token stays under its limits """
+        token = self._request_token(request)
+        if self.rate_limiter is None or token is None:
+            return 0
+        return self.rate_limiter.reserve(token, self._resource(request))
+
+    def _record_rate_limit(self, request: Dict, response: Response):
+        token = self._request_token(request)
+        if token is None:
+            return
+
+        if self.scheduler is not None:
+            self.scheduler.update_from_headers(token, response.headers)
+
+        if self.rate_limiter is not None:
+            # The resource GitHub counted the request against, if it says
+            resource = response.headers.get('X-RateLimit-Resource') or self._resource(request)
+            self.rate_limiter.record(token, resource, response.headers, limited=is_rate_limited(response))
+
+    def connection_stats(self) -> Dict:
+        """ Requests made, connections opened for them (the rest reused an open
+        one), and seconds spent in the requests """
+        connections = 0
+        for adapter in set(self.session.adapters.values()):
+            pools = adapter.poolmanager.pools
+            for key in pools.keys():
+                connections += pools[key].num_connections
+
+        return {
+            'requests': self.request_count,
+            'new_connections': connections,
+            'reused_connections': max(0, self.request_count - connections),
+            'request_time': self.request_time
+        }
 
     @staticmethod
     def read_tokens_from_file(file_path: str):
@@ -152,17 +377,21 @@ class GithubWrapper:
         repos = self.get_repos(start_index)
         return self.get_stats(repos)
 
+    # Requests are built and responses parsed by the _*_request and _parse_* helpers below,
+    # so AsyncGithubWrapper (async_api_wrapper.py) can share them with its own HTTP client
+
     @staticmethod
-    def get_rate_limit(token: str) -> RateLimit:
-        headers = {
-            'Accept': 'application/vnd.github.v3+json',
-            'Authorization': 'bearer ' + token
+    def _rate_limit_request(token: str) -> Dict:
+        return {
+            'url': 'https://api.github.com/rate_limit',
+            'headers': {
+                'Accept': 'application/vnd.github.v3+json',
+                'Authorization': 'bearer ' + token
+            }
         }
 
-        response = requests.get(
-            'https://api.github.com/rate_limit',
-            headers=headers)
-
+    @staticmethod
+    def _parse_rate_limit(response: Response, token: str) -> RateLimit:
         try:
             ensure_success(response)
         except UnauthorizedException:
@@ -174,31 +403,45 @@ class GithubWrapper:
         return RateLimit(
             core=res['core']['remaining'],
             search=res['search']['remaining'],
-            graphql=res['graphql']['remaining']
+            graphql=res['graphql']['remaining'],
+            resets={
+                resource: (limit['remaining'], limit['reset'])
+                for resource, limit in res.items()
+            }
         )
 
-    def get_files(self, repo_name: RepoName, file_names) -> List[RepoFile]:
-        headers = {
-            'Accept': 'application/vnd.github.v3+json',
-            'Authorization': 'bearer ' + self.get_token()
-        }
+    @staticmethod
+    def get_rate_limit(token: str, session: Optional[requests.Session] = None) -> RateLimit:
+        response = (session or requests).get(timeout=30, **GithubWrapper._rate_limit_request(token))
+        return GithubWrapper._parse_rate_limit(response, token)
 
-        params = {
-            'q': f'repo:{repo_name.owner}/{repo_name.name}' +
-                 ''.join(map(lambda name: ' filename:' + name, file_names))
+    def _files_request(self, repo_name: RepoName, file_names) -> Dict:
+        return {
+            'url': self.search_url,
+            'headers': {
+                'Accept': 'application/vnd.github.v3+json',
+                'Authorization': 'bearer ' + self.get_token()
+            },
+            'params': {
+                'q': f'repo:{repo_name.owner}/{repo_name.name}' +
+                     ''.join(map(lambda name: ' filename:' + name, file_names))
+            }
         }
 
-        response = requests.get(
-            self.search_url,
-            headers=headers,
-            params=params)
-
+    def _ensure_success(self, response: Response):
         try:
             ensure_success(response)
         except UnauthorizedException:
             print(f'401 unauthorized http status using token \"{self.get_token()}\". Bad token?')
             raise
 
+    def get_files(self, repo_name: RepoName, file_names) -> List[RepoFile]:
+        response = self._send('GET', self._files_request(repo_name, file_names))
+        return self._parse_files(response)
+
+    def _parse_files(self, response: Response) -> List[RepoFile]:
+        self._ensure_success(response)
+
         search_result = response.json()
         results = []
 
@@ -210,25 +453,62 @@ class GithubWrapper:
 
         return results
 
-    def get_repos(self, start_index: int = 0):
-        headers = {
-            'Accept': 'application/vnd.github.v3+json'
+    def _search_repos_request(self, query: str, page: int = 1, per_page: int = 100, sort: str = 'stars') -> Dict:
+        return {
+            'url': self.repo_search_url,
+            'headers': {
+                'Accept': 'application/vnd.github.v3+json',
+                'Authorization': 'bearer ' + self.get_token()
+            },
+            'params': {
+                'q': query,
+                'sort': sort,
+                'page': page,
+                'per_page': per_page
+            }
         }
 
-        params = {
-            'since': start_index
+    def search_repos(self, query: str, page: int = 1, per_page: int = 100, sort: str = 'stars') -> RepoSearchPage:
+        response = self._send('GET', self._search_repos_request(query, page, per_page, sort))
+        return self._parse_search_repos(response)
+
+    def _parse_search_repos(self, response: Response) -> RepoSearchPage:
+        self._ensure_success(response)
+
+        search_result = response.json()
+        repos = []
+
+        for repo in search_result['items']:
+            repos.append((
+                int(repo['id']),
+                repo['owner']['login'],
+                repo['name'],
+                repo['language'],
+                repo.get('node_id')
+            ))
+
+        return RepoSearchPage(
+            total_count=search_result['total_count'],
+            repos=repos
+        )
+
+    def _repos_request(self, start_index: int = 0) -> Dict:
+        return {
+            'url': self.repositories_url,
+            'headers': {
+                'Accept': 'application/vnd.github.v3+json'
+            },
+            'params': {
+                'since': start_index
+            }
         }
 
-        response = requests.get(
-            self.repositories_url,
-            headers=headers,
-            params=params)
+    def get_repos(self, start_index: int = 0):
+        response = self._send('GET', self._repos_request(start_index))
+        return self._parse_repos(response)
 
-        try:
-            ensure_success(response)
-        except UnauthorizedException:
-            print(f'401 unauthorized http status using token \"{self.get_token()}\". Bad token?')
-            raise
+    def _parse_repos(self, response: Response) -> List[RepoName]:
+        self._ensure_success(response)
 
         repo_list = response.json()
         results = []
@@ -243,8 +523,106 @@ class GithubWrapper:
         return results
 
     def get_stats(self, repos: List[RepoName]) -> Dict[str, RepoStats]:
-        # GraphQL used for this is from the following stackoverflow thread:
-        # https://stackoverflow.com/questions/27931139/how-to-use-github-v3-api-to-get-commit-count-for-a-repo
+        stats, errors = self.get_stats_partial(repos)
+        return stats
+
+    def get_stats_partial(self, repos: List[RepoName]) -> Tuple[Dict[str, RepoStats], Dict[str, str]]:
+        """ get_stats, keeping whatever part of the batch could be read (see _query_in_parts).
+        Returns the stats, and the error of each repo that couldn't be read (like deleted or
+        private ones), both keyed by str(repo_name) """
+        results = {}
+        errors = {}
+
+        for batch, response_dict in self._query_in_parts(repos, self._stats_request):
+            stats, batch_errors = self._stats_from_response(response_dict, batch)
+            results.update(stats)
+            errors.update(batch_errors)
+
+        return results, errors
+
+    def _query_in_parts(self, repos: List[RepoName], request: Callable[[List[RepoName]], Dict]) -> List[Tuple[List[RepoName], Dict]]:
+        """ Sends the GraphQL query request(repos). A batch failing as a whole with a
+        TransientException (a server error after the session retries, a timeout, or a query
+        without data) is split in halves which are sent separately, down to single repos.
+        A single repo still failing so is raised, as that's no reason to think the repo
+        can't be read, just that GitHub can't answer now. Returns each batch sent, in the
+        order of repos, with its parsed response """
+        parts = []
+        pending = [repos]
+        self.last_query_splits = 0
+
+        while len(pending) > 0:
+            batch = pending.pop()
+
+            try:
+                response = self._send('POST', request(batch))
+                response_dict = self._graphql_response(response)
+            except TransientException:
+                if len(batch) < 2:
+                    raise
+
+                middle = len(batch) // 2
+                pending.extend([batch[middle:], batch[:middle]])
+                self.last_query_splits += 1
+                continue
+
+            parts.append((batch, response_dict))
+
+        return parts
+
+    def _repos_selection(self, repos: List[RepoName], body: str) -> str:
+        """ GraphQL selection of many repos in a single request. If all of them have a node_id,
+        with nodes(ids: [..]) fields of up to NODES_PER_FIELD repos, nodes_*index of the
+        field*. Otherwise each repo goes under its own alias, repo_*index in repos* """
+        if all(repo_name.node_id is not None for repo_name in repos):
+            body = ''.join(['  ' + line for line in body.splitlines(True)])
+            fields = []
+            for field, start in enumerate(range(0, len(repos), NODES_PER_FIELD)):
+                ids = ', '.join([json.dumps(repo_name.node_id)
+                                 for repo_name in repos[start:start + NODES_PER_FIELD]])
+                fields.append(f'  nodes_{field}: nodes(ids: [{ids}]) {{\n    ... on Repository {{\n{body}    }}\n  }}\n')
+            return ''.join(fields)
+
+        repo_template = '  repo_$INDEX: repository(owner: "$OWNER", name: "$REPO") {\n$BODY  }\n'
+
+        return '\n'.join([
+            repo_template
+                .replace("$INDEX", str(index)) \
+                .replace("$OWNER", repo_name.owner) \
+                .replace("$REPO", repo_name.name) \
+                .replace("$BODY", body)
+            for index, repo_name in enumerate(repos)
+        ])
+
+    @staticmethod
+    def _repos_results(response_dict: Dict, repos: List[RepoName]) -> List[Tuple[Optional[Dict], Optional[str]]]:
+        """ Result and error of each repo selected with _repos_selection, in the same order.
+        Repos that can't be read (deleted, private..) have a null result, and an error
+        whose path leads to them """
+        result_dict = response_dict.get("data") or {}
+        errors = {}
+
+        for error in response_dict.get("errors") or []:
+            path = error.get("path") or []
+            in_nodes = len(path) > 0 and str(path[0]).startswith("nodes_")
+            key = tuple(path[:2]) if in_nodes else tuple(path[:1])
+            errors[key] = error.get("message")
+
+        if "nodes_0" in result_dict:
+            results = []
+            for index in range(len(repos)):
+                field, offset = divmod(index, NODES_PER_FIELD)
+                nodes = result_dict.get(f"nodes_{field}") or []
+                results.append((nodes[offset] if offset < len(nodes) else None,
+                                errors.get((f"nodes_{field}", offset))))
+            return results
+
+        return [
+            (result_dict.get(f"repo_{index}"), errors.get((f"repo_{index}",)))
+            for index in range(len(repos))
+        ]
+
+    def _graphql_request(self, query: str) -> Dict:
         headers = {
             'User-Agent': 'DE2 github project bot',
             'Accept': '*/*',
@@ -259,35 +637,140 @@ class GithubWrapper:
             'Sec-GPC': '1',
         }
 
-        repo_template = '  repo_$INDEX: repository(owner: "$OWNER", name: "$REPO") {\n    ...RepoFragment\n  }\n'
-
-        repo_templates = '\n'.join([
-            repo_template
-                .replace("$INDEX", repo_name.uuid.hex) \
-                .replace("$OWNER", repo_name.owner) \
-                .replace("$REPO", repo_name.name)
-            for repo_name in repos
-        ])
-
-        query = self.query_template.replace("$REPOS", repo_templates)
-
         json_data = {
             'query': query,
             'variables': {},
         }
 
-        response = requests.post('https://api.github.com/graphql', headers=headers,
-                                 json=json_data)
+        return {
+            'url': self.graphql_api_url,
+            'headers': headers,
+            'json': json_data
+        }
 
-        try:
-            ensure_success(response)
-        except UnauthorizedException:
-            print(f'401 unauthorized http status using token \"{self.get_token()}\". Bad token?')
-            raise
+    def _stats_request(self, repos: List[RepoName]) -> Dict:
+        # GraphQL used for this is from the following stackoverflow thread:
+        # https://stackoverflow.com/questions/27931139/how-to-use-github-v3-api-to-get-commit-count-for-a-repo
+        query = self.query_template.replace("$REPOS", self._repos_selection(repos, '    ...RepoFragment\n'))
+        return self._graphql_request(query)
+
+    def find_files(self, repos: List[RepoName], file_names) -> List[List[RepoFile]]:
+        """ Like get_files, but for many repos in a single GraphQL request instead of one
+        code search per repo. Returns the files found in each repo, in the same order.
+        Paths (like '.github/workflows') are looked up in the default branch. Patterns
+        (like 'test*') are matched against the names at the root of the repo """
+        files = []
+        for batch, response_dict in self._query_in_parts(
+                repos, lambda batch: self._find_files_request(batch, file_names)):
+            files.extend(self._files_from_response(response_dict, batch, file_names))
+        return files
+
+    def get_stats_and_files(self, repos: List[RepoName], file_names) -> Tuple[Dict[str, RepoStats], List[List[RepoFile]]]:
+        """ get_stats and find_files of the same repos in a single request, split as
+        get_stats_partial does if it fails """
+        results = {}
+        files = []
+        for batch, response_dict in self._query_in_parts(
+                repos, lambda batch: self._stats_and_files_request(batch, file_names)):
+            stats, batch_files = self._stats_and_files_from_response(response_dict, batch, file_names)
+            results.update(stats)
+            files.extend(batch_files)
+        return results, files
+
+    def _stats_and_files_request(self, repos: List[RepoName], file_names) -> Dict:
+        body = '    ...RepoFragment\n' + self._files_selection(file_names)
+        query = self.query_template.replace("$REPOS", self._repos_selection(repos, body))
+        return self._graphql_request(query)
+
+    def _find_files_request(self, repos: List[RepoName], file_names) -> Dict:
+        body = self._files_selection(file_names)
+        return self._graphql_request(
+            '{\n  rateLimit {\n    cost\n    remaining\n    resetAt\n  }\n' +
+            self._repos_selection(repos, body) + '}\n')
+
+    def _graphql_response(self, response: Response) -> Dict:
+        """ The parsed response of a GraphQL query. Its rateLimit is read, and its cost
+        charged, once per response here """
+        self._ensure_success(response)
 
         response_dict = response.json()
-        result_dict = response_dict["data"]
+        ensure_data(response_dict)
+        self._read_query_rate_limit(response_dict)
+        return response_dict
+
+    def _read_query_rate_limit(self, response_dict: Dict):
+        rate_limit = (response_dict.get("data") or {}).get("rateLimit")
+
+        if rate_limit is not None:
+            self.last_query_cost = rate_limit.get("cost")
+            self.graphql_remaining = rate_limit.get("remaining")
+            self.graphql_reset_at = rate_limit.get("resetAt")
+
+            # The query was paced as a single point
+            if self.rate_limiter is not None and self.last_query_cost is not None:
+                self.rate_limiter.charge(self.get_token(), 'graphql', self.last_query_cost - 1)
+
+    @staticmethod
+    def _files_selection(file_names) -> str:
+        paths = [name for name in file_names if not is_file_pattern(name)]
+
+        body = ''.join([
+            f'    path_{index}: object(expression: {json.dumps("HEAD:" + path)}) {{\n'
+            f'      __typename\n'
+            f'    }}\n'
+            for index, path in enumerate(paths)
+        ])
+
+        if len(paths) < len(file_names):
+            body += '    root: object(expression: "HEAD:") {\n' \
+                    '      ... on Tree {\n' \
+                    '        entries {\n' \
+                    '          name\n' \
+                    '          path\n' \
+                    '        }\n' \
+                    '      }\n' \
+                    '    }\n'
+
+        return body
+
+    @staticmethod
+    def _stats_and_files_from_response(response_dict: Dict, repos: List[RepoName], file_names) -> Tuple[Dict[str, RepoStats], List[List[RepoFile]]]:
+        stats, errors = GithubWrapper._stats_from_response(response_dict, repos)
+        return stats, GithubWrapper._files_from_response(response_dict, repos, file_names)
+
+    @staticmethod
+    def _files_from_response(response_dict: Dict, repos: List[RepoName], file_names) -> List[List[RepoFile]]:
+        paths = [name for name in file_names if not is_file_pattern(name)]
+        patterns = [name for name in file_names if is_file_pattern(name)]
+        results = []
+
+        # Repos that can't be found are null, and have no files
+        for repo_results, error in GithubWrapper._repos_results(response_dict, repos):
+            files = []
+
+            if repo_results is not None:
+                for index, path in enumerate(paths):
+                    if repo_results.get(f"path_{index}") is not None:
+                        files.append(RepoFile(name=path.split('/')[-1], path=path))
+
+                # Only selected when there are patterns
+                root = repo_results.get('root')
+                for entry in find_property(root, ['entries']) or []:
+                    if any(fnmatch.fnmatch(entry['name'], pattern) for pattern in patterns):
+                        files.append(RepoFile(name=entry['name'], path=entry['path']))
+
+            results.append(files)
+
+        return results
+
+    def _parse_stats(self, response: Response, repos: List[RepoName]) -> Dict[str, RepoStats]:
+        stats, errors = self._stats_from_response(self._graphql_response(response), repos)
+        return stats
+
+    @staticmethod
+    def _stats_from_response(response_dict: Dict, repos: List[RepoName]) -> Tuple[Dict[str, RepoStats], Dict[str, str]]:
         results = {}
+        errors = {}
 
         paths = {
             'owner': ['owner', 'login'],
@@ -296,13 +779,13 @@ class GithubWrapper:
             'commits': ['defaultBranchRef', 'target', 'history', 'totalCount']
         }
 
-        for repo_name in repos:
-            repo_results = result_dict[f"repo_{repo_name.uuid.hex}"]
-            name = repo_results["name"]
-            owner = find_property(repo_results, paths['owner'])
+        for repo_name, (repo_results, error) in zip(repos, GithubWrapper._repos_results(response_dict, repos)):
+            if repo_results is None:
+                errors[str(repo_name)] = error or "Repository not found"
+                continue
 
-            assert repo_name.name == name
-            assert repo_name.owner == owner
+            # A different name or owner means the repo was renamed or transferred, and
+            # GitHub followed it (or its node_id was used). It's still the right repo
 
             lang_id = find_property(repo_results, paths['lang_id'])
             lang_name = find_property(repo_results, paths['lang_name'])
@@ -315,7 +798,7 @@ class GithubWrapper:
                 primary_language_id=lang_id
             )
 
-        return results
+        return results, errors
 
 
 class RepoEnumerator:
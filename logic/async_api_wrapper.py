@@ -0,0 +1,127 @@
+"""
+asyncio variant of GithubWrapper, so many GitHub requests can be in flight at once.
+
+Requires httpx: pip install httpx (pip install httpx[http2] to use http2=True)
+
+Requests go through a single httpx.AsyncClient, which keeps connections to GitHub alive
+and reuses them, and at most max_concurrency of them are running at the same time.
+Requests are built, paced and parsed by the same helpers GithubWrapper uses.
+
+The client is bound to the event loop it's first used in, so all calls to a wrapper
+have to run in the same loop (see GithubProcessor, which keeps one for this).
+"""
+import asyncio
+from typing import Callable, Dict, List, Optional, Tuple
+
+import httpx
+
+from api_wrapper import GithubWrapper, RateLimit, RepoException, RepoFile, RepoName, RepoSearchPage, RepoStats, \
+    TransientException
+
+
+class AsyncGithubWrapper:
+    def __init__(self,
+                 auth_tokens: List[str],
+                 max_concurrency: int = 10,
+                 http2: bool = False,
+                 timeout: float = 30,
+                 scheduler=None,
+                 rate_limiter=None,
+                 **urls):
+        self.wrapper = GithubWrapper(auth_tokens, scheduler=scheduler, rate_limiter=rate_limiter, **urls)
+        self.max_concurrency = max_concurrency
+        self.client = httpx.AsyncClient(
+            http2=http2,
+            timeout=timeout,
+            limits=httpx.Limits(max_connections=max_concurrency,
+                                max_keepalive_connections=max_concurrency))
+        self._semaphore = None
+
+    async def _request(self, method: str, request: Dict) -> httpx.Response:
+        # Created on first use, inside the event loop
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+
+        delay = self.wrapper._pace(request)
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+        async with self._semaphore:
+            try:
+                response = await self.client.request(method, **request)
+            except httpx.TransportError as e:
+                raise TransientException(str(e)) from e
+
+        self.wrapper._record_rate_limit(request, response)
+        return response
+
+    async def close(self):
+        await self.client.aclose()
+
+    async def get_rate_limit(self, token: str) -> RateLimit:
+        response = await self._request('GET', GithubWrapper._rate_limit_request(token))
+        return GithubWrapper._parse_rate_limit(response, token)
+
+    async def get_files(self, repo_name: RepoName, file_names) -> List[RepoFile]:
+        response = await self._request('GET', self.wrapper._files_request(repo_name, file_names))
+        return self.wrapper._parse_files(response)
+
+    async def _get_files_or_none(self, repo_name: RepoName, file_names) -> Optional[List[RepoFile]]:
+        try:
+            return await self.get_files(repo_name, file_names)
+        except RepoException:
+            return None
+
+    async def get_files_of_repos(self, repo_names: List[RepoName], file_names) -> List[Optional[List[RepoFile]]]:
+        """ get_files of all the repos concurrently, in the same order. None for the repos
+        that can't be read """
+        return await asyncio.gather(*[
+            self._get_files_or_none(repo_name, file_names)
+            for repo_name in repo_names
+        ])
+
+    async def _query_in_parts(self, repos: List[RepoName], request: Callable[[List[RepoName]], Dict]) -> List[Tuple[List[RepoName], Dict]]:
+        """ GithubWrapper._query_in_parts, with the halves of a failed batch sent concurrently """
+        try:
+            response = await self._request('POST', request(repos))
+            return [(repos, self.wrapper._graphql_response(response))]
+        except TransientException:
+            if len(repos) < 2:
+                raise
+
+        self.wrapper.last_query_splits += 1
+        middle = len(repos) // 2
+        halves = await asyncio.gather(self._query_in_parts(repos[:middle], request),
+                                      self._query_in_parts(repos[middle:], request))
+        return halves[0] + halves[1]
+
+    async def find_files(self, repos: List[RepoName], file_names) -> List[List[RepoFile]]:
+        self.wrapper.last_query_splits = 0
+        files = []
+        for batch, response_dict in await self._query_in_parts(
+                repos, lambda batch: self.wrapper._find_files_request(batch, file_names)):
+            files.extend(GithubWrapper._files_from_response(response_dict, batch, file_names))
+        return files
+
+    async def get_stats_and_files(self, repos: List[RepoName], file_names) -> Tuple[Dict[str, RepoStats], List[List[RepoFile]]]:
+        self.wrapper.last_query_splits = 0
+        results = {}
+        files = []
+        for batch, response_dict in await self._query_in_parts(
+                repos, lambda batch: self.wrapper._stats_and_files_request(batch, file_names)):
+            stats, batch_files = GithubWrapper._stats_and_files_from_response(response_dict, batch, file_names)
+            results.update(stats)
+            files.extend(batch_files)
+        return results, files
+
+    async def search_repos(self, query: str, page: int = 1, per_page: int = 100, sort: str = 'stars') -> RepoSearchPage:
+        response = await self._request('GET', self.wrapper._search_repos_request(query, page, per_page, sort))
+        return self.wrapper._parse_search_repos(response)
+
+    async def get_repos(self, start_index: int = 0) -> List[RepoName]:
+        response = await self._request('GET', self.wrapper._repos_request(start_index))
+        return self.wrapper._parse_repos(response)
+
+    async def get_stats(self, repos: List[RepoName]) -> Dict[str, RepoStats]:
+        response = await self._request('POST', self.wrapper._stats_request(repos))
+        return self.wrapper._parse_stats(response, repos)
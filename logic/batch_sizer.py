@@ -0,0 +1,48 @@
+"""
+Size of the batches of repos queried in a single GraphQL request, adapted to how
+expensive the last queries were.
+
+Queries of repos with a long history are slow (history.totalCount) and can time out,
+while small repos can be queried in much larger batches. After each query the batch
+grows if it was cheap and fast, and shrinks if it was slow, costly or failed, always
+within [minimum, maximum].
+"""
+
+
+class AdaptiveBatchSizer:
+    def __init__(self,
+                 initial: int = 100,
+                 minimum: int = 10,
+                 maximum: int = 250,
+                 target_latency: float = 5.0,
+                 max_cost: int = 10,
+                 growth: float = 1.25,
+                 shrink: float = 0.5):
+        self.minimum = minimum
+        self.maximum = maximum
+        # Seconds a query should take, and rateLimit.cost points it should use at most
+        self.target_latency = target_latency
+        self.max_cost = max_cost
+        self.growth = growth
+        self.shrink = shrink
+        self.size = self._bounded(initial)
+
+    def _bounded(self, size: float) -> int:
+        return max(self.minimum, min(self.maximum, int(size)))
+
+    def record(self, batch_size: int, cost: int, latency: float) -> int:
+        """ Adapts the size after a query of batch_size repos that used cost points
+        and took latency seconds. Returns the new size """
+        if latency > self.target_latency or (cost is not None and cost > self.max_cost):
+            self.size = self._bounded(batch_size * self.shrink)
+        elif latency < self.target_latency / 2 and (cost is None or cost <= self.max_cost / 2):
+            # Only grow from batches that were actually full
+            if batch_size >= self.size:
+                self.size = self._bounded(max(self.size * self.growth, self.size + 1))
+
+        return self.size
+
+    def failed(self) -> int:
+        """ The last query failed (like a timeout or a 502), try smaller batches """
+        self.size = self._bounded(self.size * self.shrink)
+        return self.size
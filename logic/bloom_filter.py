@@ -0,0 +1,67 @@
+"""
+Bloom filter split in shards, so it can be kept in the state store of Pulsar Functions
+one shard per key, and only the shards that changed have to be written back.
+
+All the bits of an item live in the same shard, so checking or adding an item touches a
+single shard. Used by 'aggregate_functions.py' to remember which repos were already counted,
+with a memory footprint fixed by the expected number of items and the false positive rate
+(a false positive makes a new repo look as already counted).
+"""
+import hashlib
+import math
+import struct
+from typing import Optional
+
+_hashes = struct.Struct('<QQQ')
+
+
+class ShardedBloomFilter:
+    def __init__(self, expected_items: int, false_positive_rate: float, num_shards: int):
+        # Optimal number of bits and hash functions for the expected items and rate
+        total_bits = math.ceil(-expected_items * math.log(false_positive_rate) / math.log(2) ** 2)
+        self.num_shards = num_shards
+        self.shard_bits = max(8, math.ceil(total_bits / num_shards / 8) * 8)
+        self.num_hashes = max(1, round(total_bits / expected_items * math.log(2)))
+        self.shards = [None] * num_shards
+        self.dirty = set()
+
+    def shard_of(self, item: str) -> int:
+        return self._hash(item)[0] % self.num_shards
+
+    def is_loaded(self, shard: int) -> bool:
+        return self.shards[shard] is not None
+
+    def load_shard(self, shard: int, data: Optional[bytes]):
+        """ Sets the bits of a shard, as saved with shard_bytes(). None means an empty shard """
+        if data is not None and len(data) == self.shard_bits // 8:
+            self.shards[shard] = bytearray(data)
+        else:
+            self.shards[shard] = bytearray(self.shard_bits // 8)
+
+    def merge_shard(self, shard: int, data: Optional[bytes]):
+        """ Adds the bits of a saved copy of a shard, which might have been updated elsewhere """
+        if data is not None and len(data) == self.shard_bits // 8:
+            merged = int.from_bytes(self.shards[shard], 'little') | int.from_bytes(data, 'little')
+            self.shards[shard] = bytearray(merged.to_bytes(len(data), 'little'))
+
+    def shard_bytes(self, shard: int) -> bytes:
+        return bytes(self.shards[shard])
+
+    def add(self, item: str) -> bool:
+        """ Adds an item to its (loaded) shard. Returns True if it wasn't there before """
+        shard_index, h1, h2 = self._hash(item)
+        shard = self.shards[shard_index % self.num_shards]
+        added = False
+        for i in range(self.num_hashes):
+            bit = (h1 + i * h2) % self.shard_bits
+            byte, mask = bit >> 3, 1 << (bit & 7)
+            if not shard[byte] & mask:
+                shard[byte] |= mask
+                added = True
+        if added:
+            self.dirty.add(shard_index % self.num_shards)
+        return added
+
+    @staticmethod
+    def _hash(item: str):
+        return _hashes.unpack(hashlib.blake2b(item.encode('utf-8'), digest_size=24).digest())
@@ -0,0 +1,96 @@
+"""
+Bounded ranking of the repos with most commits, kept up to date incrementally instead of
+re-sorting every repo ever processed.
+
+Used by PulsarConnection.process_results: the ranking is saved in a checkpoint together with
+the position reached in each partition of 'commit_repo_info', so the next partial results only
+need to read the messages published after it.
+"""
+import heapq
+import struct
+from typing import Dict, List
+
+import message_schema
+from message_schema import CommitRepoInfo
+
+CHECKPOINT_VERSION = 1
+
+_header = struct.Struct('<BII')  # version, number of positions, number of repos
+_length = struct.Struct('<I')
+
+
+class CommitRanking:
+    def __init__(self, size: int):
+        self.size = size
+        # Min-heap of (commits, repo_id, record), so the smallest of the top is at [0]
+        self._heap = []
+        # repo_id -> commits, for the repos currently in the ranking
+        self._repos = {}
+
+    def __len__(self):
+        return len(self._heap)
+
+    def min_commits(self) -> int:
+        """ Commits a repo needs to get into a full ranking """
+        return self._heap[0][0] if len(self._heap) >= self.size else 0
+
+    def add(self, record: CommitRepoInfo) -> bool:
+        """ Adds a repo if it makes it into the ranking. A repo seen again keeps its
+        highest number of commits. Returns True if the ranking changed """
+        commits = int(record.commits or 0)
+        record = record._replace(commits=commits)
+
+        if record.repo_id in self._repos:
+            if commits <= self._repos[record.repo_id]:
+                return False
+            self._heap = [entry for entry in self._heap if entry[1] != record.repo_id]
+            heapq.heapify(self._heap)
+        elif len(self._heap) >= self.size:
+            if commits <= self._heap[0][0]:
+                return False
+            _, removed_id, _ = heapq.heappop(self._heap)
+            del self._repos[removed_id]
+
+        heapq.heappush(self._heap, (commits, record.repo_id, record))
+        self._repos[record.repo_id] = commits
+        return True
+
+    def top(self) -> List[CommitRepoInfo]:
+        """ The ranking, from most to least commits """
+        return [record for _, _, record in sorted(self._heap, reverse=True)]
+
+    def to_checkpoint(self, positions: Dict[str, bytes]) -> bytes:
+        """ Serializes the ranking with the serialized message id reached in each
+        partition (topic name -> MessageId.serialize()) """
+        parts = [_header.pack(CHECKPOINT_VERSION, len(positions), len(self._heap))]
+        for topic, message_id in positions.items():
+            for value in (topic.encode('utf-8'), message_id):
+                parts.append(_length.pack(len(value)))
+                parts.append(value)
+        for record in self.top():
+            value = message_schema.encode(record)
+            parts.append(_length.pack(len(value)))
+            parts.append(value)
+        return b''.join(parts)
+
+    @staticmethod
+    def from_checkpoint(data: bytes, size: int):
+        """ Inverse of to_checkpoint. Returns the ranking and the positions """
+        version, num_positions, num_repos = _header.unpack_from(data)
+        if version != CHECKPOINT_VERSION:
+            raise ValueError(f"Unknown commit ranking checkpoint version {version}")
+
+        offset = _header.size
+        values = []
+        for i in range(2 * num_positions + num_repos):
+            length, = _length.unpack_from(data, offset)
+            offset += _length.size
+            values.append(data[offset:offset + length])
+            offset += length
+
+        positions = {values[i].decode('utf-8'): values[i + 1]
+                     for i in range(0, 2 * num_positions, 2)}
+        ranking = CommitRanking(size)
+        for value in values[2 * num_positions:]:
+            ranking.add(message_schema.decode(value, CommitRepoInfo))
+        return ranking, positions
@@ -1,12 +1,21 @@
+import asyncio
+import collections
+import concurrent.futures
+import fnmatch
+import math
 import random
+import threading
 import time
 from typing import Callable, Optional, List, Tuple
 
-from more_itertools import take
-
-from api_wrapper import GithubWrapper, RepoName, RateLimitException
+from api_wrapper import GithubWrapper, RepoName, RepoFile, RateLimit, RateLimitException, RepoException, \
+    TransientException, UnauthorizedException
+from batch_sizer import AdaptiveBatchSizer
+from rate_limiter import RateLimiter
+from token_scheduler import TokenScheduler
+from message_schema import BasicRepoInfo, CommitRepoInfo
 from pulsar_wrapper import PulsarConnection
-from github import Github, RateLimitExceededException
+from search_window import SearchWindow, SEARCH_RESULT_CAP
 
 
 class ProcessingFinishedException(Exception):
@@ -17,10 +26,77 @@ class GithubProcessor:
     def __init__(self,
                  pulsar: PulsarConnection,
                  no_token_sleep: int = 10,
-                 verbose: bool = False):
+                 verbose: bool = False,
+                 async_requests: bool = False,
+                 max_concurrency: int = 10,
+                 http2: bool = False,
+                 file_detection: str = 'graphql',
+                 graphql_batch_size: int = 50,
+                 fused_enrichment: bool = False,
+                 min_batch_size: int = 10,
+                 max_batch_size: int = 250,
+                 token_leases=None,
+                 leases_per_worker: int = 1,
+                 pace_requests: bool = True,
+                 transient_retries: int = 3,
+                 max_backoff: float = 30):
         self.pulsar = pulsar
         self.no_token_sleep = no_token_sleep
         self.verbose = verbose
+        # With async_requests, the tests and CI of a batch of max_concurrency
+        # repos are checked concurrently, through AsyncGithubWrapper
+        self.async_requests = async_requests
+        self.max_concurrency = max_concurrency
+        self.http2 = http2
+        # How tests and CI files are found: 'graphql' looks them up for graphql_batch_size
+        # repos in one request (GithubWrapper.find_files), 'search' uses a code search per repo
+        self.file_detection = file_detection
+        if file_detection == 'graphql':
+            self.query_batch_size = graphql_batch_size
+        else:
+            self.query_batch_size = max_concurrency if async_requests else 1
+        # With fused_enrichment, commits, tests and CI of a batch of repos are found
+        # in a single GraphQL query by enrich_repos, instead of in three stages
+        self.fused_enrichment = fused_enrichment
+        self.graphql_batch_size = graphql_batch_size
+        # Repos per get_stats query (and per fused query), adapted to the cost and latency
+        # of the previous ones
+        self.commit_batch_sizer = AdaptiveBatchSizer(
+            initial=100, minimum=min_batch_size, maximum=max_batch_size)
+        self.enrich_batch_sizer = AdaptiveBatchSizer(
+            initial=graphql_batch_size, minimum=min(min_batch_size, graphql_batch_size),
+            maximum=max_batch_size)
+        # Hands out the token with most quota left for each kind of request
+        # With token_leases (token_leases.py), only the leases_per_worker tokens leased by
+        # this worker are used. Otherwise, all tokens in tokens.txt
+        self.token_leases = token_leases
+        self.leases_per_worker = leases_per_worker
+        self._leases = {}
+        # Tokens GitHub said are bad, never used again
+        self._bad_tokens = set()
+        self.token_scheduler = TokenScheduler(
+            pulsar.token_list if token_leases is None else [], exhausted_wait=no_token_sleep)
+        # Paces the requests of every token to just under GitHub's limits
+        self.rate_limiter = RateLimiter() if pace_requests else None
+        # Times a task is retried after a TransientException, backing off 1s, 2s, 4s.. up
+        # to max_backoff, before giving up on it
+        self.transient_retries = transient_retries
+        self.max_backoff = max_backoff
+        # Errors seen by class: 'rate_limited', 'unauthorized', 'transient', 'repo' and
+        # 'unexpected' (see api_wrapper.GithubException)
+        self.error_counts = collections.Counter()
+        # (token, resource) -> time before which checking the token is pointless,
+        # as it was exhausted for the resource until then
+        self._token_checked_until = {}
+        self._check_executor = None
+        # Stages can run in threads of their own (see worker_runtime.py). _lock guards the
+        # tokens, leases and counters they share, and each thread has its own wrappers
+        # and event loop (in _local)
+        self._lock = threading.RLock()
+        self._wrappers_lock = threading.Lock()
+        self._local = threading.local()
+        # (thread id, token) -> GithubWrapper
+        self._wrappers = {}
         self.repos_with_test_counter = 0
         self.ci_override_chance = 0.15
         self.random = random.Random()
@@ -43,86 +119,228 @@ class GithubProcessor:
 
         print(message)
 
-    def _get_token(self):
+    def _get_token(self, resource: str = 'core'):
         while True:
-            # Attempt to get a
-            token = self.pulsar.get_free_token()
+            if self.token_leases is not None:
+                with self._lock:
+                    self._renew_leases(resource)
+
+            # Attempt to get the token with most quota left for the resource
+            token = self.token_scheduler.pick(resource)
 
             if token is not None:
                 return token
 
-            # Check all standby tokens to see if they have
-            # still exceeded the rate limit
-            self._log("Checking tokens")
-            if not self._check_tokens():
-                # All seen standby tokens still exceed rate limit,
-                # Sleep and retry again later
-                if self.no_token_sleep > 0:
-                    self._log("Sleeping until next token check")
-                    time.sleep(self.no_token_sleep)
+            with self._lock:
+                # Exchange the leased tokens for others with quota left
+                if self.token_leases is not None and self._swap_leases(resource):
+                    continue
+
+                # All tokens seem exhausted. Check their actual quota
+                # (asking for it doesn't count against it)
+                self._log("Checking tokens")
+                available = self._check_tokens(resource)
+
+            if not available:
+                # Still exhausted, sleep until the first one resets
+                wait = self.token_scheduler.seconds_until_reset(resource) + 1
+                self._log(f"Sleeping {wait:.0f}s until next token reset")
+                time.sleep(wait)
+
+    def _add_lease(self, lease):
+        self._leases[lease.token] = lease
+        for name, (remaining, reset) in lease.quota.items():
+            self.token_scheduler.update(lease.token, name, remaining, reset)
+        self.token_scheduler.add_token(lease.token)
+
+    def _release_lease(self, token: str):
+        lease = self._leases.pop(token)
+        self.token_scheduler.remove_token(token)
+        self.token_leases.release(lease, self.token_scheduler.known_quota(token))
+
+    def _renew_leases(self, resource: str):
+        # Renew leases halfway through, saving the quota of their token, and forget the
+        # ones that expired
+        for token, lease in list(self._leases.items()):
+            if lease.expires - time.time() < self.token_leases.lease_seconds / 2 and \
+                    not self.token_leases.renew(lease, self.token_scheduler.known_quota(token)):
+                self._log(f"{__name__}: lease of a token expired")
+                self._leases.pop(token)
+                self.token_scheduler.remove_token(token)
+
+        while len(self._leases) < self.leases_per_worker:
+            lease = self.token_leases.acquire(resource, exclude=set(self._leases) | self._bad_tokens)
+
+            if lease is None:
+                break
+
+            self._add_lease(lease)
+
+    def _swap_leases(self, resource: str) -> bool:
+        """ Releases the leased tokens exhausted for resource, with their quota, and leases
+        other ones instead. Returns True if a token with quota left could be leased """
+        exhausted = [
+            token for token in self._leases
+            if self.token_scheduler.known_quota(token).get(resource, (self.token_scheduler.min_remaining, 0))[0]
+            < self.token_scheduler.min_remaining
+        ]
+
+        lease = self.token_leases.acquire(resource, exclude=set(self._leases) | self._bad_tokens)
+
+        if lease is None:
+            return False
+
+        self._add_lease(lease)
+
+        for token in exhausted[:max(0, len(self._leases) - self.leases_per_worker)]:
+            self._release_lease(token)
+
+        self._log(f"{__name__}: leased another token")
+        return True
+
+    def _drop_token(self, token: str):
+        with self._lock:
+            self._bad_tokens.add(token)
+            self.token_scheduler.remove_token(token)
+
+            if token in self._leases:
+                self.token_leases.release(self._leases.pop(token))
 
     @staticmethod
-    def _get_all_tokens(retriever):
-        tokens = []
+    def _publish(put: Callable[..., Optional[bool]], *args, **kwargs) -> None:
+        """ Publishes with put, one of the PulsarConnection put_* methods. If it fails, raises
+        a TransientException, so run_with_token redelivers what the task took instead of
+        acknowledging it without its results """
+        if put(*args, **kwargs) is not True:
+            raise TransientException(f"Could not publish with {put.__name__}")
 
-        while True:
-            token = retriever()
+    def _count_error(self, name: str, count: int = 1):
+        with self._lock:
+            self.error_counts[name] += count
+
+    def _check_token(self, token: str) -> RateLimit:
+        limit = GithubWrapper.get_rate_limit(token, session=self._get_wrapped_api(token).session)
 
-            if token is None:
-                return tokens
+        for name, (remaining, reset) in limit.resets.items():
+            self.token_scheduler.update(token, name, remaining, reset)
 
-            tokens.append(token)
+        return limit
 
-    def _check_tokens(self):
+    def _check_tokens(self, resource: str = 'core'):
         self._log(f"{__name__}: attempting to check tokens")
-        # Keep track of removed tokens in case of exception
-        # in order to be able to re-add them as standby
-        tokens = GithubProcessor._get_all_tokens(self.pulsar.get_standby_token)
-        result = False
-        fails = 0
-        successes = 0
+        now = time.time()
+        tokens = [
+            token for token in self.token_scheduler.tokens
+            if self._token_checked_until.get((token, resource), 0) <= now
+        ]
 
-        try:
-            # Duplicate list to allow for removing elements
-            # while iterating properly
-            for token in list(tokens):
-                limit = GithubWrapper.get_rate_limit(token)
-
-                if limit.is_exceeded():
-                    # Rate limit is exceeded, put it back in standby
-                    self.pulsar.put_standby_token(token)
-                    fails += 1
-                else:
-                    # No rate limit is exceeded, put token in free
-                    self.pulsar.put_free_token(token)
-                    successes += 1
-                    tokens.remove(token)
-                    result = True
-
-            self._log(f"{__name__}: token check status: {fails} out of {fails + successes} tokens still expired.")
-
-            return result
-        except:
-            self._log(f"{__name__}: exception when checking tokens")
-            # Re-add tokens still in list in case of exception
-            for token in tokens:
-                self.pulsar.put_standby_token(token)
-            raise
+        if len(tokens) < 1:
+            self._log(f"{__name__}: all tokens were already checked and are still expired.")
+            return False
 
-    def _create_pyapi(self, token):
-        return Github(token, per_page=100)
+        if self._check_executor is None:
+            self._check_executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=max(1, min(len(self.token_scheduler.tokens), self.max_concurrency)))
+
+        # All tokens are checked at the same time
+        checks = {token: self._check_executor.submit(self._check_token, token) for token in tokens}
+        fails = 0
+
+        for token, check in checks.items():
+            try:
+                limit = check.result()
+            except UnauthorizedException:
+                self._count_error('unauthorized')
+                self._drop_token(token)
+                fails += 1
+                continue
+            except Exception as e:
+                self._log(f"{__name__}: exception when checking token: {e}")
+                self._token_checked_until[(token, resource)] = now + self.no_token_sleep
+                fails += 1
+                continue
+
+            remaining, reset = limit.resets.get(resource, (0, now + self.no_token_sleep))
+
+            if remaining < self.token_scheduler.min_remaining:
+                # Not worth checking again before it resets
+                self._token_checked_until[(token, resource)] = reset
+                fails += 1
+            else:
+                self._token_checked_until.pop((token, resource), None)
+
+        self._log(f"{__name__}: token check status: {fails} out of {len(tokens)} tokens still expired.")
+
+        return fails < len(tokens)
 
     def _create_wrapped_api(self, token):
-        return GithubWrapper([token])
+        return GithubWrapper([token], scheduler=self.token_scheduler, rate_limiter=self.rate_limiter)
+
+    def _get_wrapped_api(self, token):
+        # Kept per token, so their connections are reused. And per thread, as their
+        # last_query_* attributes describe the last request made with them
+        key = (threading.get_ident(), token)
+
+        with self._wrappers_lock:
+            if key not in self._wrappers:
+                self._wrappers[key] = self._create_wrapped_api(token)
+
+            return self._wrappers[key]
+
+    def connection_stats(self):
+        stats = {'requests': 0, 'new_connections': 0, 'reused_connections': 0, 'request_time': 0.0}
+
+        with self._wrappers_lock:
+            wrappers = list(self._wrappers.values())
+
+        for wrapper in wrappers:
+            for name, value in wrapper.connection_stats().items():
+                stats[name] += value
+
+        if self.rate_limiter is not None:
+            stats['paced_time'] = self.rate_limiter.waited
+            stats['rate_limit_penalties'] = self.rate_limiter.penalties
+
+        return stats
+
+    def _event_loop(self):
+        # An event loop can only run in one thread at a time, so each thread has its own,
+        # together with the async wrappers bound to it
+        if getattr(self._local, 'loop', None) is None:
+            self._local.loop = asyncio.new_event_loop()
+            self._local.async_wrappers = {}
+
+        return self._local.loop
+
+    def _run_async(self, coroutine):
+        return self._event_loop().run_until_complete(coroutine)
+
+    def _get_async_wrapped_api(self, token):
+        # Kept per token, so their connections are reused. The client of a wrapper is
+        # bound to the loop of the thread that created it (see _event_loop)
+        self._event_loop()
+        async_wrappers = self._local.async_wrappers
+
+        if token not in async_wrappers:
+            # httpx is only needed when async_requests is set
+            from async_api_wrapper import AsyncGithubWrapper
+            async_wrappers[token] = AsyncGithubWrapper(
+                [token],
+                max_concurrency=self.max_concurrency,
+                http2=self.http2,
+                scheduler=self.token_scheduler,
+                rate_limiter=self.rate_limiter)
+
+        return async_wrappers[token]
 
     def process_results(self):
         self.pulsar.process_results()
         raise ProcessingFinishedException
 
     def read_repos(self):
-        return self.run_with_token(self._read_repos)
+        return self.run_with_token(self._read_repos, resource='search')
 
-    def _read_repos(self, token: str, count: int = 1000) -> bool:
+    def _read_repos(self, token: str) -> bool:
         self._log(f"{__name__}: attempting to read repos")
         day = self.pulsar.get_day_to_process()
 
@@ -130,49 +348,94 @@ class GithubProcessor:
             self._log(f"{__name__}: received no day to read repos from.")
             return False
 
-        repos = list(take(count, self \
-                          ._create_pyapi(token) \
-                          .search_repositories(query=f'created:{day} sort:stars')))
+        # A day split into windows is processed once they're all read (see window_read)
+        if self._read_window(token, SearchWindow.from_day(day)):
+            self.pulsar.day_read(day)
+        return True
+
+    def read_window(self):
+        return self.run_with_token(self._read_window_to_process, resource='search')
+
+    def _read_window_to_process(self, token: str) -> bool:
+        self._log(f"{__name__}: attempting to read repos of a window")
+        window = self.pulsar.get_window_to_process()
+
+        if window is None:
+            self._log(f"{__name__}: received no window to read repos from.")
+            return False
+
+        window = SearchWindow.parse(window)
+        if self._read_window(token, window):
+            self._publish(self.pulsar.window_read, window)
+        return True
 
-        basic_repo_info = list(map(
-            lambda repo: (
-                repo.id,
-                repo.owner.login,
-                repo.name,
-                repo.language
-            ),
-            repos
-        ))
+    def _read_window(self, token: str, window: SearchWindow, per_page: int = 100) -> bool:
+        """ Publishes the repos of window, or its halves to 'window_to_process' if it has too
+        many. Returns whether its repos were read, False if it was split """
+        wrapper = self._get_wrapped_api(token)
+        query = f'created:{window}'
+
+        # The first page also tells how many repos the window has
+        first_page = wrapper.search_repos(query, page=1, per_page=per_page)
+
+        if first_page.total_count > SEARCH_RESULT_CAP:
+            halves = window.split()
+
+            if halves is not None:
+                self._log(f"{__name__}: {first_page.total_count} repos in {window}, splitting it")
+                self._publish(self.pulsar.put_windows_to_process, [str(half) for half in halves])
+                return False
+
+            self._log(f"{__name__}: {first_page.total_count} repos in {window}, "
+                      f"only {SEARCH_RESULT_CAP} can be read")
+
+        repos = list(first_page.repos)
+        num_pages = math.ceil(min(first_page.total_count, SEARCH_RESULT_CAP) / per_page)
+
+        for page in range(2, num_pages + 1):
+            repos.extend(wrapper.search_repos(query, page=page, per_page=per_page).repos)
+
+        basic_repo_info = [BasicRepoInfo(*repo) for repo in repos]
 
         self._log(f"{__name__}: read {len(basic_repo_info)} repos")
-        self.pulsar.put_basic_repo_info(basic_repo_info)
+        self._publish(self.pulsar.put_basic_repo_info, basic_repo_info, test_check=not self.fused_enrichment)
         return True
 
     def analyze_repo_commits(self):
-        return self.run_with_token(self._analyze_repo_commits)
+        return self.run_with_token(self._analyze_repo_commits, resource='graphql')
 
     def _analyze_repo_commits(self, token: str) -> bool:
         self._log(f"{__name__}: attempting to analyze repo commits")
-        repos = self.pulsar.get_repos_for_commit_count(num_repos=100)
+        repos = self.pulsar.get_repos_for_commit_count(num_repos=self.commit_batch_sizer.size)
 
         if repos is None or len(repos) < 1:
             self._log(f"{__name__}: no repos to analyze commits for")
             return False
 
-        repo_names = list(map(
-            lambda repo_tuple: RepoName(
-                name=repo_tuple[2],
-                owner=repo_tuple[1],
-                repo_id=repo_tuple[0]
-            ),
-            repos
-        ))
+        repo_names = list(map(GithubProcessor._repo_name, repos))
 
-        wrapped_api = self._create_wrapped_api(token=token)
-        repos_with_stats = wrapped_api.get_stats(repo_names)
+        wrapped_api = self._get_wrapped_api(token=token)
+
+        try:
+            repos_with_stats, errors = wrapped_api.get_stats_partial(repo_names)
+        except Exception:
+            self.commit_batch_sizer.failed()
+            raise
+
+        if len(errors) > 0:
+            self._count_error('repo', len(errors))
+            self._log(f"{__name__}: could not read commits of {len(errors)} repos: {errors}")
+
+        if wrapped_api.last_query_splits > 0:
+            batch_size = self.commit_batch_sizer.failed()
+        else:
+            batch_size = self.commit_batch_sizer.record(
+                len(repo_names), wrapped_api.last_query_cost, wrapped_api.last_request_time)
+        self._log(f"{__name__}: query cost {wrapped_api.last_query_cost} in "
+                  f"{wrapped_api.last_request_time:.2f}s, next batch {batch_size} repos")
 
         repos_with_commits = list(map(
-            lambda repo_with_stats: (
+            lambda repo_with_stats: CommitRepoInfo(
                 repo_with_stats.name.id,
                 repo_with_stats.commits,
                 repo_with_stats.name.owner,
@@ -182,11 +445,83 @@ class GithubProcessor:
         ))
 
         self._log(f"{__name__}: read commits for {len(repos_with_commits)} repos")
-        self.pulsar.put_commit_repo_info(repos_with_commits)
+        self._publish(self.pulsar.put_commit_repo_info, repos_with_commits)
         return True
 
+    def enrich_repos(self) -> bool:
+        return self.run_with_token(self._enrich_repos, resource='graphql')
+
+    def _enrich_repos(self, token: str) -> bool:
+        self._log(f"{__name__}: attempting to enrich repos")
+        repos = self.pulsar.get_repos_for_commit_count(num_repos=self.enrich_batch_sizer.size)
+
+        if repos is None or len(repos) < 1:
+            self._log(f"{__name__}: no repos to enrich")
+            return False
+
+        repo_names = list(map(GithubProcessor._repo_name, repos))
+
+        start = time.perf_counter()
+
+        try:
+            if self.async_requests:
+                wrapped_api = self._get_async_wrapped_api(token).wrapper
+                repos_with_stats, repo_files = self._run_async(
+                    self._get_async_wrapped_api(token).get_stats_and_files(
+                        repo_names, self.test_files + self.ci_files))
+            else:
+                wrapped_api = self._get_wrapped_api(token)
+                repos_with_stats, repo_files = wrapped_api.get_stats_and_files(
+                    repo_names, self.test_files + self.ci_files)
+        except Exception:
+            self.enrich_batch_sizer.failed()
+            raise
+
+        if wrapped_api.last_query_splits > 0:
+            self.enrich_batch_sizer.failed()
+        else:
+            self.enrich_batch_sizer.record(
+                len(repo_names), wrapped_api.last_query_cost, time.perf_counter() - start)
+
+        repos_with_commits = []
+        repos_with_tests = []
+        repos_with_ci = []
+
+        for repo, repo_name, files in zip(repos, repo_names, repo_files):
+            # The language stays the one of the search, which the repos were counted with
+            stats = repos_with_stats.get(str(repo_name))
+
+            # Deleted or private since it was found
+            if stats is None:
+                continue
+
+            repos_with_commits.append(CommitRepoInfo(repo.repo_id, stats.commits, repo.owner, repo.name))
+
+            # As in the staged pipeline, CI is only counted for repos with tests
+            if any(GithubProcessor._matches(file, self.test_files) for file in files):
+                repos_with_tests.append(repo)
+
+                if any(GithubProcessor._matches(file, self.ci_files) for file in files):
+                    repos_with_ci.append(repo)
+
+        self._log(f"{__name__}: enriched {len(repos)} repos, {len(repos_with_tests)} with tests, "
+                  f"{len(repos_with_ci)} with ci")
+        self._publish(self.pulsar.put_commit_repo_info, repos_with_commits)
+
+        if len(repos_with_tests) > 0:
+            self._publish(self.pulsar.put_repo_with_tests, repos_with_tests)
+
+        if len(repos_with_ci) > 0:
+            self._publish(self.pulsar.put_repo_with_ci, repos_with_ci)
+
+        return True
+
+    @staticmethod
+    def _matches(file: RepoFile, file_names: List[str]) -> bool:
+        return any(file.path == name or fnmatch.fnmatch(file.name, name) for name in file_names)
+
     def analyze_repo_ci(self) -> bool:
-        return self.run_with_token(self._analyze_repo_ci)
+        return self.run_with_token(self._analyze_repo_ci, resource=self._file_resource())
 
     def _analyze_repo_ci(self, token: str) -> bool:
         if self.repos_with_test_counter < 1 and self.random.random() > self.ci_override_chance:
@@ -198,22 +533,23 @@ class GithubProcessor:
             token=token,
             retriever=self.pulsar.get_repo_with_tests,
             query_files=self.ci_files,
-            output=self.pulsar.put_repo_with_ci
+            output=lambda repos: self._publish(self.pulsar.put_repo_with_ci, repos)
         )
 
         if status > 0:
             self._log(f"{__name__}: analyzed ci for at least one repo")
-            self.repos_with_test_counter -= status
-
-            if self.repos_with_test_counter < 1:
-                self.repos_with_test_counter = 0
+            with self._lock:
+                self.repos_with_test_counter = max(0, self.repos_with_test_counter - status)
         else:
             self._log(f"{__name__}: no repos to analyze ci for")
 
         return status > 0
 
     def analyze_repo_tests(self) -> bool:
-        return self.run_with_token(self._analyze_repo_tests)
+        return self.run_with_token(self._analyze_repo_tests, resource=self._file_resource())
+
+    def _file_resource(self) -> str:
+        return 'graphql' if self.file_detection == 'graphql' else 'code_search'
 
     def _analyze_repo_tests(self, token: str) -> bool:
         self._log(f"{__name__}: attempting to analyze repo tests")
@@ -221,12 +557,13 @@ class GithubProcessor:
             token=token,
             retriever=self.pulsar.get_repos_for_test_check,
             query_files=self.test_files,
-            output=self.pulsar.put_repo_with_tests
+            output=lambda repos: self._publish(self.pulsar.put_repo_with_tests, repos)
         )
 
         if status > 0:
             self._log(f"{__name__}: analyzed tests for at least one repo")
-            self.repos_with_test_counter += status
+            with self._lock:
+                self.repos_with_test_counter += status
         else:
             self._log(f"{__name__}: no repos to analyze tests for")
 
@@ -237,12 +574,21 @@ class GithubProcessor:
                             retriever: Callable[[int], List],
                             query_files: List[str],
                             output: Callable[[List], None],
-                            batch_size: int = 1) -> int:
-        repos = retriever(batch_size)
+                            batch_size: Optional[int] = None) -> int:
+        repos = retriever(batch_size or self.query_batch_size)
 
         if repos is None or len(repos) < 1:
             return 0
 
+        if self.file_detection == 'graphql' or self.async_requests:
+            self._query_repos(
+                token=token,
+                repos=repos,
+                search_files=query_files,
+                consumer=output
+            )
+            return len(repos)
+
         for repo in repos:
             self._query_repo(
                 token=token,
@@ -253,36 +599,112 @@ class GithubProcessor:
 
         return len(repos)
 
+    @staticmethod
+    def _repo_name(repo: BasicRepoInfo) -> RepoName:
+        return RepoName(
+            owner=repo.owner,
+            name=repo.name,
+            repo_id=repo.repo_id,
+            node_id=repo.node_id)
+
     def _query_repo(self,
                     token: str,
-                    repo: (str, str, str, str),
+                    repo: BasicRepoInfo,
                     search_files: List[str],
                     consumer: Callable[[List], None]) -> None:
-        wrapper = self._create_wrapped_api(token)
+        wrapper = self._get_wrapped_api(token)
 
-        repo_id, owner, name, language = repo
-        repo_name = RepoName(
-            owner=owner,
-            name=name,
-            repo_id=repo_id)
+        repo_name = GithubProcessor._repo_name(repo)
 
-        files = wrapper.get_files(
-            repo_name=repo_name,
-            file_names=search_files
-        )
+        try:
+            files = wrapper.get_files(
+                repo_name=repo_name,
+                file_names=search_files
+            )
+        except RepoException as e:
+            self._count_error('repo')
+            self._log(f"{__name__}: skipping {repo_name}: {e}")
+            return
 
         if files is not None and len(files) > 0:
-            consumer([(repo_id, owner, name, language)])
+            consumer([repo])
+
+    def _query_repos(self,
+                     token: str,
+                     repos: List[BasicRepoInfo],
+                     search_files: List[str],
+                     consumer: Callable[[List], None]) -> None:
+        repo_names = list(map(GithubProcessor._repo_name, repos))
+
+        if self.file_detection != 'graphql':
+            repo_files = self._run_async(
+                self._get_async_wrapped_api(token).get_files_of_repos(repo_names, search_files))
+        elif self.async_requests:
+            repo_files = self._run_async(
+                self._get_async_wrapped_api(token).find_files(repo_names, search_files))
+        else:
+            repo_files = self._get_wrapped_api(token).find_files(repo_names, search_files)
+
+        found = [repo for repo, files in zip(repos, repo_files) if files is not None and len(files) > 0]
+
+        if len(found) > 0:
+            consumer(found)
 
-    def run_with_token(self, function: Callable[[str], bool]) -> bool:
-        result = False
-        token = self._get_token()
+    def run_with_token(self, function: Callable[[str], bool], resource: str = 'core') -> bool:
+        """ Runs function with a token for resource. What happens when it fails depends on
+        the error (see api_wrapper.GithubException): only rate limit and unauthorized errors
+        change the token. What function takes from the work topics is acknowledged once it's
+        done with it; when it's retried or given up, it's redelivered instead of lost """
+        token = self._get_token(resource)
+        retries = 0
 
         while True:
+            self.pulsar.begin_work()
+            done = False
             try:
                 result = function(token)
-                self.pulsar.put_free_token(token)
+                done = True
+                self._log(f"{__name__}: connection stats: {self.connection_stats()}, "
+                          f"errors: {dict(self.error_counts)}")
                 return result
-            except:
-                self.pulsar.put_standby_token(token)
-                token = self._get_token()
+            except RateLimitException as e:
+                # Leave the token alone until its quota resets
+                self._count_error('rate_limited')
+                self.token_scheduler.exhausted(token, e.resource or resource, e.reset)
+                token = self._get_token(resource)
+            except UnauthorizedException:
+                self._count_error('unauthorized')
+                self._log(f"{__name__}: dropping a bad token")
+                self._drop_token(token)
+                token = self._get_token(resource)
+            except TransientException as e:
+                # Nothing wrong with the token, try again with it after a while
+                self._count_error('transient')
+
+                if retries >= self.transient_retries:
+                    self._log(f"{__name__}: giving up after {retries} retries: {e}")
+                    return False
+
+                wait = min(self.max_backoff, 2 ** retries) * (0.5 + self.random.random())
+                retries += 1
+                self._log(f"{__name__}: transient error, retrying in {wait:.1f}s: {e}")
+                # Meanwhile, another worker can take what was taken
+                self.pulsar.end_work(False)
+                time.sleep(wait)
+            except RepoException as e:
+                # The repos taken for this run can't be read, they are skipped
+                done = True
+                self._count_error('repo')
+                self._log(f"{__name__}: skipping repos: {e}")
+                return True
+            except ProcessingFinishedException:
+                done = True
+                raise
+            except Exception as e:
+                # Likely a bug with what was taken for this run, which is skipped. The token is fine
+                done = True
+                self._count_error('unexpected')
+                print(f"\n*** Exception in {function.__name__}: {e!r} ***\n")
+                return True
+            finally:
+                self.pulsar.end_work(done)
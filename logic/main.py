@@ -1,10 +1,13 @@
 import json
 import os
+import time
 from typing import Callable, List
 
 from api_wrapper import GithubWrapper, RepoEnumerator
 from githubprocessor import GithubProcessor, ProcessingFinishedException
 from pulsar_wrapper import PulsarConnection
+from token_leases import PulsarTokenLeases
+from worker_runtime import Stage, WorkerRuntime
 
 
 def run_task(task: Callable[[], bool], run_once: bool):
@@ -18,10 +21,12 @@ def run_task(task: Callable[[], bool], run_once: bool):
     return ran_once
 
 
-def run_tasks_until_fail(tasks: List[Callable[[], bool]]):
+def run_tasks_until_fail(tasks: List[Callable[[], bool]]) -> bool:
     for task in tasks:
         if task():
-            return
+            return True
+
+    return False
 
 
 def run_main():
@@ -29,30 +34,129 @@ def run_main():
 
     pulsar_host = environment.get('pulsar_host')
     debug = environment.get('debug', 'false').lower() == 'true'
+    async_publishing = environment.get('async_publishing', 'true').lower() == 'true'
+    # 'Shared' or 'Key_Shared', see PulsarConnection
+    subscription_type = environment.get('subscription_type', 'Shared')
+    # Has to match how the topics were created by scripts/init-namespaces.sh
+    partitioned = environment.get('pulsar_partitioned', 'false').lower() == 'true'
+    # 'YYYY-MM-DD' days to process. In continuous mode end_date isn't used: new days keep
+    # being processed as they pass, and the worker never exits
+    start_date = environment.get('start_date', '2021-01-01')
+    end_date = environment.get('end_date', '2021-12-31')
+    continuous = environment.get('continuous', 'false').lower() == 'true'
+    idle_sleep = int(environment.get('idle_sleep', '60'))
+    # Check the tests and CI of max_concurrency repos at once (requires httpx)
+    async_requests = environment.get('async_requests', 'false').lower() == 'true'
+    max_concurrency = int(environment.get('max_concurrency', '10'))
+    http2 = environment.get('http2', 'false').lower() == 'true'
+    # 'graphql' (many repos per request) or 'search' (a code search per repo)
+    file_detection = environment.get('file_detection', 'graphql')
+    graphql_batch_size = int(environment.get('graphql_batch_size', '50'))
+    # Bounds of the repos per commit (or fused) GraphQL query, adapted to their cost
+    min_batch_size = int(environment.get('min_batch_size', '10'))
+    max_batch_size = int(environment.get('max_batch_size', '250'))
+    # 'pulsar' leases tokens so each one is only used by one worker at a time, 'none' has
+    # every worker use all tokens
+    token_leasing = environment.get('token_leasing', 'pulsar')
+    leases_per_worker = int(environment.get('leases_per_worker', '1'))
+    lease_seconds = int(environment.get('lease_seconds', '300'))
+    # Pace requests to just under GitHub's rate limits (rate_limiter.py)
+    pace_requests = environment.get('pace_requests', 'true').lower() == 'true'
+    # Find commits, tests and CI of a repo at once (GithubProcessor.enrich_repos)
+    fused_enrichment = environment.get('fused_enrichment', 'false').lower() == 'true'
+    # Run every stage in its own pool of threads (worker_runtime.py), of these sizes
+    threaded = environment.get('threaded', 'false').lower() == 'true'
+    read_threads = int(environment.get('read_threads', '1'))
+    commit_threads = int(environment.get('commit_threads', '2'))
+    test_threads = int(environment.get('test_threads', '2'))
+    ci_threads = int(environment.get('ci_threads', '1'))
+    stage_idle_sleep = float(environment.get('stage_idle_sleep', '5'))
+    # Messages each work topic consumer holds ahead of being asked for them
+    prefetch = int(environment.get('prefetch', '10'))
 
     pulsar = PulsarConnection(
-        ip_address=pulsar_host
+        ip_address=pulsar_host,
+        async_publishing=async_publishing,
+        subscription_type=subscription_type,
+        partitioned_topics=partitioned,
+        start_date=start_date,
+        end_date=end_date,
+        continuous=continuous,
+        # No batch can take more repos than this
+        max_receive=max(max_batch_size, graphql_batch_size),
+        prefetch=prefetch
     )
 
     processor = GithubProcessor(
         pulsar=pulsar,
-        verbose=debug
+        verbose=debug,
+        async_requests=async_requests,
+        max_concurrency=max_concurrency,
+        http2=http2,
+        file_detection=file_detection,
+        graphql_batch_size=graphql_batch_size,
+        fused_enrichment=fused_enrichment,
+        min_batch_size=min_batch_size,
+        max_batch_size=max_batch_size,
+        token_leases=PulsarTokenLeases(pulsar, lease_seconds=lease_seconds) if token_leasing == 'pulsar' else None,
+        leases_per_worker=leases_per_worker,
+        pace_requests=pace_requests
     )
 
     # Prioritize tasks as (from most prioritized to least):
     # 1. Try to analyze if a repo has ci or not
     # 2. Analyze if a repo has tests or not
     # 3. Find commit count for repos
-    # 4. Find repos
+    # 4. Find repos of the windows days were split into
+    # 5. Find repos
 
     tasks = [
         processor.analyze_repo_ci,
         processor.analyze_repo_tests,
         processor.analyze_repo_commits,
-        processor.read_repos,
-        processor.process_results
+        processor.read_window,
+        processor.read_repos
     ]
 
+    # The three analysis stages are done by one
+    if fused_enrichment:
+        tasks = [
+            processor.enrich_repos,
+            processor.read_window,
+            processor.read_repos
+        ]
+
+    # In continuous mode results are updated as days are caught up with,
+    # (see PulsarConnection.get_day_to_process) so there's no final processing
+    if not continuous:
+        tasks.append(processor.process_results)
+
+    if threaded:
+        # Each stage keeps consuming what the one before it publishes
+        stages = [
+            Stage('read_repos', lambda: processor.read_window() or processor.read_repos(), read_threads),
+            Stage('commits', processor.analyze_repo_commits, commit_threads),
+            Stage('tests', processor.analyze_repo_tests, test_threads),
+            Stage('ci', processor.analyze_repo_ci, ci_threads)
+        ]
+
+        if fused_enrichment:
+            stages = [stages[0], Stage('enrich', processor.enrich_repos, commit_threads)]
+
+        runtime = WorkerRuntime(
+            stages,
+            final=None if continuous else processor.process_results,
+            idle_sleep=stage_idle_sleep,
+            verbose=debug
+        )
+
+        try:
+            runtime.run()
+        except ProcessingFinishedException:
+            print("Results were produced. Processing has finished. Exiting.")
+
+        return
+
     try:
         while True:
             # run_once = False
@@ -63,7 +167,9 @@ def run_main():
             #     run_once = True
 
             # Iterate over all tasks in the specified order
-            run_tasks_until_fail(tasks)
+            if not run_tasks_until_fail(tasks) and continuous:
+                # Nothing to do until a new day passes
+                time.sleep(idle_sleep)
             # for task in tasks:
             #     if task():
             #         # If task completes successfully, break and restart iterating through tasks
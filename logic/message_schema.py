@@ -0,0 +1,130 @@
+"""
+Compact binary records exchanged through the Pulsar topics. Shared by 'pulsar_wrapper.py',
+'githubprocessor.py' and 'aggregate_functions.py', so a message is encoded and decoded
+the same way everywhere, without formatting tuples as text and eval'ing them back.
+
+Every message starts with a small header: the schema version, the record type, the integer
+fields of the record and the byte length of each text field. The utf-8 text fields follow
+right after it. A text field set to None is stored with length NONE_LENGTH.
+
+Messages published before this schema existed are text tuples such as
+"(123, 'owner', 'name', 'Python')". decode() still accepts them (safely, through
+ast.literal_eval) so topics retaining old messages keep working.
+
+Version 2 added node_id to BasicRepoInfo. Messages of version 1 decode with node_id None.
+Pulsar Functions have to be deployed with the new version (scripts/init-functions.sh) before
+workers start publishing it.
+
+A comparison against the old f-string + eval path is in 'schema_benchmark.py'
+"""
+import ast
+import struct
+from typing import NamedTuple, Optional
+
+SCHEMA_VERSION = 2
+NONE_LENGTH = 0xFFFF
+
+
+class BasicRepoInfo(NamedTuple):
+    """ repos_for_commit_count, repos_for_test_check and repo_with_tests topics """
+    repo_id: int
+    owner: str
+    name: str
+    language: Optional[str]
+    # GraphQL node id, since version 2
+    node_id: Optional[str] = None
+
+
+class CommitRepoInfo(NamedTuple):
+    """ commit_repo_info and *YYYY-MM-DD*_result_commit topics """
+    repo_id: int
+    commits: int
+    owner: str
+    name: str
+
+
+class RepoWithCi(NamedTuple):
+    """ repo_with_ci topic """
+    repo_id: int
+    language: Optional[str]
+
+
+class LanguageResult(NamedTuple):
+    """ language_results topic """
+    language: str
+    num_repos: int
+    num_tests: int
+    num_ci: int
+
+
+class _Layout:
+    """ How a record type is laid out in a message: which fields are integers,
+    which are text, and the header struct holding them """
+    def __init__(self, kind, record_type, field_types):
+        self.kind = kind
+        self.record_type = record_type
+        self.int_fields = [i for i, t in enumerate(field_types) if t == 'q']
+        self.str_fields = [i for i, t in enumerate(field_types) if t == 's']
+        self.header = struct.Struct(
+            '<BB' + 'q' * len(self.int_fields) + 'H' * len(self.str_fields))
+
+
+# (version, kind) -> layout. A new version gets new entries here, old ones stay
+# so messages already retained in the topics can still be decoded (fields added
+# later need a default in the record type).
+# _KINDS maps each record type to the layout of the current version
+_LAYOUTS = {}
+_KINDS = {}
+
+for _version, _kind, _record_type, _field_types in [
+        (1, 1, BasicRepoInfo, 'qsss'),
+        (1, 2, CommitRepoInfo, 'qqss'),
+        (1, 3, RepoWithCi, 'qs'),
+        (1, 4, LanguageResult, 'sqqq'),
+        # Version 2 adds node_id to BasicRepoInfo
+        (2, 1, BasicRepoInfo, 'qssss'),
+        (2, 2, CommitRepoInfo, 'qqss'),
+        (2, 3, RepoWithCi, 'qs'),
+        (2, 4, LanguageResult, 'sqqq')]:
+    _LAYOUTS[(_version, _kind)] = _Layout(_kind, _record_type, _field_types)
+    if _version == SCHEMA_VERSION:
+        _KINDS[_record_type] = _LAYOUTS[(_version, _kind)]
+
+
+def encode(record: tuple) -> bytes:
+    """ Encodes one of the records above in the current schema version """
+    layout = _KINDS[type(record)]
+    texts = [None if record[i] is None else str(record[i]).encode('utf-8')
+             for i in layout.str_fields]
+    header = layout.header.pack(
+        SCHEMA_VERSION, layout.kind,
+        *[int(record[i] or 0) for i in layout.int_fields],
+        *[NONE_LENGTH if text is None else len(text) for text in texts])
+    return header + b''.join(filter(None, texts))
+
+
+def decode(data, legacy_type=None):
+    """ Decodes a message into its record. Text tuples from before this schema are
+    returned as legacy_type if given, or as a plain tuple otherwise """
+    if isinstance(data, str):
+        data = data.encode('utf-8')
+    if data[:1] == b'(':
+        values = ast.literal_eval(data.decode('utf-8'))
+        return legacy_type(*values) if legacy_type is not None else values
+
+    layout = _LAYOUTS.get((data[0], data[1]))
+    if layout is None:
+        raise ValueError(f"Unknown message schema version {data[0]}, record type {data[1]}")
+
+    header = layout.header.unpack_from(data)
+    values = [None] * (len(layout.int_fields) + len(layout.str_fields))
+    for i, value in zip(layout.int_fields, header[2:]):
+        values[i] = value
+
+    offset = layout.header.size
+    for i, length in zip(layout.str_fields, header[2 + len(layout.int_fields):]):
+        if length == NONE_LENGTH:
+            continue
+        values[i] = data[offset:offset + length].decode('utf-8')
+        offset += length
+    return layout.record_type(*values)
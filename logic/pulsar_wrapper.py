@@ -1,10 +1,11 @@
 """
-Requires pulsar-client: pip install pulsar-client==2.10.0
-Requires sortedcontainers: pip install sortedcontainers
+Requires pulsar-client: pip install pulsar-client==3.1.0
+(older clients have no start_message_id_inclusive for readers, see get_token_quota)
 
 For this script to work, requires having a Pulsar Standalone receiving connections in port:6650
 If Pulsar server is not in localhost, instantiate the class with the IP its running on. For
 ex: my_pulsar = pulsar_wrapper.PulsarConnection(ip_address=192.168.##.##)
+The admin REST API (port:8080) is used to cheaply check if a work topic is empty
 
 Pulsar namespaces also have to be configured so topics behave as they are intended below.
 The following commands are needed for this, using pulsar-admin command line:
@@ -20,51 +21,90 @@ Instructions for the command line instruction to start it are in 'aggregate_func
 This script uses the following topics. They can be listed, examined or deleted using
 'bin/pulsar-admin topics' commands
 
-Topics in public/default namespace:
-persistent://public/default/repos_for_commit_count
-persistent://public/default/repos_for_test_check
-persistent://public/default/repo_with_tests
+Topics in public/default namespace (the ones marked with * can be partitioned, see
+PARTITIONED_TOPICS and 'scripts/init-namespaces.sh'):
+persistent://public/default/repos_for_commit_count *
+persistent://public/default/repos_for_test_check *
+persistent://public/default/repo_with_tests *
 persistent://public/default/day_to_process
+persistent://public/default/window_to_process : parts of a day with too many repos for a single
+search (see 'search_window.py')
 
 Topics in public/static namespace (retains messages):
 persistent://public/static/initialized
 persistent://public/static/days_processed
+persistent://public/static/windows_read_*YYYY-MM-DD* : windows of a day split into windows
+(see 'window_to_process') that were read. The day is processed once they cover all of it
 persistent://public/static/free_token
-persistent://public/static/commit_repo_info
+persistent://public/static/commit_repo_info *
 persistent://public/static/repo_with_ci
 
+persistent://public/static/token_lease_*hash of token* : a worker holding its Exclusive
+subscription has the lease of the token (see 'token_leases.py')
+persistent://public/static/token_quota_*hash of token* : quota the token had left when it
+was last released, as a JSON {resource: [remaining, reset]}
+
+persistent://public/static/commit_ranking_checkpoint : top repos by commits so far, and up to
+which message of 'commit_repo_info' they were computed (see 'commit_ranking.py')
+
 persistent://public/static/*YYYY-MM-DD*_result_commit
 persistent://public/static/aggregate_languages_info : signals Pulsar to compute results for this language
 persistent://public/static/languages : list of unique languages
+persistent://public/static/commit_leaderboard_request : signals Pulsar Functions to publish its
+commit leaderboard
+persistent://public/static/commit_leaderboard : snapshots of the leaderboard kept by Pulsar Functions
 persistent://public/static/language_results : posts aggregated information of each language in tuples
 of the form: ('language', num_repos, num_tests, num_ci)
 
+Repo and result tuples are published as the compact binary records defined in 'message_schema.py'
+
+Days from start_date to end_date are processed. In continuous mode there's no end_date: the
+days that have passed since the last ones enqueued are added to 'day_to_process' whenever it
+runs empty, and results are updated (incrementally) every time it catches up with them.
+
 """
 import requests
 import datetime
 import time
 import bisect
+import hashlib
+import itertools
+import json
+import os
+import socket
+import threading
 import pulsar
 from pulsar import PartitionsRoutingMode
+from pulsar import ConsumerType
+from pulsar import BatchingType
 from pulsar import MessageId
 import _pulsar
-import sortedcontainers
-
-class RepoCommits(object):
-    """ Data Type to support tuple in-place sorting using sortedcontainers """
-    def __init__(self, repo_tuple):
-        self.ident = repo_tuple[0]
-        self.commits = int(repo_tuple[1] or 0)
-        self.owner = repo_tuple[2]
-        self.repo_name = repo_tuple[3]
-        
-    def __repr__(self):
-        return f"({self.ident}, {self.commits}, '{self.owner}', '{self.repo_name}')"
+import message_schema
+from message_schema import BasicRepoInfo, CommitRepoInfo, RepoWithCi, LanguageResult
+from commit_ranking import CommitRanking
+from search_window import SearchWindow
+
+# Subscription types supported for the work topics. Exclusive isn't one of them:
+# consumers are long-lived, so it would lock every other worker out of the topic
+SUBSCRIPTION_TYPES = {
+    'Shared': ConsumerType.Shared,
+    'Key_Shared': ConsumerType.KeyShared,
+    'Failover': ConsumerType.Failover
+}
+
+# Work topics that can be created as partitioned topics by 'scripts/init-namespaces.sh'.
+# Their messages are keyed by repo_id, which decides the partition they go to
+PARTITIONED_TOPICS = ['repos_for_commit_count', 'repos_for_test_check',
+                      'repo_with_tests', 'commit_repo_info']
 
 class PulsarConnection:
 
-    def __init__(self, ip_address='localhost'):
+    def __init__(self, ip_address='localhost', async_publishing=True, max_in_flight=1000,
+                 admin_port=8080, subscription_type='Shared', partitioned_topics=False,
+                 start_date='2021-01-01', end_date='2021-12-31', continuous=False,
+                 max_receive=250, prefetch=10):
         self.client = pulsar.Client(f'pulsar://{ip_address}:6650')
+        self.admin_url = f'http://{ip_address}:{admin_port}/admin/v2'
         self.tenant = 'public'
         self.namespace = 'default'
         self.static_namespace = 'static'
@@ -73,23 +113,409 @@ class PulsarConnection:
         self.token_list = None
         self.current_token = 1
         self.last_day_processed = False
+        # 'YYYY-MM-DD' range of days to process. With continuous, end_date is ignored and
+        # days keep being added up to yesterday (the last complete day)
+        self.start_date = start_date
+        self.end_date = end_date
+        self.continuous = continuous
         self.days_to_review = 15 # Lapse of days to make an update on partial results
         self.top_repos_partial_results = 100 # Top commited repositories to publish in partial results
+        # Producers and consumers are kept open for the lifetime of the connection,
+        # keyed by topic (and subscription), and only re-created after a failure
+        self.client_name = f'{socket.gethostname()}_{os.getpid()}_{int(time.time())}'
+        self._producers = {}
+        self._consumers = {}
+        self._pool_lock = threading.Lock()
+        # token -> Exclusive consumer holding its lease. Also used by the lease reaper
+        # thread (see token_leases.py), so only with _token_locks_lock held
+        self._token_locks = {}
+        self._token_locks_lock = threading.Lock()
+        # Messages popped by each thread while it works on them (see begin_work)
+        self._work = threading.local()
+        self.pool_stats = {'producer_hits': 0, 'producer_misses': 0,
+                           'consumer_hits': 0, 'consumer_misses': 0}
+        # When publishing asynchronously, producers batch messages and up to
+        # max_in_flight of them can be waiting for the broker at the same time
+        self.async_publishing = async_publishing
+        self.max_in_flight = max_in_flight
+        # Work-queue calls pop up to the requested number of messages (at most max_receive),
+        # waiting at most batch_timeout_millis for them. Their consumer only prefetches a
+        # few (prefetch) and pulls the rest as they're taken, so a worker doesn't hold a
+        # large share of the backlog while the others sharing the subscription are idle
+        self.batch_timeout_millis = 100
+        self.max_receive = max_receive
+        self.prefetch = prefetch
+        # How workers share the repo work topics. With 'Shared' each message goes to any
+        # free worker; with 'Key_Shared' all messages of a repo_id go to the same worker.
+        # 'day_to_process' is always Shared, as its messages have no key
+        self.subscription_type = subscription_type
+        self.consumer_type = SUBSCRIPTION_TYPES[subscription_type]
+        # Set if PARTITIONED_TOPICS were created as partitioned topics
+        self.partitioned_topics = partitioned_topics
         self._set_init_status() # updates 'initialized' and 'initializing'
         # Initialize the system if it hasn't
         if not self.initialized:
             self._initialize_pulsar()
     
     def close(self):
-        """ Remeber to close when finished working """
+        """ Remeber to close when finished working. Also closes every pooled
+        producer and consumer """
+        with self._pool_lock, self._token_locks_lock:
+            handles = list(self._producers.values()) + list(self._consumers.values()) + \
+                list(self._token_locks.values())
+            self._producers.clear()
+            self._consumers.clear()
+            self._token_locks.clear()
+        for handle in handles:
+            try: handle.close()
+            except Exception as e: print(f"\n*** Exception closing {handle}: {e} ***\n")
         try: self.client.close()
         except Exception as e: print(f"\n*** Exception: {e} ***\n")
-        
-    def eval_message(self, message):
-        """ Check the message can be evaluated """
+
+    def _topic(self, topic_name, namespace=None):
+        """ Full name of a persistent topic, in self.namespace unless stated otherwise """
+        return f'persistent://{self.tenant}/{namespace or self.namespace}/{topic_name}'
+
+    def _get_producer(self, topic_name, namespace=None):
+        """ Returns the pooled producer of a topic, creating it on first use.
+        Creation is retried every second until the broker accepts it """
+        topic = self._topic(topic_name, namespace)
+        with self._pool_lock:
+            producer = self._producers.get(topic)
+            if producer is not None:
+                self.pool_stats['producer_hits'] += 1
+                return producer
+            self.pool_stats['producer_misses'] += 1
+
+        batching_config = {}
+        if self.async_publishing:
+            batching_config = {
+                'batching_enabled': True,
+                'batching_max_messages': self.max_in_flight,
+                'batching_max_publish_delay_ms': 10,
+                'max_pending_messages': self.max_in_flight,
+                'block_if_queue_full': True}
+            # Key_Shared consumers need every batch to hold a single key
+            if self.consumer_type == ConsumerType.KeyShared:
+                batching_config['batching_type'] = BatchingType.KeyBased
+
+        # Keyed messages go to the partition of their key's hash, the rest are spread
+        routing_mode = PartitionsRoutingMode.UseSinglePartition
+        if self._is_partitioned(topic_name):
+            routing_mode = PartitionsRoutingMode.RoundRobinDistribution
+
+        while True:
+            try:
+                producer = self.client.create_producer(
+                    topic=topic,
+                    producer_name=f'{topic_name}_prod_{self.client_name}',
+                    message_routing_mode=routing_mode,
+                    **batching_config)
+                break
+            except Exception as e:
+                print(f"\n*** Exception creating '{topic_name}' producer: {e} ***\n")
+                print("Retrying in 1 second")
+                time.sleep(1)
+
+        with self._pool_lock:
+            # Another thread might have created it in the meantime
+            pooled = self._producers.setdefault(topic, producer)
+        if pooled is not producer:
+            producer.close()
+        return pooled
+
+    def _get_consumer(self, topic_name, namespace=None, queue_size=1, consumer_type=None):
+        """ Returns the pooled consumer of a topic, subscribing on first use. The
+        subscription name is always the same, so it references the current read position.
+        The subscription is of self.consumer_type unless stated otherwise, so every worker
+        holds its own consumer on it and they pull from the topic in parallel.
+        There's a single consumer per topic, prefetching up to queue_size messages, so
+        no messages are left behind in consumers that aren't used anymore """
+        key = self._topic(topic_name, namespace)
+        with self._pool_lock:
+            consumer = self._consumers.get(key)
+            if consumer is not None:
+                self.pool_stats['consumer_hits'] += 1
+                return consumer
+            self.pool_stats['consumer_misses'] += 1
+
+        while True:
+            try:
+                consumer = self.client.subscribe(
+                    topic=key,
+                    subscription_name=f'{topic_name}_sub',
+                    consumer_type=consumer_type or self.consumer_type,
+                    consumer_name=f'{topic_name}_cons_{self.client_name}',
+                    initial_position=_pulsar.InitialPosition.Earliest,
+                    # Only prefetch what calls can take, so messages aren't held by a
+                    # worker while others sharing the subscription are idle
+                    receiver_queue_size=queue_size)
+                break
+            except Exception as e:
+                print(f"\n*** Exception subscribing to '{topic_name}': {e} ***\n")
+                print("Waiting 1 second to retry")
+                time.sleep(1)
+
+        with self._pool_lock:
+            pooled = self._consumers.setdefault(key, consumer)
+        if pooled is not consumer:
+            consumer.close()
+        return pooled
+
+    def _is_partitioned(self, topic_name):
+        return self.partitioned_topics and topic_name in PARTITIONED_TOPICS
+
+    def _partitions(self, topic_name, namespace=None):
+        """ Names of the partitions of a topic, or just the topic if it isn't partitioned.
+        Readers can only read from one partition at a time """
+        topic = self._topic(topic_name, namespace)
+        if not self._is_partitioned(topic_name):
+            return [topic]
+        try:
+            return self.client.get_topic_partitions(topic)
+        except Exception as e:
+            print(f"\n*** Exception getting partitions of '{topic_name}': {e} ***\n")
+            return [topic]
+
+    def _invalidate(self, pool, key):
+        """ Drops a broken producer or consumer (key: topic) from its pool. The next call to _get_producer/_get_consumer will reconnect it """
+        with self._pool_lock:
+            handle = pool.pop(key, None)
+        if handle is not None:
+            try: handle.close()
+            except Exception: pass
+
+    @staticmethod
+    def _is_timeout(exception):
+        """ A receive timeout just means the topic had nothing to give """
+        return (isinstance(exception, getattr(pulsar, 'Timeout', ()))
+                or 'TimeOut' in str(exception))
+
+    def _publish(self, topic_name, messages, namespace=None):
+        """ Sends a list of already encoded messages through the pooled producer
+        of the topic. Returns True, or None if a message couldn't be sent """
+        return self._publish_many([(topic_name, messages, namespace)])
+
+    @staticmethod
+    def _keyed(record):
+        """ Encodes a repo record as a (message, key) pair, keyed by its repo_id """
+        return (message_schema.encode(record), str(record[0]))
+
+    def _publish_many(self, topic_messages):
+        """ Publishes to several topics at the same time. topic_messages is a list
+        of (topic_name, [encoded messages], namespace) tuples, where a message can also
+        be a (message, key) pair. Returns True, or None if a message couldn't be sent """
+        if not self.async_publishing:
+            for topic_name, messages, namespace in topic_messages:
+                producer = self._get_producer(topic_name, namespace)
+                for message in messages:
+                    content, key = message if isinstance(message, tuple) else (message, None)
+                    try:
+                        producer.send(content, partition_key=key)
+                    except Exception as e:
+                        print(f"\n*** Exception sending '{topic_name}' message: {e} ***\n")
+                        self._invalidate(self._producers, self._topic(topic_name, namespace))
+                        return
+            return True
+
+        # Only max_in_flight messages can be waiting for their callback at a time
+        in_flight = threading.BoundedSemaphore(self.max_in_flight)
+        failures = []
+
+        def on_sent(topic_name, namespace):
+            def callback(res, msg_id):
+                if res != pulsar.Result.Ok:
+                    failures.append((topic_name, namespace, res))
+                in_flight.release()
+            return callback
+
+        producers = []
+        sends = []
+        for topic_name, messages, namespace in topic_messages:
+            producer = self._get_producer(topic_name, namespace)
+            callback = on_sent(topic_name, namespace)
+            producers.append((topic_name, producer))
+            sends.append([(producer, message, callback) for message in messages])
+
+        # Interleave the topics so all of them are being published concurrently
+        for send in itertools.chain.from_iterable(itertools.zip_longest(*sends)):
+            if send is None: continue
+            producer, message, callback = send
+            content, key = message if isinstance(message, tuple) else (message, None)
+            in_flight.acquire()
+            try:
+                producer.send_async(content, callback, partition_key=key)
+            except Exception as e:
+                failures.append((None, None, e))
+                in_flight.release()
+                break
+
+        # One flush per producer, then wait for every pending callback
+        for topic_name, producer in producers:
+            try: producer.flush()
+            except Exception as e: failures.append((topic_name, None, e))
+        for i in range(self.max_in_flight):
+            in_flight.acquire()
+
+        if failures:
+            print(f"\n*** Exception sending messages: {failures[0][2]} ({len(failures)} failed) ***\n")
+            for topic_name, messages, namespace in topic_messages:
+                self._invalidate(self._producers, self._topic(topic_name, namespace))
+            return
+        return True
+
+    def _receive(self, topic_name, num_messages, record_type, namespace=None):
+        """ Pops up to num_messages decoded record_type records from the pooled consumer of
+        a topic in one call. Might return less elements if the topic doesn't have
+        more to give. They're acknowledged right away, or by end_work if the thread
+        began work """
+        if self.is_topic_empty(topic_name, namespace): return []
+        consumer = self._get_consumer(topic_name, namespace, queue_size=self.prefetch)
+        try:
+            messages = self._receive_messages(consumer, min(num_messages, self.max_receive))
+        except Exception as e:
+            print(f"\n*** Exception receiving value from '{topic_name}': {e} ***\n")
+            self._invalidate(self._consumers, self._topic(topic_name, namespace))
+            return []
+        if len(messages) < 1: return []
+
+        records = [self.decode_message(msg.value(), record_type) for msg in messages]
+        self._settle(consumer, messages)
+        return [record for record in records if record != False]
+
+    def begin_work(self):
+        """ From now on, messages this thread pops from the work topics are only
+        acknowledged by end_work(True), once they've been worked on. With end_work(False)
+        they're negatively acknowledged instead, so they're redelivered (to this or
+        another worker) rather than lost """
+        self._work.pending = []
+        self._work.actions = []
+
+    def end_work(self, success=True):
+        pending = getattr(self._work, 'pending', None) or []
+        actions = getattr(self._work, 'actions', None) or []
+        self._work.pending = None
+        self._work.actions = None
+        # Before acknowledging, so they're done again if the messages are redelivered
+        for action in actions if success else []:
+            try:
+                action()
+            except Exception as e:
+                print(f"\n*** Exception finishing work: {e!r} ***\n")
+                success = False
+                break
+        for consumer, messages in pending:
+            if success:
+                # One by one even on Failover subscriptions, as a cumulative ack would also
+                # acknowledge messages negatively acknowledged before
+                for msg in messages:
+                    try: consumer.acknowledge(msg)
+                    except Exception as e: print(f"\n*** Exception acknowledging message: {e} ***\n")
+            else:
+                for msg in messages:
+                    try: consumer.negative_acknowledge(msg)
+                    except Exception as e: print(f"\n*** Exception negatively acknowledging message: {e} ***\n")
+
+    def _after_work(self, action):
+        """ Calls action once the work this thread began is done (see end_work), or right
+        away if it didn't begin work """
+        actions = getattr(self._work, 'actions', None)
+        if actions is not None:
+            actions.append(action)
+            return
+        action()
+
+    def _settle(self, consumer, messages):
+        """ Acknowledges received messages, right away or on end_work if the thread
+        began work """
+        pending = getattr(self._work, 'pending', None)
+        if pending is not None:
+            pending.append((consumer, messages))
+            return
+        self._acknowledge_batch(consumer, messages)
+
+    def _receive_messages(self, consumer, num_messages):
+        """ Up to num_messages messages from consumer, waiting at most batch_timeout_millis
+        for all of them. Only fewer if it doesn't have more to give in that time.
+        consumer.batch_receive() isn't used: its policy (max messages and bytes) is fixed
+        when subscribing, so it can't take just the num_messages of each call. Batches of
+        adaptive size would need a consumer per size, leaving messages prefetched by the
+        unused ones unacknowledged. Messages already prefetched are taken from the local
+        queue here, without a round trip to the broker """
+        messages = []
+        deadline = time.monotonic() + self.batch_timeout_millis / 1000
+        while len(messages) < num_messages:
+            # Prefetched messages are returned right away
+            timeout_millis = max(1, int((deadline - time.monotonic()) * 1000))
+            try:
+                messages.append(consumer.receive(timeout_millis=timeout_millis))
+            except Exception as e:
+                if not self._is_timeout(e):
+                    raise
+                break
+        return messages
+
+    def iter_batches(self, topic_name, batch_size, record_type, namespace=None):
+        """ Generator popping lists of up to batch_size decoded record_type records from a
+        topic until it's empty. Each batch is acknowledged (see _acknowledge_batch) when the
+        next one is requested, or when the generator is closed """
+        batch_size = min(batch_size, self.max_receive)
+        while not self.is_topic_empty(topic_name, namespace):
+            consumer = self._get_consumer(topic_name, namespace, queue_size=self.prefetch)
+            try:
+                messages = self._receive_messages(consumer, batch_size)
+            except Exception as e:
+                print(f"\n*** Exception receiving value from '{topic_name}': {e} ***\n")
+                self._invalidate(self._consumers, self._topic(topic_name, namespace))
+                return
+            if len(messages) < 1:
+                return
+
+            records = [self.decode_message(msg.value(), record_type) for msg in messages]
+            try:
+                yield [record for record in records if record != False]
+            finally:
+                self._acknowledge_batch(consumer, messages)
+
+    def _acknowledge_batch(self, consumer, messages):
+        """ Acknowledges a whole received batch. Only Failover subscriptions can do it in
+        one call, with a cumulative acknowledgement. Cumulative acks aren't allowed on
+        (Key_)Shared subscriptions (the default), so there every message is acknowledged
+        with a call of its own. The client might still group those into fewer ack
+        commands to the broker, but that isn't guaranteed """
+        if self.consumer_type == ConsumerType.Failover:
+            try:
+                consumer.acknowledge_cumulative(messages[-1])
+            except Exception as e:
+                print(f"\n*** Exception acknowledging messages: {e} ***\n")
+            return
+        for msg in messages:
+            try:
+                consumer.acknowledge(msg)
+            except Exception as e:
+                print(f"\n*** Exception acknowledging message: {e} ***\n")
+
+    def is_topic_empty(self, topic_name, namespace=None):
+        """ Cheap check of whether the subscription of a work topic has any message left,
+        using the backlog reported by the admin REST API instead of waiting for a receive
+        to time out. If it can't be known, the topic is assumed not to be empty """
+        stats = 'partitioned-stats' if self._is_partitioned(topic_name) else 'stats'
+        try:
+            response = requests.get(
+                f'{self.admin_url}/persistent/{self.tenant}/{namespace or self.namespace}/{topic_name}/{stats}',
+                timeout=1)
+            # The topic doesn't exist yet, so there's nothing in it
+            if response.status_code == 404: return True
+            subscription = response.json()['subscriptions'].get(f'{topic_name}_sub')
+            return subscription is not None and subscription['msgBacklog'] == 0
+        except Exception:
+            return False
+
+    def decode_message(self, message, record_type=None):
+        """ Check the message can be decoded into a record of message_schema """
         try:
-            processed_message = eval(message)
-        except:
+            processed_message = message_schema.decode(message, record_type)
+        except Exception:
             processed_message = False
         return processed_message
         
@@ -156,37 +582,22 @@ class PulsarConnection:
         
         # Send an Initializing message, so other workers don't do the same
         print("\n*** Initializing the system *** \n")
-        try:
-            curr_time = str(int(time.time()))
-            topic_name = 'initialized'
-            init_producer = self.client.create_producer(
-                topic=f'persistent://{self.tenant}/{self.static_namespace}/{topic_name}',
-                producer_name=f'{topic_name}_prod_{curr_time}',
-                message_routing_mode=PartitionsRoutingMode.UseSinglePartition)
-        except Exception as e:
-            print(f"\n*** Exception: {e} ***\n")
-            init_producer.close()
-            return
-        
-        try:
-            init_producer.send(("Initializing").encode('utf-8'))      
-        except Exception as e:
-            print(f"\n*** Exception sending Initializing message: {e} ***\n")
-            init_producer.close()
+        if not self._publish('initialized', [("Initializing").encode('utf-8')],
+                             namespace=self.static_namespace):
             return
         
         self.initializing = True
             
-        self.create_day_to_process() # Creates 365 days in 'day_to_process' topic
+        # Creates 365 days in 'day_to_process' topic. Retrying is safe, as days already
+        # planned are deduplicated (see _plan_days)
+        while not self.create_day_to_process():
+            print("Waiting 1 second to retry")
+            time.sleep(1)
         #self.load_all_git_tokens() # Loads 4 tokens in 'free_token'
         
-        try:
-            init_producer.send(("Initialized").encode('utf-8'))      
-        except Exception as e:
-            print(f"\n*** Exception sending Initialized message: {e} ***\n")
-            init_producer.close()
+        if not self._publish('initialized', [("Initialized").encode('utf-8')],
+                             namespace=self.static_namespace):
             return
-        init_producer.close()
         
         self.initializing = False
         self.initialized = True
@@ -198,29 +609,8 @@ class PulsarConnection:
         """ Keeps track of which days have been processed so far (each day with a
         ‘YYYY-MM-DD’ format). Useful to compute partial ‘global’ results every
         certain time by Pulsar Functions. """
-        while True:
-            try:
-                topic_name = 'days_processed'
-                days_processed_producer = self.client.create_producer(
-                    topic=f'persistent://{self.tenant}/{self.static_namespace}/{topic_name}',
-                    producer_name=f'{topic_name}_prod',
-                    message_routing_mode=PartitionsRoutingMode.UseSinglePartition)
-                break
-            except Exception as e:
-                print(f"\n*** Exception creating 'days_processed' topic: {e} ***\n")
-                print("Retrying in 1 second")
-                time.sleep(1)
-       
-        try:
-            days_processed_producer.send((
-                f"{day}").encode('utf-8'))      
-        except Exception as e:
-            print(f"\n*** Exception sending date message: {e} ***\n")
-            days_processed_producer.close()
-            return
-            
-        days_processed_producer.close()        
-        return True
+        return self._publish('days_processed', [(f"{day}").encode('utf-8')],
+                             namespace=self.static_namespace)
         
     def load_all_git_tokens(self):
         """ Updated: now just using a token list """
@@ -228,84 +618,175 @@ class PulsarConnection:
         return True
     
     def create_day_to_process(self):
-        """ Create the 'day_to_process' topic with 365 'YYYY-MM-DD' values.
-        To be called automatically while initializing, but also making it externally
-        available for test purposes """
+        """ Populate the 'day_to_process' topic with the 'YYYY-MM-DD' values from start_date
+        to end_date (to yesterday in continuous mode). To be called automatically while
+        initializing, but also making it externally available for test purposes """
         print("\n*** Populating 'day_to_process' topic ***\n")
-        while True:
-            try:
-                topic_name = 'day_to_process'
-                day_producer = self.client.create_producer(
-                    topic=f'persistent://{self.tenant}/{self.namespace}/{topic_name}',
-                    message_routing_mode=PartitionsRoutingMode.UseSinglePartition)
-                break
-            except Exception as e:
-                print(f"\n*** Exception creating 'day_to_process' topic: {e} ***\n")
-                print("Waiting 1 second..")
-                time.sleep(1)
-        
-        init_date = datetime.datetime(2021, 1, 1)
-        dates = [(init_date + datetime.timedelta(days=idx)).strftime('%Y-%m-%d') for idx in range(365)]
-        
-        for date in dates:
-            try:
-                day_producer.send((f"{date}").encode('utf-8'))      
-            except Exception as e:
-                print(f"\n*** Exception sending date message: {e} ***\n")
-                day_producer.close()
-                return
-        day_producer.close()
+        return self._plan_days()
+
+    def _last_day_to_plan(self):
+        if self.continuous:
+            return datetime.datetime.utcnow().date() - datetime.timedelta(days=1)
+        return datetime.datetime.strptime(self.end_date, '%Y-%m-%d').date()
+
+    def _plan_days(self):
+        """ Publishes to 'day_to_process' the days up to _last_day_to_plan() that haven't
+        been published yet. It's done by a producer named 'day_planner' using the ordinal of
+        each day as sequence id: with deduplication enabled in the namespace, the broker
+        remembers the last day published (last_sequence_id) and drops any day sent twice.
+        Only one worker at a time can open the producer, the others skip planning.
+        Returns True, or None if the days couldn't be planned """
+        try:
+            # Sends wait for room in the producer queue, instead of failing once more than
+            # its max_pending_messages (1000 days) are waiting for the broker
+            planner = self.client.create_producer(
+                self._topic('day_to_process'), producer_name='day_planner',
+                block_if_queue_full=True)
+        except Exception as e:
+            print(f"\n*** Exception creating 'day_planner' producer (planning elsewhere?): {e} ***\n")
+            return
+
+        failures = []
+        def on_sent(res, msg_id):
+            if res != pulsar.Result.Ok:
+                failures.append(res)
+
+        try:
+            first_day = max(datetime.datetime.strptime(self.start_date, '%Y-%m-%d').toordinal(),
+                            planner.last_sequence_id() + 1)
+            last_day = self._last_day_to_plan().toordinal()
+            for ordinal in range(first_day, last_day + 1):
+                day = datetime.date.fromordinal(ordinal).strftime('%Y-%m-%d')
+                planner.send_async(
+                    day.encode('utf-8'), on_sent, sequence_id=ordinal)
+            planner.flush()
+        except Exception as e:
+            print(f"\n*** Exception planning days to process: {e} ***\n")
+            return
+        finally:
+            planner.close()
+
+        if failures:
+            print(f"\n*** Exception planning days to process: {failures[0]} ({len(failures)} failed) ***\n")
+            return
+        if last_day >= first_day:
+            print(f"Planned {last_day - first_day + 1} days to process")
         return True
-    
+
     def get_day_to_process(self):
         """ Pops a ‘YYYY-MM-DD’ string value from the topic 'day_to_process'.
-        If there are no more days to process, returns None (Null) """
+        If there are no more days to process, returns None (Null). In continuous mode
+        that only means there are no new days yet. Once all its repos are read, the day
+        has to be marked as processed with day_read, or window_read for each of its windows
+        if it was split """
         if self.last_day_processed: return None
         
         topic_name = 'day_to_process'
-        # Create a consumer on persistent topic, always using the same name,
-        # so it always references to the current read position
-        while True:
-            try:
-                day_consumer = self.client.subscribe(
-                    topic=f"persistent://{self.tenant}/{self.namespace}/{topic_name}",
-                    subscription_name=f'{topic_name}_sub',
-                    initial_position=_pulsar.InitialPosition.Earliest)
-                break
-            except Exception as e:
-                print(f"\n*** Exception creating day_consumer: {e} ***\n")
-                print(f"Waiting 1 secs until its liberated")
-                time.sleep(1)
-                #day_consumer.close()
-            
+        if self.continuous and self.is_topic_empty(topic_name):
+            # Add the days that have passed since the last ones were planned, if any
+            self._plan_days()
+            if self.is_topic_empty(topic_name): return None
+        
+        day_consumer = self._get_consumer(topic_name, consumer_type=ConsumerType.Shared)
         try:
-            msg = day_consumer.receive()
+            # In continuous mode other workers might take the last days first, so don't
+            # wait for days that might never come
+            if self.continuous:
+                msg = day_consumer.receive(timeout_millis=self.batch_timeout_millis)
+            else:
+                msg = day_consumer.receive()
             # Save the string message (decode from byte value)
             day = str(msg.value().decode())
-            # Acknowledge that the message was received          
-            day_consumer.acknowledge(msg)
         except Exception as e:
-            print(f"\n*** Exception receiving value from 'day_consumer': {e} ***\n")
-            day_consumer.close()
+            if not self._is_timeout(e):
+                print(f"\n*** Exception receiving value from 'day_consumer': {e} ***\n")
+                self._invalidate(self._consumers, self._topic(topic_name))
             return
         
+        self._settle(day_consumer, [msg])
+        
+        return day
+
+    def day_read(self, day):
+        """ Marks a day whose repos were all read as processed. With begin_work, only
+        once that work is done """
+        self._after_work(lambda: self._day_processed(day))
+
+    def window_read(self, window):
+        """ Records that the repos of a window (a SearchWindow) of a split day were all read.
+        Once the windows read cover the whole day, marks it as processed (see day_read).
+        Every worker checks it after recording its own window, so the last one to finish
+        sees them all. Returns True, or None if it couldn't be recorded or checked """
+        day = window.start.strftime('%Y-%m-%d')
+        topic_name = f'windows_read_{day}'
+        if not self._publish(topic_name, [str(window).encode('utf-8')], namespace=self.static_namespace):
+            return
+
+        try:
+            reader = self.client.create_reader(
+                topic=self._topic(topic_name, self.static_namespace),
+                reader_name=f'{topic_name}_read_{self.client_name}',
+                start_message_id=MessageId.earliest)
+        except Exception as e:
+            print(f"\n*** Exception creating reader for '{topic_name}' topic: {e} ***\n")
+            return
+
+        # A window read more than once (redelivered) is only counted once
+        windows = set()
+        try:
+            while reader.has_message_available():
+                windows.add(SearchWindow.parse(reader.read_next(timeout_millis=400).value().decode()))
+        except Exception as e:
+            print(f"\n*** Exception receiving value from '{topic_name}' topic: {e} ***\n")
+            return
+        finally:
+            reader.close()
+
+        whole_day = SearchWindow.from_day(day)
+        if sum((read.end - read.start for read in windows), datetime.timedelta()) >= whole_day.end - whole_day.start:
+            self.day_read(day)
+        return True
+
+    def _day_processed(self, day):
+        topic_name = 'day_to_process'
         # If we reached the end, signal so we start sending None from next call on
-        if day == '2021-12-31':
+        if not self.continuous and day == self.end_date:
             self.last_day_processed = True
         
-        # Every 'self.days_to_review' days, compute partial results
+        # Every 'self.days_to_review' days compute partial results. In continuous mode,
+        # also whenever the days have been caught up with, to keep them fresh every day
         if (self.last_day_processed == False):
             day_of_year = int(datetime.datetime.strptime(day, '%Y-%m-%d').strftime('%j'))
-            if (day_of_year%self.days_to_review == 0):
+            if (day_of_year%self.days_to_review == 0 or
+                    (self.continuous and self.is_topic_empty(topic_name))):
                 self.process_results(day)
         
-        # Close at the end so no to block other processes that use the same subscription
-        day_consumer.close()
-        
         self._put_days_processed(day)
-        
-        return day
             
+    def put_windows_to_process(self, windows):
+        """ Publishes 'start..end' creation date ranges to the 'window_to_process' topic,
+        for days that had to be split to read all their repos """
+        return self._publish('window_to_process', [window.encode('utf-8') for window in windows])
+
+    def get_window_to_process(self):
+        """ Pops a 'start..end' string value from the topic 'window_to_process'.
+        If there are no windows left, returns None (Null) """
+        topic_name = 'window_to_process'
+        if self.is_topic_empty(topic_name): return None
+
+        window_consumer = self._get_consumer(topic_name, consumer_type=ConsumerType.Shared)
+        try:
+            msg = window_consumer.receive(timeout_millis=self.batch_timeout_millis)
+            window = str(msg.value().decode())
+        except Exception as e:
+            if not self._is_timeout(e):
+                print(f"\n*** Exception receiving value from 'window_consumer': {e} ***\n")
+                self._invalidate(self._consumers, self._topic(topic_name))
+            return None
+
+        self._settle(window_consumer, [msg])
+        return window
+
     def get_initializing(self):
         return self.initializing
     
@@ -334,6 +815,65 @@ class PulsarConnection:
         Now only iterating through list """   
         return self.get_free_token()
     
+    @staticmethod
+    def _token_hash(token):
+        """ Tokens are secrets, topics are named after a hash of them instead """
+        return hashlib.sha256(token.encode('utf-8')).hexdigest()[:16]
+
+    def lock_token(self, token):
+        """ Takes the lease of a token, by subscribing to its 'token_lease_*hash*' topic with
+        an Exclusive subscription. Fails if another worker holds it. The broker drops the
+        subscription if this worker dies, so the token isn't locked forever """
+        with self._token_locks_lock:
+            if token in self._token_locks: return True
+            try:
+                self._token_locks[token] = self.client.subscribe(
+                    self._topic(f'token_lease_{self._token_hash(token)}', self.static_namespace),
+                    subscription_name='token_lease',
+                    consumer_type=ConsumerType.Exclusive,
+                    consumer_name=self.client_name)
+            except Exception:
+                # Subscribed by someone else (ConsumerBusy)
+                return False
+            return True
+
+    def unlock_token(self, token):
+        with self._token_locks_lock:
+            consumer = self._token_locks.pop(token, None)
+        if consumer is None: return
+        try: consumer.close()
+        except Exception as e: print(f"\n*** Exception releasing token lease: {e} ***\n")
+
+    def put_token_quota(self, token, quota):
+        """ Publishes the quota a token has left ({resource: (remaining, reset)}) to
+        its 'token_quota_*hash*' topic """
+        return self._publish(f'token_quota_{self._token_hash(token)}',
+                             [json.dumps(quota).encode('utf-8')], namespace=self.static_namespace)
+
+    def get_token_quota(self, token):
+        """ Last quota published for a token, or an empty dict if there's none """
+        topic_name = f'token_quota_{self._token_hash(token)}'
+        try:
+            # Start at the last message, so only that one is read
+            reader = self.client.create_reader(
+                topic=self._topic(topic_name, self.static_namespace),
+                reader_name=f'{topic_name}_read_{self.client_name}',
+                start_message_id=MessageId.latest,
+                start_message_id_inclusive=True)
+        except Exception as e:
+            print(f"\n*** Exception creating reader for '{topic_name}' topic: {e} ***\n")
+            return {}
+
+        quota = {}
+        try:
+            if reader.has_message_available():
+                quota = {resource: tuple(value) for resource, value in
+                         json.loads(reader.read_next(timeout_millis=400).value().decode()).items()}
+        except Exception as e:
+            print(f"\n*** Exception receiving value from '{topic_name}' topic: {e} ***\n")
+        reader.close()
+        return quota
+
     def show_token_status(self):
         """ Just checks how the status of the free and standby tokens are currently.
         Returns a tuple with two lists ( [free_tokens], [standby_tokens] ) """
@@ -390,278 +930,71 @@ class PulsarConnection:
         reader.close()
         return ( (free_token_list, standby_token_list) )
     
-    def put_basic_repo_info(self, repo_list):
+    def put_basic_repo_info(self, repo_list, test_check=True):
         """ Publishes a series of (repo_id, 'owner', 'name', 'language') tuples in the
         'repos_for_commit_count' and 'repos_for_test_check' topics. The same info gets
-        published in the two places to make the processing easier"""
-        
-        # Start publishing the info in 'repos_for_commit_count'
-        while True:
-            try:
-                topic_name = 'repos_for_commit_count'
-                repos_for_commit_producer = self.client.create_producer(
-                    topic=f'persistent://{self.tenant}/{self.namespace}/{topic_name}',
-                    producer_name=f'{topic_name}_prod',
-                    message_routing_mode=PartitionsRoutingMode.UseSinglePartition)
-                break
-            except Exception as e:
-                print(f"\n*** Exception creating 'repos_for_commit_count' topic: {e} ***\n")
-                print("Retrying in 1 second")
-                time.sleep(1)
-                #repos_for_commit_producer.close()
-        
-        for repo in repo_list:
-            try:
-                # Remove apostrophes
-                repo = list(repo)
-                for count, value in enumerate(repo):
-                    if isinstance(value, str): repo[count] = value.replace("'", "")
-                repos_for_commit_producer.send((
-                    f"({repo[0]}, '{repo[1]}', '{repo[2]}', '{repo[3]}')").encode('utf-8'))      
-            except Exception as e:
-                print(f"\n*** Exception sending 'repos_for_commit_count' message: {e} ***\n")
-                repos_for_commit_producer.close()
-                return            
-        repos_for_commit_producer.close()
-        
-        # Now publish the same info in 'repos_for_commit_count'
-        while True:
-            try:
-                topic_name = 'repos_for_test_check'
-                repos_for_test_producer = self.client.create_producer(
-                    topic=f'persistent://{self.tenant}/{self.namespace}/{topic_name}',
-                    producer_name=f'{topic_name}_prod',
-                    message_routing_mode=PartitionsRoutingMode.UseSinglePartition)
-                break
-            except Exception as e:
-                print(f"\n*** Exception creating 'repos_for_test_check' topic: {e} ***\n")
-                print("Retrying in 1 second")
-                time.sleep(1)
+        published in the two places to make the processing easier. With test_check=False
+        only 'repos_for_commit_count' is used (when the tests are checked together with
+        the commits, see GithubProcessor.enrich_repos) """
+        messages = [self._keyed(BasicRepoInfo(*repo)) for repo in repo_list]
         
-        for repo in repo_list:
-            try:
-                # Remove apostrophes
-                repo = list(repo)
-                for count, value in enumerate(repo):
-                    if isinstance(value, str): repo[count] = value.replace("'", "")
-                repos_for_test_producer.send((
-                    f"({repo[0]}, '{repo[1]}', '{repo[2]}', '{repo[3]}')").encode('utf-8'))      
-            except Exception as e:
-                print(f"\n*** Exception sending 'repos_for_test_check' message: {e} ***\n")
-                repos_for_test_producer.close()
-                return            
-        repos_for_test_producer.close()
+        if not test_check:
+            return self._publish('repos_for_commit_count', messages)
         
-        return True
+        # Publish the info in 'repos_for_commit_count' and 'repos_for_test_check'
+        return self._publish_many([('repos_for_commit_count', messages, None),
+                                   ('repos_for_test_check', messages, None)])
     
     def get_repos_for_commit_count(self, num_repos=1):
         """  pops a num_repos sized list with (repo id, 'owner', 'name', language') 
         tuples from the topic 'repos_for_commit_count'. Might have less elements if the
         topic doesn't has more repos to return"""
-        # Create a consumer on persistent topic, always using the same name,
-        # so it always references to the current read position
-        topic_name = 'repos_for_commit_count'
-        while True:
-            try:
-                repos_for_commit_consumer = self.client.subscribe(
-                    topic=f"persistent://{self.tenant}/{self.namespace}/{topic_name}",
-                    subscription_name=f'{topic_name}_sub',
-                    initial_position=_pulsar.InitialPosition.Earliest)
-                break
-            except Exception as e:
-                print(f"\n*** Exception creating basic_repo_info: {e} ***\n")
-                print("Waiting 1 seconds to retry")
-                time.sleep(1)
-        
-        repo_list = []
-        for i in range(num_repos):
-            try:
-                # Give up to half a second to receive an answer
-                msg = repos_for_commit_consumer.receive(timeout_millis=500)
-                # Save the string message (decode from byte value)
-                message = str(msg.value().decode())
-                message = self.eval_message(message)
-                # Process message and append to repo_list
-                if (message != False): repo_list.append(message)
-                # Acknowledge that the message was received          
-                repos_for_commit_consumer.acknowledge(msg)
-            except Exception as e:
-                print(f"\n*** Exception receiving value from 'repos_for_commit_count': {e} ***")
-                print("Might have reached the limit of available repos in the topic\n")
-                #print(f"Message received: {message}")
-                break
-        
-        repos_for_commit_consumer.close()
-        return repo_list
+        return self._receive('repos_for_commit_count', num_repos, record_type=BasicRepoInfo)
 
     def get_repos_for_test_check(self, num_repos=1):
         """  pops a num_repos sized list with (repo id, 'owner', 'name', language') 
         tuples from the topic 'repos_for_test_check'. Might have less elements if the
         topic doesn't has more repos to return"""
-        # Create a consumer on persistent topic, always using the same name,
-        # so it always references to the current read position
-        topic_name = 'repos_for_test_check'
-        while True:
-            try:
-                repos_for_test_check_consumer = self.client.subscribe(
-                    topic=f"persistent://{self.tenant}/{self.namespace}/{topic_name}",
-                    subscription_name=f'{topic_name}_sub',
-                    initial_position=_pulsar.InitialPosition.Earliest)
-                break
-            except Exception as e:
-                print(f"\n*** Exception creating basic_repo_info: {e} ***\n")
-                print("Waiting 1 secs to retry")
-                time.sleep(1)
-        
-        repo_list = []
-        for i in range(num_repos):
-            try:
-                # Give up to 300 milliseconds to receive an answer
-                msg = repos_for_test_check_consumer.receive(timeout_millis=300)
-                # Save the string message (decode from byte value)
-                message = str(msg.value().decode())
-                message = self.eval_message(message)
-                # Process message and append to repo_list
-                if (message != False): repo_list.append(message)
-                # Acknowledge that the message was received          
-                repos_for_test_check_consumer.acknowledge(msg)
-            except Exception as e:
-                print(f"\n*** Exception receiving value from 'repos_for_test_check': {e} ***")
-                print("Might have reached the limit of available repos in the topic\n")
-                break
-        
-        repos_for_test_check_consumer.close()
-        return repo_list
+        return self._receive('repos_for_test_check', num_repos, record_type=BasicRepoInfo)
 
     def put_commit_repo_info(self, repo_list):
         """ Publishes a series of (repo_id, num_commits, 'repo_owner', 'repo_name') tuples in the
         commit_repo_info topic"""
-        while True:
-            try:
-                topic_name = 'commit_repo_info'
-                commit_repo_producer = self.client.create_producer(
-                    topic=f'persistent://{self.tenant}/{self.static_namespace}/{topic_name}',
-                    producer_name=f'{topic_name}_prod',
-                    message_routing_mode=PartitionsRoutingMode.UseSinglePartition)
-                break
-            except Exception as e:
-                print(f"\n*** Exception creating 'commit_repo_info' topic: {e} ***\n")
-                print("Waiting 1 sec")
-                time.sleep(1)
-        
-        for repo in repo_list:
-            try:
-                commit_repo_producer.send((
-                    f"({repo[0]}, {repo[1]}, '{repo[2]}', '{repo[3]}')").encode('utf-8'))      
-            except Exception as e:
-                print(f"\n*** Exception sending commit_repo_info message: {e} ***\n")
-                commit_repo_producer.close()
-                return
-            
-        commit_repo_producer.close()
-        return True
+        return self._publish('commit_repo_info', [
+            self._keyed(CommitRepoInfo(*repo))
+            for repo in repo_list], namespace=self.static_namespace)
     
     def put_repo_with_tests(self, repo_list):
         """ Publishes a series of (repo_id, 'repo_owner', 'repo_name', 'language') tuples in the
         repo_with_tests topic """
-        while True:
-            try:
-                topic_name = 'repo_with_tests'
-                repo_with_tests_producer = self.client.create_producer(
-                    topic=f'persistent://{self.tenant}/{self.namespace}/{topic_name}',
-                    producer_name=f'{topic_name}_prod',
-                    message_routing_mode=PartitionsRoutingMode.UseSinglePartition)
-                break
-            except Exception as e:
-                print(f"\n*** Exception creating 'repo_with_tests' topic: {e} ***\n")
-                print("Wait 1 sec")
-                time.sleep(1)
-        
-        for repo in repo_list:
-            try:
-                repo_with_tests_producer.send((
-                    f"({repo[0]}, '{repo[1]}', '{repo[2]}', '{repo[3]}' )").encode('utf-8'))      
-            except Exception as e:
-                print(f"\n*** Exception sending repo_with_tests message: {e} ***\n")
-                repo_with_tests_producer.close()
-                return
-            
-        repo_with_tests_producer.close()
-        return True
+        return self._publish('repo_with_tests', [
+            self._keyed(BasicRepoInfo(*repo))
+            for repo in repo_list])
     
     def get_repo_with_tests(self, num_repos):
         """  pops a num_repos sized list with (repo_id, 'repo_owner', 'repo_name', 'language')
         tuples from the topic repo_with_tests. Might have less elements if the
         topic doesn't has more repos to return """
-        # Create a consumer on persistent topic, always using the same name,
-        # so it always references to the current read position
-        topic_name = 'repo_with_tests'
-        while True:
-            try:
-                repo_with_tests_consumer = self.client.subscribe(
-                    topic=f"persistent://{self.tenant}/{self.namespace}/{topic_name}",
-                    subscription_name=f'{topic_name}_sub',
-                    initial_position=_pulsar.InitialPosition.Earliest)
-                break
-            except Exception as e:
-                print(f"\n*** Exception creating repo_with_tests: {e} ***\n")
-                print("Waiting 1 sec to retry")
-                time.sleep(1)
-        
-        repo_list = []
-        for i in range(num_repos):
-            try:
-                # Give up to 200 milliseconds to receive an answer
-                msg = repo_with_tests_consumer.receive(timeout_millis=200)
-                # Save the string message (decode from byte value)
-                message = str(msg.value().decode())
-                message = self.eval_message(message)
-                # Process message and append to repo_list
-                if (message != False): repo_list.append(message)
-                # Acknowledge that the message was received          
-                repo_with_tests_consumer.acknowledge(msg)
-            except Exception as e:
-                print(f"\n*** Exception receiving value from 'repo_with_tests_consumer': {e} ***")
-                print("Might have reached the limit of available repos in the topic\n")
-                break
-        
-        repo_with_tests_consumer.close()
-        return repo_list
+        return self._receive('repo_with_tests', num_repos, record_type=BasicRepoInfo)
 
     def put_repo_with_ci(self, repo_list):
         """ Publishes a series of (repo_id, 'language') tuples in the
         repo_with_ci topic """
-        while True:
-            try:
-                topic_name = 'repo_with_ci'
-                repo_with_ci_producer = self.client.create_producer(
-                    topic=f'persistent://{self.tenant}/{self.static_namespace}/{topic_name}',
-                    producer_name=f'{topic_name}_prod',
-                    message_routing_mode=PartitionsRoutingMode.UseSinglePartition)
-                break
-            except Exception as e:
-                print(f"\n*** Exception creating 'repo_with_ci_producer' topic: {e} ***\n")
-                print("Waiting 1 sec")
-                time.sleep(1)
-        
-        for repo in repo_list:
-            try: # repo[3] has the language
-                repo_with_ci_producer.send((
-                    f"({repo[0]}, '{repo[3]}')").encode('utf-8'))      
-            except Exception as e:
-                print(f"\n*** Exception sending 'repo_with_ci_producer' message: {e} ***\n")
-                repo_with_ci_producer.close()
-                return
-            
-        repo_with_ci_producer.close()
-        return True
+        # repo[3] has the language
+        return self._publish('repo_with_ci', [
+            self._keyed(RepoWithCi(repo[0], repo[3]))
+            for repo in repo_list], namespace=self.static_namespace)
     
-    def process_results(self, cutoff_date='2021-12-31'):
-        """ Process answers up to existing information (at cutoff_date) and publish top
-        repos by commit number to a special result topic """
+    def process_results(self, cutoff_date=None):
+        """ Process answers up to existing information (at cutoff_date, end_date by default)
+        and publish top repos by commit number to a special result topic. The ranking is
+        updated incrementally from the last checkpoint, so only commit info published since
+        then is read """
+        cutoff_date = cutoff_date or self.end_date
         
-        # Make sure the final processing hasn't been called before, by checking for a final
-        # '2021-12-31' message on the 'initialized' topic
+        # Make sure the results haven't been processed before up to this date (or a later
+        # one, like the final end_date), by checking the last cutoff date reported on
+        # the 'initialized' topic
         init_topic = 'initialized'
         curr_time = str(int(time.time()))
         while True:
@@ -688,8 +1021,8 @@ class PulsarConnection:
                 break
         reader.close()
         
-        # If the final day has already been processed, exit the method
-        if (init_list[-1] == '2021-12-31'): return False
+        # If the day has already been processed, exit the method
+        if (len(init_list[-1]) == 10 and init_list[-1] >= cutoff_date): return False
         
         # Walk through current list of languages, and send them to 'aggregate_languages_info'
         # topic to signal Pulsar Functions to report current counters
@@ -712,8 +1045,11 @@ class PulsarConnection:
             try:
                 # Give up to 400 milliseconds to receive an answer
                 msg = reader.read_next(timeout_millis=400)
-                # Save the string message (decode from byte value)
-                language_list.append(str(msg.value().decode()))
+                # Save the string message (decode from byte value). Instances of the
+                # aggregate function might have published the same language
+                language = str(msg.value().decode())
+                if language not in language_list:
+                    language_list.append(language)
             except Exception as e:
                 print(f"\n*** Exception receiving value from 'languages': {e} ***\n")
                 break
@@ -721,123 +1057,96 @@ class PulsarConnection:
         
         # Publish current list language to 'aggregate_languages_info'. It will make Pulsar
         # Functions work on them
-        while True:
-            try:
-                lang_result_topic = 'aggregate_languages_info'
-                lang_result_producer = self.client.create_producer(
-                    topic=f'persistent://{self.tenant}/{self.static_namespace}/{lang_result_topic}',
-                    producer_name=f'{lang_result_topic}_prod',
-                    message_routing_mode=PartitionsRoutingMode.UseSinglePartition)
-                break
-            except Exception as e:
-                print(f"\n*** Exception creating 'aggregate_languages_info' topic: {e} ***\n")
-                print("Wait 1 sec")
-                time.sleep(1)
+        if not self._publish('aggregate_languages_info',
+                             [(lang).encode('utf-8') for lang in language_list],
+                             namespace=self.static_namespace):
+            return
         
-        for lang in language_list:
+        # Start from the ranking of the last results, and the position it reached on each
+        # partition of 'commit_repo_info', so only newer messages have to be read
+        ranking = CommitRanking(self.top_repos_partial_results)
+        positions = {}
+        checkpoint = self._read_last_message('commit_ranking_checkpoint', self.static_namespace)
+        if checkpoint is not None:
             try:
-                lang_result_producer.send((lang).encode('utf-8'))
+                ranking, positions = CommitRanking.from_checkpoint(
+                    checkpoint, self.top_repos_partial_results)
             except Exception as e:
-                print(f"\n*** Exception sending 'aggregate_languages_info' message: {e} ***\n")
-                lang_result_producer.close()
-                return
-        lang_result_producer.close()             
+                print(f"\n*** Exception loading commit ranking checkpoint, starting over: {e} ***\n")
         
-        # Create a consumer on persistent topic with the commit information of repos
-        # with unique name, so it always start from the beginning
+        # Create a reader on each partition of the persistent topic with the commit information
+        # of repos with unique name, starting right after the checkpoint
         topic_name = 'commit_repo_info'
-        curr_time = str(int(time.time()))
-        while True:
-            try:
-                reader = self.client.create_reader(
-                    topic=f"persistent://{self.tenant}/{self.static_namespace}/{topic_name}",
-                    reader_name=f'{topic_name}_sub_{curr_time}',
-                    start_message_id=MessageId.earliest)
-                break
-            except Exception as e:
-                print(f"\n*** Exception creating reader for commit_repo_info: {e} ***\n")
-                print("Wait 1 sec")
-                time.sleep(1)
-        
-        # Ordered list supporting in-place insertion
-        ord_list = sortedcontainers.SortedKeyList(key=lambda x: -x.commits)
-        lower_value = 0 # Keep track of minimum value from the list
-        while reader.has_message_available():
-            try:
-                # Give up to 400 milliseconds to receive an answer
-                msg = reader.read_next(timeout_millis=400)
-                # Save the string message (decode from byte value)
-                message = str(msg.value().decode())
-                repo_tuple = eval(message)     
-                # If this is the last time processing results, add all values
-                if (cutoff_date=='2021-12-31'):
-                    ord_list.add(RepoCommits(repo_tuple))
-                else: # Only add on list if bigger than lower_value
-                    num_commits = int(repo_tuple[1] or 0)
-                    if (num_commits > lower_value):
-                        ord_list.add(RepoCommits(repo_tuple))
-                        # When exceeding size, take last element and update lower_value
-                        if (len(ord_list) > self.top_repos_partial_results):
-                            lower_value = ord_list.pop().commits
-            except Exception as e:
-                print(f"\n*** Exception receiving value from 'commit_repo_info': {e} ***\n")
-                break      
-        reader.close()
+        for partition in self._partitions(topic_name, self.static_namespace):
+            start_message_id = MessageId.earliest
+            if partition in positions:
+                start_message_id = MessageId.deserialize(positions[partition])
+            curr_time = str(int(time.time()))
+            while True:
+                try:
+                    reader = self.client.create_reader(
+                        topic=partition,
+                        reader_name=f'{topic_name}_sub_{curr_time}',
+                        start_message_id=start_message_id)
+                    break
+                except Exception as e:
+                    print(f"\n*** Exception creating reader for commit_repo_info: {e} ***\n")
+                    print("Wait 1 sec")
+                    time.sleep(1)
+            
+            while reader.has_message_available():
+                try:
+                    # Give up to 400 milliseconds to receive an answer
+                    msg = reader.read_next(timeout_millis=400)
+                    ranking.add(message_schema.decode(msg.value(), CommitRepoInfo))
+                    positions[partition] = msg.message_id().serialize()
+                except Exception as e:
+                    print(f"\n*** Exception receiving value from 'commit_repo_info': {e} ***\n")
+                    break      
+            reader.close()
         
         # Now publish the results in a {cutoff_date}_result_commit topic, with tuples in a
         # (id_repo, num_commits, 'repo_owner', 'repo_name') format
-        while True:
-            try:
-                topic_name = f'{cutoff_date}_result_commit'
-                result_commit_producer = self.client.create_producer(
-                    topic=f'persistent://{self.tenant}/{self.static_namespace}/{topic_name}',
-                    producer_name=f'{topic_name}_prod',
-                    message_routing_mode=PartitionsRoutingMode.UseSinglePartition)
-                break
-            except Exception as e:
-                print(f"\n*** Exception creating '{cutoff_date}_result_commit' topic: {e} ***\n")
-                print("Wait 1 sec")
-                time.sleep(1)
+        if not self._publish(f'{cutoff_date}_result_commit', [
+                message_schema.encode(repo) for repo in ranking.top()],
+                namespace=self.static_namespace):
+            return
         
-        for repo in ord_list.irange():
-            try:
-                result_commit_producer.send((
-                    f"({repo.ident}, {repo.commits}, '{repo.owner}', '{repo.repo_name}')").encode('utf-8'))
-            except Exception as e:
-                print(f"\n*** Exception sending basic_repo_info message: {e} ***\n")
-                result_commit_producer.close()
-                return            
-        result_commit_producer.close()
+        # Save the checkpoint for the next results
+        if not self._publish('commit_ranking_checkpoint', [ranking.to_checkpoint(positions)],
+                             namespace=self.static_namespace):
+            return
         
         # Send a message to the 'initialized' topic sharing the cutoff date of the results
         print("\n*** Reporting the cutoff date to the 'initialized' topic *** \n")
-        while True:
-            try:
-                curr_time = str(int(time.time()))
-                topic_name = 'initialized'
-                init_producer = self.client.create_producer(
-                    topic=f'persistent://{self.tenant}/{self.static_namespace}/{topic_name}',
-                    producer_name=f'{topic_name}_prod_{curr_time}',
-                    message_routing_mode=PartitionsRoutingMode.UseSinglePartition)
-                break
-            except Exception as e:
-                print(f"\n*** Exception sending cutoff date to 'initialized': {e} ***\n")
-                print("Wait 1 sec")
-                time.sleep(1)
-        
+        return self._publish('initialized', [(f'{cutoff_date}').encode('utf-8')],
+                             namespace=self.static_namespace)
+
+    def _read_last_message(self, topic_name, namespace=None):
+        """ Value of the last message of a (small) retained topic, or None if it's empty """
+        curr_time = str(int(time.time()))
         try:
-            init_producer.send((f'{cutoff_date}').encode('utf-8'))
+            reader = self.client.create_reader(
+                topic=self._topic(topic_name, namespace),
+                reader_name=f'{topic_name}_read_{curr_time}',
+                start_message_id=MessageId.earliest)
         except Exception as e:
-            print(f"\n*** Exception sending Initializing message: {e} ***\n")
-            init_producer.close()
-            return      
-        
-        init_producer.close()
-        return True
+            print(f"\n*** Exception creating reader for '{topic_name}' topic: {e} ***\n")
+            return
+
+        value = None
+        while reader.has_message_available():
+            try:
+                value = reader.read_next(timeout_millis=400).value()
+            except Exception as e:
+                print(f"\n*** Exception receiving value from '{topic_name}' topic: {e} ***\n")
+                break
+        reader.close()
+        return value
 
     def get_current_cuttoff_date(self):
-        """ Receives the 'YYYY-MM-DD' of the last processed information. If 
-        it is '2021-12-31' it means all has already been processed """    
+        """ Receives the 'YYYY-MM-DD' of the last processed information. If it is
+        end_date (and not in continuous mode) it means all has already been processed """    
 
         # This info is kept in the 'initialized' topic
         init_topic = 'initialized'
@@ -882,7 +1191,7 @@ class PulsarConnection:
             print(f"\n*** It seems there are still no results. Received '{cutoff_date}' as cutoff value ***\n")
             return
 
-        if (cutoff_date == '2021-12-31'):
+        if (not self.continuous and cutoff_date == self.end_date):
             print("\n*** Showing final results (all info has been processed) ***\n")
         else:
             print(f"\n*** Showing partial results up to {cutoff_date} (info is still being processed) ***\n")
@@ -907,8 +1216,7 @@ class PulsarConnection:
             try:
                 # Give up to 400 milliseconds to receive an answer
                 msg = reader.read_next(timeout_millis=700)
-                # Save the string message (decode from byte value)
-                result_tuple = eval(str(msg.value().decode()))
+                result_tuple = message_schema.decode(msg.value(), CommitRepoInfo)
                 repo_name = f"{result_tuple[2]}/{result_tuple[3]}"
                 result_list.append((repo_name, result_tuple[1]))
             except Exception as e:
@@ -918,6 +1226,25 @@ class PulsarConnection:
 
         return result_list    
     
+    def request_commit_leaderboard(self):
+        """ Signals Pulsar Functions to publish a snapshot of the commit leaderboard it keeps
+        up to date as commit info arrives, to the 'commit_leaderboard' topic """
+        return self._publish('commit_leaderboard_request', [str(int(time.time())).encode('utf-8')],
+                             namespace=self.static_namespace)
+
+    def get_commit_leaderboard(self, num_values=10):
+        """ Reads the last snapshot of the commit leaderboard published by Pulsar Functions
+        (see request_commit_leaderboard). Returns a num_values list of tuples of the form
+        ('repo_name', num_commits), like get_top_commits """
+        snapshot = self._read_last_message('commit_leaderboard', self.static_namespace)
+        if snapshot is None:
+            print("\n*** It seems there is still no commit leaderboard. Request one first ***\n")
+            return
+
+        leaderboard, _ = CommitRanking.from_checkpoint(snapshot, self.top_repos_partial_results)
+        return [(f"{repo.owner}/{repo.name}", repo.commits)
+                for repo in leaderboard.top()[:num_values]]
+
     def get_languages_stats(self):
         """ Receives current aggregated information of languages in a list made of tuples
         ('language', num_repos, num_tests, num_cis). Returns a dictionary with the consolidated
@@ -945,8 +1272,7 @@ class PulsarConnection:
             try:
                 # Give up to 400 milliseconds to receive an answer
                 msg = reader.read_next(timeout_millis=400)
-                # Save the string message (decode from byte value)
-                result_tuple = eval(str(msg.value().decode()))
+                result_tuple = message_schema.decode(msg.value(), LanguageResult)
                 result_dict[result_tuple[0]]={'num_repos': result_tuple[1],
                                   'num_tests': result_tuple[2],
                                   'num_ci': result_tuple[3]}
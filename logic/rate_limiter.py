@@ -0,0 +1,163 @@
+"""
+Client-side pacing of GitHub requests, so they stay just under the rate limits instead of
+bursting into them and being penalized.
+
+Every token has a token bucket per resource ('core', 'search', 'code_search', 'graphql'),
+refilled at the documented limit of the resource (DEFAULT_LIMITS). A request takes one
+from its bucket, or waits until there is one. The rate of a bucket is also lowered to
+what the token has left until its quota resets (X-RateLimit-Remaining / X-RateLimit-Reset
+headers), times headroom, so the quota lasts until the reset instead of running out
+before it.
+
+When GitHub asks to slow down anyway (a rate limit error), the bucket is paused until
+Retry-After, until the reset if there's no quota left, or for SECONDARY_LIMIT_WAIT
+otherwise, and its rate is halved. Each request that goes through afterwards regrows it
+a little, back up to the documented limit.
+"""
+import threading
+import time
+from typing import Dict, NamedTuple, Optional, Tuple
+
+
+class Limit(NamedTuple):
+    # requests allowed per period seconds, and how many can be made at once
+    requests: float
+    period: float
+    burst: float
+
+
+# https://docs.github.com/en/rest/overview/resources-in-the-rest-api#rate-limiting
+DEFAULT_LIMITS = {
+    'core': Limit(5000, 3600, 10),
+    'search': Limit(30, 60, 3),
+    'code_search': Limit(10, 60, 1),
+    'graphql': Limit(5000, 3600, 10),
+}
+
+# Secondary limits don't always say for how long, the docs advise waiting at least this
+SECONDARY_LIMIT_WAIT = 60
+
+
+class TokenBucket:
+    def __init__(self, limit: Limit, clock=time.monotonic):
+        self.limit = limit
+        self.capacity = limit.burst
+        self.tokens = limit.burst
+        self._clock = clock
+        # Tokens are counted up to this time. Set in the future while paused
+        self.updated = clock()
+        # Fraction of the documented rate in use, lowered after a penalty
+        self.factor = 1.0
+        # Rate the quota left allows until it resets, if known
+        self.quota_rate = None
+
+    @property
+    def rate(self) -> float:
+        rate = self.limit.requests / self.limit.period * self.factor
+        return rate if self.quota_rate is None else min(rate, self.quota_rate)
+
+    def reserve(self, amount: float = 1) -> float:
+        """ Takes amount from the bucket. Returns the seconds to wait before using them """
+        now = self._clock()
+        if now > self.updated:
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+
+        # Below 0, they are borrowed from the ones yet to come, so later reservations
+        # queue behind this one
+        self.tokens -= amount
+        return max(0.0, self.updated - now) + max(0.0, -self.tokens / self.rate)
+
+    def pause(self, seconds: float):
+        """ No requests for seconds, and start over from an empty bucket after them """
+        self.updated = max(self.updated, self._clock() + seconds)
+        self.tokens = min(self.tokens, 0)
+
+
+class RateLimiter:
+    def __init__(self,
+                 limits: Optional[Dict[str, Limit]] = None,
+                 headroom: float = 0.9,
+                 recovery: float = 0.02,
+                 clock=time.monotonic,
+                 wall_clock=time.time,
+                 sleep=time.sleep):
+        self.limits = limits or DEFAULT_LIMITS
+        # Fraction of the quota left paced over until it resets
+        self.headroom = headroom
+        # How much of the documented rate each successful request gives back after a penalty
+        self.recovery = recovery
+        self._clock = clock
+        # Resets in the headers are epoch seconds
+        self._wall_clock = wall_clock
+        self._sleep = sleep
+        self._lock = threading.Lock()
+        self._buckets: Dict[Tuple[str, str], TokenBucket] = {}
+        self.waited = 0.0
+        self.penalties = 0
+
+    def _bucket(self, token: str, resource: str) -> TokenBucket:
+        key = (token, resource)
+        if key not in self._buckets:
+            self._buckets[key] = TokenBucket(self.limits.get(resource, self.limits['core']), self._clock)
+        return self._buckets[key]
+
+    def reserve(self, token: str, resource: str, amount: float = 1) -> float:
+        """ Seconds to wait before making a request with token. For callers that can't
+        block, like AsyncGithubWrapper """
+        with self._lock:
+            delay = self._bucket(token, resource).reserve(amount)
+            self.waited += delay
+            return delay
+
+    def wait(self, token: str, resource: str):
+        delay = self.reserve(token, resource)
+        if delay > 0:
+            self._sleep(delay)
+
+    def charge(self, token: str, resource: str, amount: float):
+        """ The last request used amount more than it reserved (like a costly GraphQL
+        query). Later requests wait for it """
+        if amount > 0:
+            self.reserve(token, resource, amount)
+
+    def record(self, token: str, resource: str, headers, limited: bool = False):
+        """ Adapts the pace of token after a response. limited tells if the response was
+        a rate limit error (see api_wrapper.is_rate_limited) """
+        remaining = _header_number(headers, 'X-RateLimit-Remaining')
+        reset = _header_number(headers, 'X-RateLimit-Reset')
+        retry_after = _header_number(headers, 'Retry-After')
+
+        with self._lock:
+            bucket = self._bucket(token, resource)
+            now = self._wall_clock()
+
+            if remaining is not None and reset is not None:
+                bucket.quota_rate = max(remaining * self.headroom, 1) / max(reset - now, 1)
+
+            if not limited:
+                bucket.factor = min(1.0, bucket.factor + self.recovery)
+                return
+
+            if retry_after is not None:
+                wait = retry_after
+            elif remaining is not None and remaining < 1 and reset is not None:
+                wait = reset - now
+            else:
+                wait = SECONDARY_LIMIT_WAIT
+
+            bucket.pause(max(wait, 0) + 1)
+            bucket.factor = max(bucket.factor / 2, 0.05)
+            self.penalties += 1
+
+    def status(self) -> Dict[Tuple[str, str], float]:
+        """ (token, resource) -> requests per second currently allowed """
+        with self._lock:
+            return {key: bucket.rate for key, bucket in self._buckets.items()}
+
+
+def _header_number(headers, name: str) -> Optional[float]:
+    try:
+        return float(headers.get(name))
+    except (TypeError, ValueError):
+        return None
@@ -0,0 +1,59 @@
+"""
+Compares the cost of the message formats used in the Pulsar topics:
+- 'eval': the old f-string tuples, parsed back with eval()
+- 'schema': the binary records of 'message_schema.py'
+
+Doesn't need Pulsar running. Usage: python schema_benchmark.py [number_of_messages]
+"""
+import sys
+import timeit
+
+import message_schema
+from message_schema import BasicRepoInfo, CommitRepoInfo
+
+
+def eval_encode_basic(repo):
+    return f"({repo[0]}, '{repo[1]}', '{repo[2]}', '{repo[3]}')".encode('utf-8')
+
+
+def eval_encode_commit(repo):
+    return f"({repo[0]}, {repo[1]}, '{repo[2]}', '{repo[3]}')".encode('utf-8')
+
+
+def eval_decode(data):
+    return eval(str(data.decode()))
+
+
+def run(num_messages=10000):
+    basic_repos = [BasicRepoInfo(400000000 + i, f'owner_{i}', f'some-repository-{i}', 'Python')
+                   for i in range(num_messages)]
+    commit_repos = [CommitRepoInfo(400000000 + i, i * 7, f'owner_{i}', f'some-repository-{i}')
+                    for i in range(num_messages)]
+
+    cases = [
+        ('basic_repo_info', basic_repos, eval_encode_basic),
+        ('commit_repo_info', commit_repos, eval_encode_commit),
+    ]
+
+    print(f"{num_messages} messages per case, best of 5 runs\n")
+    print(f"{'record':<18}{'format':<8}{'encode (us/msg)':>17}{'decode (us/msg)':>17}{'bytes/msg':>11}")
+    for name, records, eval_encode in cases:
+        formats = [
+            ('eval', eval_encode, eval_decode),
+            ('schema', message_schema.encode, message_schema.decode),
+        ]
+        for format_name, encode, decode in formats:
+            encoded = [encode(record) for record in records]
+            encode_time = min(timeit.repeat(
+                lambda: [encode(record) for record in records], number=1, repeat=5))
+            decode_time = min(timeit.repeat(
+                lambda: [decode(data) for data in encoded], number=1, repeat=5))
+            size = sum(map(len, encoded)) / len(encoded)
+            print(f"{name:<18}{format_name:<8}"
+                  f"{encode_time / num_messages * 1e6:>17.2f}"
+                  f"{decode_time / num_messages * 1e6:>17.2f}"
+                  f"{size:>11.1f}")
+
+
+if __name__ == "__main__":
+    run(int(sys.argv[1]) if len(sys.argv) > 1 else 10000)
@@ -2,7 +2,27 @@ PULSAR_ADMIN_PATH=$(cat pulsar-path.txt)/bin/pulsar-admin
 PULSAR_ADMIN_PATH="${PULSAR_ADMIN_PATH/#\~/$HOME}"
 
 HERE=$(dirname "$0")
-AGGREGATE_FUNCTIONS_PATH=$(realpath ../$HERE/aggregate_functions.py)
+# Instances of the aggregate function, so it keeps up with partitioned input topics
+FUNCTION_PARALLELISM=${FUNCTION_PARALLELISM:-1}
+# How the function remembers already reviewed repos: 'counter' (the default, one counter per
+# repo in the state store) or 'bloom' (sharded Bloom filters cached by each function instance).
+# 'bloom' only deduplicates correctly with FUNCTION_PARALLELISM=1, or with input topics
+# routed by repo_id key (Key_Shared), otherwise every instance counts the same repo once.
+# Switching an existing deployment between modes starts from an empty dedup history
+DEDUP_MODE=${DEDUP_MODE:-counter}
+if [ "$DEDUP_MODE" = "bloom" ] && [ "$FUNCTION_PARALLELISM" != "1" ]; then
+  echo "Warning: DEDUP_MODE=bloom with FUNCTION_PARALLELISM=$FUNCTION_PARALLELISM needs key-routed input topics"
+fi
+LOGIC_PATH=$(realpath ../$HERE)
+
+# aggregate_functions.py imports message_schema.py, commit_ranking.py and bloom_filter.py, so
+# they are packaged in a zip with the layout Pulsar expects for Python functions: <name>/src/*.py
+BUILD_PATH=$(mktemp -d)
+mkdir -p $BUILD_PATH/aggregate_functions/src
+cp $LOGIC_PATH/aggregate_functions.py $LOGIC_PATH/message_schema.py \
+  $LOGIC_PATH/commit_ranking.py $LOGIC_PATH/bloom_filter.py $BUILD_PATH/aggregate_functions/src/
+(cd $BUILD_PATH && zip -qr aggregate_functions.zip aggregate_functions)
+AGGREGATE_FUNCTIONS_PATH=$BUILD_PATH/aggregate_functions.zip
 
 echo Initializing functions using file $AGGREGATE_FUNCTIONS_PATH
 
@@ -12,4 +32,6 @@ $PULSAR_ADMIN_PATH functions create \
   --tenant public \
   --namespace static \
   --name aggregate_functions \
-  --inputs persistent://public/default/repos_for_commit_count,persistent://public/default/repo_with_tests,persistent://public/static/repo_with_ci,persistent://public/static/aggregate_languages_info
\ No newline at end of file
+  --parallelism $FUNCTION_PARALLELISM \
+  --inputs persistent://public/default/repos_for_commit_count,persistent://public/default/repo_with_tests,persistent://public/static/repo_with_ci,persistent://public/static/aggregate_languages_info,persistent://public/static/commit_repo_info,persistent://public/static/commit_leaderboard_request \
+  --user-config "{\"leaderboard_size\": 100, \"dedup_mode\": \"$DEDUP_MODE\"}"
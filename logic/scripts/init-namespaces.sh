@@ -1,8 +1,20 @@
 PULSAR_ADMIN_PATH=$(cat pulsar-path.txt)/bin/pulsar-admin
 PULSAR_ADMIN_PATH="${PULSAR_ADMIN_PATH/#\~/$HOME}"
 
+# Number of partitions for the repo work topics (PARTITIONED_TOPICS in pulsar_wrapper.py).
+# 0 keeps them as regular topics. With any other value, run the workers with
+# pulsar_partitioned=true so they publish and read them as partitioned topics
+PARTITIONS=${PARTITIONS:-0}
+
 $PULSAR_ADMIN_PATH namespaces set-retention public/default --size -1 --time -1
 $PULSAR_ADMIN_PATH namespaces set-deduplication public/default --enable
 $PULSAR_ADMIN_PATH namespaces create public/static
 $PULSAR_ADMIN_PATH namespaces set-retention public/static --size -1 --time -1
-$PULSAR_ADMIN_PATH namespaces set-deduplication public/static --enable
\ No newline at end of file
+$PULSAR_ADMIN_PATH namespaces set-deduplication public/static --enable
+
+if [ "$PARTITIONS" -gt 0 ]; then
+  for TOPIC in public/default/repos_for_commit_count public/default/repos_for_test_check \
+               public/default/repo_with_tests public/static/commit_repo_info; do
+    $PULSAR_ADMIN_PATH topics create-partitioned-topic persistent://$TOPIC --partitions $PARTITIONS
+  done
+fi
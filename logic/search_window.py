@@ -0,0 +1,59 @@
+"""
+Time windows of repo creation dates, used to read every repo created in a day even though
+the GitHub search API never returns more than SEARCH_RESULT_CAP results for a query.
+
+A day starts as a single window. If its search has more results than the cap, it is
+bisected into two windows (on hour boundaries, then on minute boundaries) which are searched
+separately, until every window fits under the cap or is a single minute long.
+
+Windows are sent through the 'window_to_process' topic as their 'created:' search range,
+for example '2021-01-01T00:00:00Z..2021-01-01T11:59:59Z'
+"""
+import datetime
+from typing import NamedTuple, Optional, Tuple
+
+SEARCH_RESULT_CAP = 1000
+
+_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
+_SECOND = datetime.timedelta(seconds=1)
+_MINUTE = datetime.timedelta(minutes=1)
+_HOUR = datetime.timedelta(hours=1)
+
+
+class SearchWindow(NamedTuple):
+    # Creation dates from start (included) to end (excluded)
+    start: datetime.datetime
+    end: datetime.datetime
+
+    @staticmethod
+    def from_day(day: str) -> 'SearchWindow':
+        """ The window of a whole 'YYYY-MM-DD' day """
+        start = datetime.datetime.strptime(day, '%Y-%m-%d')
+        return SearchWindow(start, start + datetime.timedelta(days=1))
+
+    @staticmethod
+    def parse(text: str) -> 'SearchWindow':
+        """ Inverse of str(window) """
+        start, last = text.split('..')
+        return SearchWindow(datetime.datetime.strptime(start, _FORMAT),
+                            datetime.datetime.strptime(last, _FORMAT) + _SECOND)
+
+    def __str__(self):
+        # Both ends of a search range are included
+        return f'{self.start.strftime(_FORMAT)}..{(self.end - _SECOND).strftime(_FORMAT)}'
+
+    def split(self) -> Optional[Tuple['SearchWindow', 'SearchWindow']]:
+        """ Bisects the window on an hour boundary, or on a minute boundary once it's an
+        hour or shorter. Returns None if it's already a single minute """
+        span = self.end - self.start
+        if span > _HOUR:
+            unit = _HOUR
+        elif span > _MINUTE:
+            unit = _MINUTE
+        else:
+            return None
+
+        middle = self.start + (span / 2) // unit * unit
+        if middle <= self.start:
+            middle = self.start + unit
+        return SearchWindow(self.start, middle), SearchWindow(middle, self.end)
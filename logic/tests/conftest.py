@@ -0,0 +1,22 @@
+import os
+import sys
+
+import pytest
+
+# The modules in logic/ import each other by their plain names, as when run from there
+LOGIC_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, LOGIC_PATH)
+
+
+class FakeClock:
+    """ A clock that only moves when now is changed """
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock():
+    return FakeClock()
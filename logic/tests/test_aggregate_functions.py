@@ -0,0 +1,102 @@
+import pytest
+
+pytest.importorskip('pulsar')
+
+import message_schema
+from aggregate_functions import AggregateFunction
+from message_schema import BasicRepoInfo
+
+LANGUAGES_TOPIC = 'persistent://public/static/languages'
+
+
+class FakeContext:
+    """ The parts of the Pulsar Functions context AggregateFunction uses """
+    def __init__(self, user_config=None):
+        self.user_config = user_config or {}
+        self.counters = {}
+        self.state = {}
+        self.published = []
+        self.topic = None
+
+    def get_user_config_value(self, key):
+        return self.user_config.get(key)
+
+    def get_current_message_topic_name(self):
+        return self.topic
+
+    def incr_counter(self, key, amount):
+        self.counters[key] = self.counters.get(key, 0) + amount
+
+    def get_counter(self, key):
+        return self.counters.get(key, 0)
+
+    def get_state(self, key):
+        return self.state.get(key)
+
+    def put_state(self, key, value):
+        self.state[key] = value
+
+    def publish(self, topic_name, message):
+        self.published.append((topic_name, message))
+
+    def send(self, function, in_topic, item):
+        self.topic = f'persistent://public/default/{in_topic}'
+        function.process(item, self)
+
+
+def repo(repo_id, language):
+    return message_schema.encode(BasicRepoInfo(repo_id, 'owner', f'repo{repo_id}', language))
+
+
+def published_languages(context):
+    return [message.decode('utf-8') for topic, message in context.published if topic == LANGUAGES_TOPIC]
+
+
+def test_language_published_before_counters_are_flushed():
+    context = FakeContext({'flush_messages': 1000, 'flush_interval_ms': 10 ** 9, 'dedup_mode': 'bloom'})
+    function = AggregateFunction()
+
+    context.send(function, 'repos_for_commit_count', repo(1, 'Python'))
+
+    # Still buffered, but partial results reading 'languages' now already see it
+    assert context.counters.get('Python-repos', 0) == 0
+    assert published_languages(context) == ['Python']
+
+
+def test_language_published_once():
+    context = FakeContext({'flush_messages': 2, 'flush_interval_ms': 10 ** 9})
+    function = AggregateFunction()
+
+    for repo_id in range(5):
+        context.send(function, 'repos_for_commit_count', repo(repo_id, 'Go'))
+
+    assert published_languages(context) == ['Go']
+
+
+def test_language_counted_by_another_instance_not_published_again():
+    context = FakeContext({'flush_messages': 1, 'flush_interval_ms': 10 ** 9})
+    context.counters['Rust-repos'] = 3
+
+    context.send(AggregateFunction(), 'repos_for_commit_count', repo(1, 'Rust'))
+
+    assert published_languages(context) == []
+    assert context.counters['Rust-repos'] == 4
+
+
+def test_repo_without_language_counted_as_none():
+    context = FakeContext({'flush_messages': 1, 'flush_interval_ms': 10 ** 9})
+
+    context.send(AggregateFunction(), 'repos_for_commit_count', repo(1, None))
+
+    assert published_languages(context) == ['None']
+    assert context.counters['None-repos'] == 1
+
+
+def test_counter_mode_counts_language_with_the_repo_marker():
+    context = FakeContext({'flush_messages': 1000, 'flush_interval_ms': 10 ** 9})
+
+    context.send(AggregateFunction(), 'repos_for_commit_count', repo(1, 'Python'))
+
+    # Nothing left in memory that a restart could lose once the repo is marked
+    assert context.counters['1'] == 1
+    assert context.counters['Python-repos'] == 1
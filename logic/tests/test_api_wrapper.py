@@ -0,0 +1,161 @@
+import os
+
+import pytest
+
+pytest.importorskip('requests')
+
+from api_wrapper import GithubWrapper, RepoName, TransientException
+from rate_limiter import RateLimiter
+
+TOKEN = 'token'
+
+
+class FakeResponse:
+    def __init__(self, body, headers=None, status_code=200):
+        self.body = body
+        self.headers = headers or {}
+        self.status_code = status_code
+
+    def json(self):
+        return self.body
+
+
+class FakeSession:
+    """ Answers every request with response, and remembers the requests """
+    def __init__(self, response):
+        self.response = response
+        self.requests = []
+
+    def request(self, method, timeout=None, **request):
+        self.requests.append((method, request))
+        return self.response
+
+
+@pytest.fixture
+def wrapper(monkeypatch):
+    # The query template is read relative to logic/
+    monkeypatch.chdir(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    return GithubWrapper([TOKEN], session=FakeSession(None))
+
+
+REPOS = [RepoName('owner', 'one'), RepoName('owner', 'two')]
+
+
+def test_graphql_requests_paced_as_graphql(wrapper):
+    assert wrapper._resource(wrapper._stats_request(REPOS)) == 'graphql'
+    assert wrapper._resource(wrapper._find_files_request(REPOS, ['test*'])) == 'graphql'
+    assert wrapper._resource(wrapper._stats_and_files_request(REPOS, ['test*'])) == 'graphql'
+
+
+def test_rest_requests_resources(wrapper):
+    assert wrapper._resource(wrapper._files_request(REPOS[0], ['test*'])) == 'code_search'
+    assert wrapper._resource(wrapper._search_repos_request('created:2021-01-01')) == 'search'
+    assert wrapper._resource(wrapper._repos_request()) == 'core'
+
+
+def test_graphql_request_posted_to_graphql_api_url(wrapper):
+    assert wrapper._stats_request(REPOS)['url'] == wrapper.graphql_api_url
+
+
+def graphql_body(cost):
+    return {
+        'data': {
+            'rateLimit': {'cost': cost, 'remaining': 4000, 'resetAt': '2021-01-01T00:00:00Z'},
+            'repo_0': None,
+            'repo_1': None
+        }
+    }
+
+
+def test_query_cost_charged_once_per_response(wrapper, clock):
+    limiter = RateLimiter(clock=clock)
+    wrapper.rate_limiter = limiter
+    wrapper.session = FakeSession(FakeResponse(graphql_body(cost=7), {'X-RateLimit-Resource': 'graphql'}))
+
+    wrapper.get_stats_and_files(REPOS, ['test*'])
+
+    # The burst it started with, less the request itself and the rest of its cost
+    bucket = limiter._buckets[(TOKEN, 'graphql')]
+    assert bucket.tokens == pytest.approx(bucket.capacity - 7)
+    assert (TOKEN, 'core') not in limiter._buckets
+
+
+def test_stats_of_repos_not_lost_when_every_request_fails(wrapper):
+    wrapper.session = FakeSession(FakeResponse({}, status_code=502))
+    repos = [RepoName('owner', f'repo{index}') for index in range(8)]
+
+    # Not read now, rather than read as errors of each repo
+    with pytest.raises(TransientException):
+        wrapper.get_stats_partial(repos)
+
+    # Split down to the first single repo, which failed as well
+    assert len(wrapper.session.requests) == 4
+
+
+def test_repos_not_found_are_errors_of_their_own(wrapper):
+    body = graphql_body(cost=1)
+    body['data']['repo_0'] = {
+        'owner': {'login': 'owner'},
+        'primaryLanguage': {'id': 'lang', 'name': 'Python'},
+        'defaultBranchRef': {'target': {'history': {'totalCount': 42}}}
+    }
+    body['errors'] = [{'type': 'NOT_FOUND', 'path': ['repo_1'], 'message': 'Could not resolve to a Repository'}]
+    wrapper.session = FakeSession(FakeResponse(body))
+
+    stats, errors = wrapper.get_stats_partial(REPOS)
+
+    assert stats['owner/one'].commits == 42
+    assert errors == {'owner/two': 'Could not resolve to a Repository'}
+
+
+def with_node_ids(count):
+    return [RepoName('owner', f'repo{index}', node_id=f'id{index}') for index in range(count)]
+
+
+def test_node_ids_selected_at_most_100_at_a_time(wrapper):
+    query = wrapper._stats_request(with_node_ids(250))['json']['query']
+
+    assert query.count('nodes(ids:') == 3
+    assert 'nodes_2: nodes(ids: ["id200"' in query
+
+
+def test_node_results_read_across_fields(wrapper):
+    repos = with_node_ids(150)
+    response_dict = {
+        'data': {
+            'nodes_0': [{'index': index} for index in range(100)],
+            'nodes_1': [{'index': index} for index in range(100, 149)] + [None]
+        },
+        'errors': [{'type': 'NOT_FOUND', 'path': ['nodes_1', 49], 'message': 'Could not resolve to a node'}]
+    }
+
+    results = GithubWrapper._repos_results(response_dict, repos)
+
+    assert [result['index'] for result, error in results[:149]] == list(range(149))
+    assert results[149] == (None, 'Could not resolve to a node')
+
+
+class FailingSession(FakeSession):
+    """ Answers with a server error the requests with more than max_repos repos """
+    def __init__(self, response, max_repos):
+        super().__init__(response)
+        self.max_repos = max_repos
+
+    def request(self, method, timeout=None, **request):
+        self.requests.append((method, request))
+        if request['json']['query'].count('repository(') > self.max_repos:
+            return FakeResponse({}, status_code=502)
+        return self.response
+
+
+def test_find_files_split_when_batch_fails(wrapper):
+    repos = [RepoName('owner', f'repo{index}') for index in range(4)]
+    body = graphql_body(cost=1)
+    body['data']['repo_0'] = {'path_0': {'__typename': 'Tree'}}
+    wrapper.session = FailingSession(FakeResponse(body), max_repos=2)
+
+    files = wrapper.find_files(repos, ['.github/workflows'])
+
+    # Both halves were answered with the same response, so its first repo has the files
+    assert [len(repo_files) for repo_files in files] == [1, 0, 1, 0]
+    assert wrapper.last_query_splits == 1
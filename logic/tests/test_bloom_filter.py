@@ -0,0 +1,62 @@
+from bloom_filter import ShardedBloomFilter
+
+
+def new_filter():
+    bloom = ShardedBloomFilter(expected_items=1000, false_positive_rate=0.01, num_shards=4)
+    for shard in range(bloom.num_shards):
+        bloom.load_shard(shard, None)
+    return bloom
+
+
+def copy_of(bloom):
+    copy = new_filter()
+    for shard in range(bloom.num_shards):
+        copy.load_shard(shard, bloom.shard_bytes(shard))
+    return copy
+
+
+def test_item_only_new_the_first_time():
+    bloom = new_filter()
+
+    assert bloom.add('repo')
+    assert not bloom.add('repo')
+
+
+def test_false_positives_near_the_rate():
+    bloom = new_filter()
+    for index in range(1000):
+        bloom.add(f'repo{index}')
+
+    # Each one checked on a copy, so they don't add up to each other
+    false_positives = sum(not copy_of(bloom).add(f'other{index}') for index in range(1000))
+
+    assert false_positives < 30
+
+
+def test_only_changed_shards_dirty():
+    bloom = new_filter()
+
+    bloom.add('repo')
+
+    assert bloom.dirty == {bloom.shard_of('repo')}
+
+
+def test_shards_merged_with_saved_copies():
+    first = new_filter()
+    second = new_filter()
+    first.add('one')
+    second.add('two')
+
+    for shard in range(first.num_shards):
+        first.merge_shard(shard, second.shard_bytes(shard))
+
+    assert not first.add('one')
+    assert not first.add('two')
+
+
+def test_shard_of_another_size_loaded_empty():
+    bloom = new_filter()
+
+    bloom.load_shard(0, b'\xff')
+
+    assert bloom.shard_bytes(0) == bytes(bloom.shard_bits // 8)
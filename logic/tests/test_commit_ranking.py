@@ -0,0 +1,45 @@
+from commit_ranking import CommitRanking
+from message_schema import CommitRepoInfo
+
+
+def repo(repo_id, commits):
+    return CommitRepoInfo(repo_id, commits, 'owner', f'repo{repo_id}')
+
+
+def test_keeps_the_repos_with_most_commits():
+    ranking = CommitRanking(2)
+
+    for repo_id, commits in [(1, 10), (2, 30), (3, 20), (4, 5)]:
+        ranking.add(repo(repo_id, commits))
+
+    assert [record.repo_id for record in ranking.top()] == [2, 3]
+    assert ranking.min_commits() == 20
+
+
+def test_repo_seen_again_keeps_its_highest_commits():
+    ranking = CommitRanking(3)
+    ranking.add(repo(1, 10))
+
+    assert ranking.add(repo(1, 15))
+    assert not ranking.add(repo(1, 12))
+    assert ranking.top() == [repo(1, 15)]
+
+
+def test_repo_not_entering_a_full_ranking_changes_nothing():
+    ranking = CommitRanking(1)
+    ranking.add(repo(1, 10))
+
+    assert not ranking.add(repo(2, 10))
+    assert len(ranking) == 1
+
+
+def test_checkpoint_round_trip():
+    ranking = CommitRanking(3)
+    for repo_id, commits in [(1, 10), (2, 30), (3, 20)]:
+        ranking.add(repo(repo_id, commits))
+    positions = {'persistent://public/static/commit_repo_info': b'\x08\x01'}
+
+    restored, restored_positions = CommitRanking.from_checkpoint(ranking.to_checkpoint(positions), 3)
+
+    assert restored.top() == ranking.top()
+    assert restored_positions == positions
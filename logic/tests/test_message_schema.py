@@ -0,0 +1,46 @@
+import struct
+
+import pytest
+
+import message_schema
+from message_schema import BasicRepoInfo, CommitRepoInfo, LanguageResult, RepoWithCi
+
+
+@pytest.mark.parametrize('record', [
+    BasicRepoInfo(123, 'owner', 'name', 'Python', 'MDEwOlJlcG9zaXRvcnkxMjM='),
+    BasicRepoInfo(123, 'owner', 'name', None),
+    CommitRepoInfo(123, 4567, 'owner', 'ñame'),
+    RepoWithCi(123, 'C++'),
+    LanguageResult('Go', 10, 5, 2)
+])
+def test_round_trip(record):
+    assert message_schema.decode(message_schema.encode(record)) == record
+
+
+def test_encoded_with_current_version():
+    data = message_schema.encode(RepoWithCi(1, 'Go'))
+
+    assert data[0] == message_schema.SCHEMA_VERSION
+
+
+def test_version_1_repo_decodes_without_node_id():
+    texts = [b'owner', b'name', b'Python']
+    data = struct.pack('<BBqHHH', 1, 1, 123, *map(len, texts)) + b''.join(texts)
+
+    assert message_schema.decode(data) == BasicRepoInfo(123, 'owner', 'name', 'Python', None)
+
+
+def test_legacy_text_tuple_decoded_as_legacy_type():
+    record = message_schema.decode(b"(123, 'owner', 'name', 'Python')", BasicRepoInfo)
+
+    assert record == BasicRepoInfo(123, 'owner', 'name', 'Python')
+
+
+def test_legacy_text_is_not_evaluated():
+    with pytest.raises(ValueError):
+        message_schema.decode("(__import__('os').getcwd(),)")
+
+
+def test_unknown_version_rejected():
+    with pytest.raises(ValueError):
+        message_schema.decode(bytes([99, 1]) + bytes(16))
@@ -0,0 +1,39 @@
+import datetime
+
+from search_window import SearchWindow
+
+
+def test_day_round_trips_through_its_search_range():
+    window = SearchWindow.from_day('2021-03-01')
+
+    assert str(window) == '2021-03-01T00:00:00Z..2021-03-01T23:59:59Z'
+    assert SearchWindow.parse(str(window)) == window
+
+
+def test_day_split_on_hours_covering_it():
+    window = SearchWindow.from_day('2021-03-01')
+
+    first, second = window.split()
+
+    assert first.start == window.start and second.end == window.end
+    assert first.end == second.start == datetime.datetime(2021, 3, 1, 12)
+
+
+def test_hour_split_on_minutes():
+    start = datetime.datetime(2021, 3, 1, 5)
+    first, second = SearchWindow(start, start + datetime.timedelta(hours=1)).split()
+
+    assert first.end == second.start == start + datetime.timedelta(minutes=30)
+
+
+def test_odd_hours_split_on_an_hour():
+    start = datetime.datetime(2021, 3, 1)
+    first, second = SearchWindow(start, start + datetime.timedelta(hours=3)).split()
+
+    assert first.end == start + datetime.timedelta(hours=1)
+
+
+def test_single_minute_not_split():
+    start = datetime.datetime(2021, 3, 1, 5, 30)
+
+    assert SearchWindow(start, start + datetime.timedelta(minutes=1)).split() is None
@@ -0,0 +1,90 @@
+import pytest
+
+from token_leases import LocalTokenLeases, TokenLeases
+
+
+def make_leases(tokens, clock, **kwargs):
+    return LocalTokenLeases(tokens, clock=clock, lease_seconds=60, expire_in_background=False, **kwargs)
+
+
+def test_backends_have_to_provide_locks_and_quotas():
+    with pytest.raises(TypeError):
+        TokenLeases(['a'])
+
+
+def test_token_leased_by_one_worker_at_a_time(clock):
+    leases = make_leases(['a'], clock)
+
+    lease = leases.acquire()
+
+    assert lease.token == 'a'
+    assert leases.acquire() is None
+
+    leases.release(lease)
+
+    assert leases.acquire().token == 'a'
+
+
+def test_acquire_skips_excluded_tokens(clock):
+    leases = make_leases(['a', 'b'], clock)
+
+    assert leases.acquire(exclude=['a']).token == 'b'
+
+
+def test_lease_expires_without_renewal(clock):
+    leases = make_leases(['a'], clock)
+    lease = leases.acquire()
+
+    clock.now += 61
+
+    assert leases.expire() == [lease]
+    assert not leases.renew(lease)
+    assert leases.acquire().token == 'a'
+
+
+def test_renewed_lease_is_kept(clock):
+    leases = make_leases(['a'], clock)
+    lease = leases.acquire()
+
+    clock.now += 40
+    assert leases.renew(lease)
+    clock.now += 40
+
+    assert leases.expire() == []
+    assert leases.acquire() is None
+
+
+def test_release_of_expired_lease_keeps_new_holder(clock):
+    leases = make_leases(['a'], clock)
+    old = leases.acquire()
+    clock.now += 61
+    new = leases.acquire()
+
+    leases.release(old)
+
+    assert leases.renew(new)
+    assert leases.acquire() is None
+
+
+def test_quota_saved_on_renewal_is_read_by_next_holder(clock):
+    leases = make_leases(['a'], clock)
+    lease = leases.acquire('core')
+
+    leases.renew(lease, {'core': (1234, clock.now + 600)})
+    # The worker dies without releasing it
+    clock.now += 61
+
+    assert leases.acquire('core').quota == {'core': (1234, 1600.0)}
+
+
+def test_exhausted_tokens_skipped_and_fullest_first(clock):
+    leases = make_leases(['a', 'b', 'c'], clock)
+    for token, remaining in [('a', 0), ('b', 100), ('c', 4000)]:
+        leases.release(leases.acquire(exclude=[t for t in 'abc' if t != token]),
+                       {'core': (remaining, clock.now + 600)})
+
+    first = leases.acquire('core')
+    second = leases.acquire('core')
+
+    assert (first.token, second.token) == ('c', 'b')
+    assert leases.acquire('core') is None
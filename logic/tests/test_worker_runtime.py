@@ -0,0 +1,49 @@
+import threading
+
+import pytest
+
+pytest.importorskip('pulsar')
+
+from worker_runtime import Stage, WorkerRuntime
+
+
+def run_briefly(runtime, seconds=0.2):
+    runtime.start()
+    threading.Event().wait(seconds)
+    idle = runtime.is_idle()
+    runtime.stop()
+    return idle
+
+
+def test_idle_once_every_stage_finds_nothing_to_do():
+    runtime = WorkerRuntime([Stage('a', lambda: False), Stage('b', lambda: False, threads=2)],
+                            idle_sleep=0.01)
+
+    assert run_briefly(runtime)
+
+
+def test_failing_stage_is_not_idle():
+    def broken():
+        raise ValueError('broken')
+
+    runtime = WorkerRuntime([Stage('a', lambda: False), Stage('broken', broken)], idle_sleep=0.01)
+
+    assert not run_briefly(runtime)
+    assert runtime.errors['broken'] > 0
+    assert runtime.runs['broken'] == 0
+
+
+def test_final_not_run_while_a_stage_fails():
+    finals = []
+
+    def broken():
+        raise ValueError('broken')
+
+    runtime = WorkerRuntime([Stage('a', lambda: False), Stage('broken', broken)],
+                            final=lambda: finals.append(True), idle_sleep=0.01)
+    timer = threading.Timer(0.2, runtime.stop)
+    timer.start()
+    runtime.run()
+    timer.join()
+
+    assert finals == []
@@ -0,0 +1,219 @@
+"""
+Leases of GitHub tokens, so each token is used by a single worker of the cluster at a time
+and their quota is spread over all the workers, instead of all of them going through the
+same tokens.txt in the same order.
+
+A worker takes a lease on a token for lease_seconds, renews it while it keeps using the
+token, and releases it together with the quota it had left. The quota is also saved on
+every renewal, so it isn't lost if the worker dies. The next worker leasing it starts from
+that quota, and tokens with most quota left are leased first.
+
+A lease that isn't renewed in time is given back (unlocked) by a background thread, so a
+worker that stops using its tokens without releasing them doesn't keep them for longer
+than lease_seconds.
+
+Two backends:
+- PulsarTokenLeases: the lock on a token is an Exclusive subscription to a topic of its own
+  (see PulsarConnection.lock_token), which the broker releases if the worker dies. The quota
+  of a token is the last message of another topic of its own
+- LocalTokenLeases: in-process stand-in, with the same behaviour, for trying things out
+  without Pulsar
+"""
+import abc
+import random
+import threading
+import time
+from typing import Dict, Iterable, List, Optional, Tuple
+
+# resource -> (remaining, reset epoch seconds), like RateLimit.resets
+Quota = Dict[str, Tuple[int, float]]
+
+
+class TokenLease:
+    def __init__(self, token: str, expires: float, quota: Quota):
+        self.token = token
+        self.expires = expires
+        # Quota left when the token was last released
+        self.quota = quota
+
+    def __repr__(self):
+        return f"( token: ...{self.token[-4:]}, expires: {self.expires} )"
+
+
+class TokenLeases(abc.ABC):
+    """ Lease logic shared by the backends, which provide _lock, _unlock, _read_quota and
+    _write_quota """
+    def __init__(self, tokens: Iterable[str], lease_seconds: float = 300, min_remaining: int = 5,
+                 clock=time.time, expire_in_background: bool = True):
+        self.tokens = list(tokens)
+        self.lease_seconds = lease_seconds
+        self.min_remaining = min_remaining
+        self._clock = clock
+        self._random = random.Random()
+        # Last quota known of every token, to try the ones with most left first
+        self._known_quota: Dict[str, Quota] = {}
+        # token -> lease held by this worker
+        self._held: Dict[str, TokenLease] = {}
+        self._held_lock = threading.Lock()
+        self.expire_in_background = expire_in_background
+        self._reaper = None
+
+    @abc.abstractmethod
+    def _lock(self, token: str) -> bool:
+        pass
+
+    @abc.abstractmethod
+    def _unlock(self, token: str):
+        pass
+
+    @abc.abstractmethod
+    def _read_quota(self, token: str) -> Quota:
+        pass
+
+    @abc.abstractmethod
+    def _write_quota(self, token: str, quota: Quota):
+        pass
+
+    def _headroom(self, quota: Quota, resource: Optional[str]) -> float:
+        remaining, reset = quota.get(resource, (None, 0)) if resource is not None else (None, 0)
+        if remaining is None or reset <= self._clock():
+            return float('inf')
+        return remaining - self.min_remaining
+
+    def expire(self) -> List[TokenLease]:
+        """ Unlocks the held leases that weren't renewed in time. Returns them """
+        now = self._clock()
+        with self._held_lock:
+            expired = [lease for lease in self._held.values() if lease.expires <= now]
+            for lease in expired:
+                del self._held[lease.token]
+
+        for lease in expired:
+            self._unlock(lease.token)
+        return expired
+
+    def _expire_periodically(self):
+        while True:
+            time.sleep(self.lease_seconds / 4)
+            self.expire()
+
+    def _start_reaper(self):
+        if self.expire_in_background and self._reaper is None:
+            self._reaper = threading.Thread(target=self._expire_periodically, name='token_lease_reaper',
+                                            daemon=True)
+            self._reaper.start()
+
+    def _holds(self, lease: TokenLease) -> bool:
+        with self._held_lock:
+            return self._held.get(lease.token) is lease
+
+    def acquire(self, resource: Optional[str] = None, exclude: Iterable[str] = ()) -> Optional[TokenLease]:
+        """ Leases a token not in exclude, preferring the ones with most quota left for
+        resource. Tokens known to be exhausted for it are skipped. None if no token
+        could be leased """
+        self.expire()
+        self._start_reaper()
+        exclude = set(exclude)
+        candidates = [token for token in self.tokens if token not in exclude]
+        self._random.shuffle(candidates)
+        candidates.sort(key=lambda token: self._headroom(self._known_quota.get(token, {}), resource),
+                        reverse=True)
+
+        for token in candidates:
+            if not self._lock(token):
+                continue
+
+            quota = self._read_quota(token)
+            self._known_quota[token] = quota
+
+            if self._headroom(quota, resource) <= 0:
+                self._unlock(token)
+                continue
+
+            lease = TokenLease(token, self._clock() + self.lease_seconds, quota)
+            with self._held_lock:
+                self._held[token] = lease
+            return lease
+
+        return None
+
+    def _save_quota(self, token: str, quota: Optional[Quota]):
+        if quota:
+            self._known_quota[token] = quota
+            self._write_quota(token, quota)
+
+    def renew(self, lease: TokenLease, quota: Optional[Quota] = None) -> bool:
+        """ Extends a lease, saving the quota the token has left. A lease that already
+        expired can't be renewed, and is released """
+        self.expire()
+        if not self._holds(lease):
+            return False
+
+        lease.expires = self._clock() + self.lease_seconds
+        self._save_quota(lease.token, quota)
+        return True
+
+    def release(self, lease: TokenLease, quota: Optional[Quota] = None):
+        """ Gives the token back, with the quota it has left """
+        self._save_quota(lease.token, quota)
+
+        # If it expired, it was already unlocked, and might be someone else's by now
+        with self._held_lock:
+            if self._held.get(lease.token) is not lease:
+                return
+            del self._held[lease.token]
+
+        self._unlock(lease.token)
+
+
+class LocalTokenLeases(TokenLeases):
+    def __init__(self, tokens: Iterable[str], **kwargs):
+        super().__init__(tokens, **kwargs)
+        self._lock_guard = threading.Lock()
+        # token -> time its lock expires
+        self._locks: Dict[str, float] = {}
+        self._quotas: Dict[str, Quota] = {}
+
+    def _lock(self, token: str) -> bool:
+        with self._lock_guard:
+            if self._locks.get(token, 0) > self._clock():
+                return False
+
+            self._locks[token] = self._clock() + self.lease_seconds
+            return True
+
+    def _unlock(self, token: str):
+        with self._lock_guard:
+            self._locks.pop(token, None)
+
+    def renew(self, lease: TokenLease, quota: Optional[Quota] = None) -> bool:
+        if not super().renew(lease, quota):
+            return False
+
+        with self._lock_guard:
+            self._locks[lease.token] = lease.expires
+        return True
+
+    def _read_quota(self, token: str) -> Quota:
+        return dict(self._quotas.get(token, {}))
+
+    def _write_quota(self, token: str, quota: Quota):
+        self._quotas[token] = dict(quota)
+
+
+class PulsarTokenLeases(TokenLeases):
+    def __init__(self, pulsar, **kwargs):
+        super().__init__(pulsar.token_list, **kwargs)
+        self.pulsar = pulsar
+
+    def _lock(self, token: str) -> bool:
+        return self.pulsar.lock_token(token)
+
+    def _unlock(self, token: str):
+        self.pulsar.unlock_token(token)
+
+    def _read_quota(self, token: str) -> Quota:
+        return self.pulsar.get_token_quota(token)
+
+    def _write_quota(self, token: str, quota: Quota):
+        self.pulsar.put_token_quota(token, quota)
@@ -0,0 +1,153 @@
+"""
+Hands out GitHub tokens by how much quota they have left, instead of in turns.
+
+GitHub rate limits each token separately per resource ('core', 'search', 'code_search',
+'graphql'..). Every response tells the quota left for the resource it used, and when it
+resets, in its X-RateLimit-* headers (see GithubWrapper). The scheduler keeps the last
+values seen for each token and resource, and acquire() returns the token with most
+requests left for the resource asked for. When all of them are exhausted, it sleeps
+exactly until the first one resets.
+
+A token never seen for a resource is assumed to have its full quota.
+"""
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+
+
+class TokenQuota:
+    def __init__(self, remaining: Optional[int] = None, reset: float = 0):
+        # Requests left, None if unknown. Valid until reset (epoch seconds)
+        self.remaining = remaining
+        self.reset = reset
+
+    def __repr__(self):
+        return f"( remaining: {self.remaining}, reset: {self.reset} )"
+
+
+class TokenScheduler:
+    def __init__(self,
+                 tokens: List[str],
+                 min_remaining: int = 5,
+                 exhausted_wait: float = 60,
+                 clock=time.time,
+                 sleep=time.sleep):
+        self.tokens = list(tokens)
+        # A token with fewer requests left than this is considered exhausted
+        self.min_remaining = min_remaining
+        # How long a token is left alone after a rate limit error without reset time
+        self.exhausted_wait = exhausted_wait
+        self._clock = clock
+        self._sleep = sleep
+        self._lock = threading.Lock()
+        # token -> resource -> TokenQuota
+        self._quotas: Dict[str, Dict[str, TokenQuota]] = {token: {} for token in self.tokens}
+
+    def add_token(self, token: str):
+        with self._lock:
+            if token not in self.tokens:
+                self.tokens.append(token)
+
+    def remove_token(self, token: str):
+        with self._lock:
+            if token in self.tokens:
+                self.tokens.remove(token)
+
+    def _quota(self, token: str, resource: str) -> TokenQuota:
+        quota = self._quotas.setdefault(token, {}).setdefault(resource, TokenQuota())
+
+        # Past its reset, the quota is full again
+        if quota.remaining is not None and quota.reset <= self._clock():
+            quota.remaining = None
+
+        return quota
+
+    def update(self, token: str, resource: str, remaining: int, reset: float):
+        with self._lock:
+            quota = self._quota(token, resource)
+            quota.remaining = remaining
+            quota.reset = reset
+
+    def update_from_headers(self, token: str, headers) -> bool:
+        """ Reads the X-RateLimit-* headers of a response got with token. Returns
+        False if it had none """
+        try:
+            resource = headers.get('X-RateLimit-Resource')
+            remaining = int(headers.get('X-RateLimit-Remaining'))
+            reset = float(headers.get('X-RateLimit-Reset'))
+        except (TypeError, ValueError):
+            return False
+
+        self.update(token, resource or 'core', remaining, reset)
+        return True
+
+    def exhausted(self, token: str, resource: str, reset: Optional[float] = None):
+        """ The token got a rate limit error for resource """
+        with self._lock:
+            quota = self._quota(token, resource)
+            quota.remaining = 0
+            if reset is not None:
+                quota.reset = reset
+            elif quota.reset <= self._clock():
+                quota.reset = self._clock() + self.exhausted_wait
+
+    def _headroom(self, token: str, resource: str) -> float:
+        remaining = self._quota(token, resource).remaining
+        return float('inf') if remaining is None else remaining - self.min_remaining
+
+    def pick(self, resource: str) -> Optional[str]:
+        """ Token with most requests left for resource, or None if all are exhausted """
+        with self._lock:
+            if len(self.tokens) < 1:
+                return None
+
+            token = max(self.tokens, key=lambda candidate: self._headroom(candidate, resource))
+
+            if self._headroom(token, resource) <= 0:
+                return None
+
+            # Count the request that's about to be made, so concurrent users spread over
+            # the tokens before their headers arrive
+            quota = self._quota(token, resource)
+            if quota.remaining is not None:
+                quota.remaining -= 1
+
+            return token
+
+    def seconds_until_reset(self, resource: str) -> float:
+        """ Until the first exhausted token resets for resource (0 if one isn't exhausted) """
+        with self._lock:
+            now = self._clock()
+            waits = []
+
+            for token in self.tokens:
+                if self._headroom(token, resource) > 0:
+                    return 0
+
+                waits.append(self._quota(token, resource).reset - now)
+
+            return max(0, min(waits)) if len(waits) > 0 else self.exhausted_wait
+
+    def acquire(self, resource: str) -> str:
+        """ Like pick, but sleeps until a token resets when all are exhausted """
+        while True:
+            token = self.pick(resource)
+
+            if token is not None:
+                return token
+
+            # One more second, as resets are rounded down to the second
+            self._sleep(self.seconds_until_reset(resource) + 1)
+
+    def known_quota(self, token: str) -> Dict[str, Tuple[int, float]]:
+        """ resource -> (remaining, reset) of the quotas known for a token """
+        with self._lock:
+            return {
+                resource: (quota.remaining, quota.reset)
+                for resource, quota in self._quotas.get(token, {}).items()
+                if quota.remaining is not None and quota.reset > self._clock()
+            }
+
+    def status(self) -> Dict[str, Dict[str, TokenQuota]]:
+        with self._lock:
+            return {token: dict(quotas) for token, quotas in self._quotas.items()}
@@ -0,0 +1,133 @@
+"""
+Runs each stage of a GithubProcessor in a pool of threads of its own, instead of all of
+them one after the other in a single thread (see run_tasks_until_fail in main.py), so a
+stage waiting on GitHub doesn't hold the others up.
+
+Stages are still connected through their Pulsar topics, and share the processor: its
+token scheduler, rate limiter and leases. Every thread runs the task of its stage over and
+over, and sleeps idle_sleep whenever it had nothing to do.
+
+final (like GithubProcessor.process_results) is run from the calling thread once every
+thread found nothing to do after the last time any of them did something. A run that
+raised isn't a run with nothing to do: its thread isn't idle until a later run of it
+finds nothing to do, so a broken stage holds final back instead of triggering it. The runtime
+stops when a task raises ProcessingFinishedException, or on stop().
+"""
+import threading
+import time
+from typing import Callable, Dict, List, NamedTuple, Optional
+
+from githubprocessor import ProcessingFinishedException
+
+
+class Stage(NamedTuple):
+    name: str
+    task: Callable[[], bool]
+    threads: int = 1
+
+
+class WorkerRuntime:
+    def __init__(self,
+                 stages: List[Stage],
+                 final: Optional[Callable[[], bool]] = None,
+                 idle_sleep: float = 1.0,
+                 verbose: bool = False):
+        self.stages = stages
+        self.final = final
+        self.idle_sleep = idle_sleep
+        self.verbose = verbose
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+        self._threads: List[threading.Thread] = []
+        # thread name -> when it last started a run that found nothing to do, or None if
+        # its last run did something or raised
+        self._idle_since: Dict[str, Optional[float]] = {}
+        self._last_busy = time.monotonic()
+        self._finished = None
+        self.runs = {stage.name: 0 for stage in stages}
+        self.errors = {stage.name: 0 for stage in stages}
+
+    def _log(self, message):
+        if not self.verbose:
+            return
+
+        print(message)
+
+    def _work(self, stage: Stage, name: str):
+        while not self._stop.is_set():
+            started = time.monotonic()
+
+            failed = False
+            try:
+                busy = stage.task()
+            except ProcessingFinishedException as e:
+                self._finished = e
+                self._stop.set()
+                return
+            except Exception as e:
+                print(f"\n*** Exception in stage {stage.name}: {e!r} ***\n")
+                busy = False
+                failed = True
+
+            with self._lock:
+                if failed:
+                    # It may have left work behind, or not done its own: neither this
+                    # thread nor the others are idle as of now
+                    self._idle_since[name] = None
+                    self._last_busy = time.monotonic()
+                    self.errors[stage.name] += 1
+                elif busy:
+                    self._idle_since[name] = None
+                    self._last_busy = time.monotonic()
+                    self.runs[stage.name] += 1
+                else:
+                    self._idle_since[name] = started
+
+            if not busy:
+                self._stop.wait(self.idle_sleep)
+
+    def is_idle(self) -> bool:
+        """ Whether every thread found nothing to do, in runs started after any
+        thread last did something """
+        with self._lock:
+            return len(self._idle_since) == len(self._threads) and all(
+                since is not None and since > self._last_busy
+                for since in self._idle_since.values())
+
+    def start(self):
+        for stage in self.stages:
+            for index in range(stage.threads):
+                name = f'{stage.name}-{index}'
+                thread = threading.Thread(target=self._work, args=(stage, name), name=name, daemon=True)
+                self._threads.append(thread)
+
+        for thread in self._threads:
+            thread.start()
+
+        self._log(f"{__name__}: started {len(self._threads)} threads: "
+                  f"{', '.join(f'{stage.name} x{stage.threads}' for stage in self.stages)}")
+
+    def stop(self):
+        self._stop.set()
+
+        for thread in self._threads:
+            thread.join()
+
+    def run(self):
+        """ Runs the stages until they finish (raises ProcessingFinishedException then),
+        or until interrupted """
+        self.start()
+
+        try:
+            while not self._stop.wait(self.idle_sleep):
+                self._log(f"{__name__}: runs per stage: {self.runs}, errors: {self.errors}")
+
+                if self.final is not None and self.is_idle():
+                    self.final()
+        except ProcessingFinishedException as e:
+            self._finished = e
+        finally:
+            self.stop()
+
+        if self._finished is not None:
+            raise self._finished